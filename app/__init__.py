@@ -19,6 +19,34 @@ def create_app(config_name='default'):
     login_manager.login_view = 'main.login'
     mail.init_app(app)
 
+    # リクエストごとの応答時間とSQL文の数・時間の集計(/admin/metrics)
+    from .metrics import request_metrics
+    request_metrics.init_app(app)
+
+    from .jobs import import_jobs
+    import_jobs.init_app(app)
+
+    # メールは OutboxMessage に登録し、送信は mail_outbox.start() したプロセスが行う
+    from .outbox import mail_outbox
+    mail_outbox.init_app(app)
+
+    # load_user() で使うユーザーのキャッシュ
+    from .cache import user_cache
+    user_cache.init_app(app)
+    # 店舗の一覧・品番→商品IDの対応表のキャッシュ(店舗・商品の書き込み時に世代番号を進めるフックも登録される)
+    from .cache import reference_cache
+    reference_cache.init_app(app)
+    # /products の行ごとの描画結果のキャッシュ
+    from .cache import row_fragment_cache
+    row_fragment_cache.init_app(app)
+
+    # 在庫の変更を /products の画面へ配信する(書き込みのコミット時にイベントを積むフックも登録される)
+    from .events import inventory_events
+    inventory_events.init_app(app)
+
+    # 在庫の書き込み時に在庫アラートの状態変化を記録するフックを登録する
+    from . import alerts
+
     from .routes import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
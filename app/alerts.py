@@ -0,0 +1,175 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from . import db
+from .models import User, Store, Product, Inventory, StockAlert, get_jst_now
+
+
+def _is_low(quantity, threshold):
+    return quantity is not None and threshold is not None and quantity <= threshold
+
+
+def stock_transition(old_quantity, old_threshold, new_quantity, new_threshold):
+    """
+    在庫数・閾値の変更で在庫アラートの状態が変わるかを判定する
+
+    閾値以下になった場合は 'low'、閾値を上回った場合は 'recovered'、変わらない場合は None を返す。
+    新規作成の在庫は変更前の値を None として渡す(作成時点で閾値以下なら 'low')。
+    """
+    was_low = _is_low(old_quantity, old_threshold)
+    is_low = _is_low(new_quantity, new_threshold)
+    if is_low and not was_low:
+        return 'low'
+    if was_low and not is_low:
+        return 'recovered'
+    return None
+
+
+def record_stock_transitions(changes):
+    """
+    バルクUPDATE/INSERTで在庫を書き込んだ処理から、アラート状態の変化をまとめて StockAlert に記録する関数
+
+    changes は (在庫ID, 変更前の在庫数, 変更前の閾値, 変更後の在庫数, 変更後の閾値) のイテラブル。
+    呼び出し側のトランザクションの中で書き込むので、在庫の更新と一緒にコミット・ロールバックされる。
+    ORM経由の更新は before_flush のフックで自動的に記録されるので、この関数を呼ぶ必要はない。
+
+    戻り値は記録した変化の件数
+    """
+    now = get_jst_now()
+    rows = []
+    for inventory_id, old_quantity, old_threshold, new_quantity, new_threshold in changes:
+        state = stock_transition(old_quantity, old_threshold, new_quantity, new_threshold)
+        if state:
+            rows.append({
+                'inventory_id': inventory_id,
+                'state': state,
+                'quantity': new_quantity,
+                'threshold': new_threshold,
+                'created_at': now
+            })
+    if rows:
+        db.session.execute(db.insert(StockAlert), rows)
+    return len(rows)
+
+
+def _old_value(state, key):
+    """ORMオブジェクトの属性の変更前の値(変更されていなければ現在の値)"""
+    history = state.attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.object, key)
+
+
+@event.listens_for(Session, 'before_flush')
+def _detect_stock_transitions(session, flush_context, instances):
+    """
+    ORM経由で在庫を作成・更新したときに、アラート状態の変化を StockAlert として同じフラッシュで書き込む
+
+    画面・API・アロケーション・バッチ更新など、Inventory オブジェクトを変更するすべての処理がここを通る。
+    """
+    for obj in session.new:
+        if isinstance(obj, Inventory):
+            quantity = obj.quantity if obj.quantity is not None else 0
+            threshold = obj.threshold if obj.threshold is not None else Inventory.__table__.c.threshold.default.arg
+            if stock_transition(None, None, quantity, threshold):
+                session.add(StockAlert(inventory=obj, state='low', quantity=quantity, threshold=threshold))
+
+    for obj in session.dirty:
+        if not isinstance(obj, Inventory):
+            continue
+        state = inspect(obj)
+        if not (state.attrs.quantity.history.has_changes() or state.attrs.threshold.history.has_changes()):
+            continue
+        transition = stock_transition(
+            _old_value(state, 'quantity'), _old_value(state, 'threshold'), obj.quantity, obj.threshold
+        )
+        if transition:
+            session.add(StockAlert(inventory=obj, state=transition, quantity=obj.quantity, threshold=obj.threshold))
+
+
+def pending_stock_alerts():
+    """
+    未処理のアラート状態の変化を読み、通知が必要な在庫を返す関数
+
+    同じ在庫に複数の変化がある場合は最後の変化だけを見る(low → recovered なら通知しない)。
+    戻り値は (未処理の StockAlert のIDのリスト, 現在も閾値以下の在庫の行のリスト)。
+    在庫の行は店舗名・商品名を1回の結合クエリで取得した
+    (id, store_id, store_name, product_name, item_number, quantity, threshold) で、店舗名・商品名の順に並ぶ。
+    """
+    pending = db.session.execute(
+        db.select(StockAlert.id, StockAlert.inventory_id, StockAlert.state)
+        .where(StockAlert.processed_at.is_(None))
+        .order_by(StockAlert.id)
+    ).all()
+
+    latest = {}
+    for _, inventory_id, state in pending:
+        latest[inventory_id] = state
+    low_ids = [inventory_id for inventory_id, state in latest.items() if state == 'low']
+
+    items = []
+    if low_ids:
+        items = db.session.execute(
+            db.select(
+                Inventory.id, Inventory.store_id, Store.name.label('store_name'),
+                Product.name.label('product_name'), Product.item_number,
+                Inventory.quantity, Inventory.threshold
+            )
+            .join(Store, Store.id == Inventory.store_id)
+            .join(Product, Product.id == Inventory.product_id)
+            .where(Inventory.id.in_(low_ids), Inventory.quantity <= Inventory.threshold)
+            .order_by(Store.name, Product.name)
+        ).all()
+    return [alert_id for alert_id, _, _ in pending], items
+
+
+def build_alert_digests(items):
+    """
+    在庫アラートの行から、送信するメールの一覧を組み立てる関数
+
+    行は店舗ごとにメモリ上でまとめ、店舗ごとのダイジェストをその店舗の店長(User.store_id)へ、
+    全店舗分のまとめを管理者へ送る。店長の読み込みも1回のクエリで行う。
+    戻り値は [(宛先のリスト, 件名, テンプレート, テンプレートに渡す値), ...]
+    """
+    by_store = {}
+    for item in items:
+        by_store.setdefault(item.store_id, []).append(item)
+
+    managers = {}
+    if by_store:
+        for store_id, email in db.session.execute(
+            db.select(User.store_id, User.email).where(User.role == 'manager', User.store_id.in_(by_store.keys()))
+        ):
+            managers.setdefault(store_id, []).append(email)
+
+    digests = []
+    for store_id, store_items in by_store.items():
+        if store_id in managers:
+            store_name = store_items[0].store_name
+            digests.append((
+                managers[store_id],
+                f'【在庫アラート】{store_name}',
+                'email/summary_alert',
+                {'items': store_items, 'store_name': store_name}
+            ))
+
+    admins = db.session.scalars(db.select(User.email).where(User.role == 'admin')).all()
+    if admins and items:
+        digests.append((
+            admins,
+            '【デイリーレポート】在庫アラート通知',
+            'email/summary_alert',
+            {'items': items, 'store_name': None}
+        ))
+    return digests
+
+
+def mark_stock_alerts_processed(alert_ids):
+    """通知を処理したアラート状態の変化に処理日時を記録する"""
+    if not alert_ids:
+        return
+    now = get_jst_now()
+    for i in range(0, len(alert_ids), 500):
+        db.session.execute(
+            db.update(StockAlert).where(StockAlert.id.in_(alert_ids[i:i + 500])).values(processed_at=now)
+        )
+    db.session.commit()
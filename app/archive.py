@@ -0,0 +1,298 @@
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, time, timedelta
+import numpy as np
+import pandas as pd
+from flask import current_app
+from . import db
+from .models import User, Store, Product, Inventory, InventoryLog, InventoryLogSummary, get_jst_now
+
+# アーカイブファイルに保存する列(timestamp 以外は整数)
+ARCHIVE_COLUMNS = ['id', 'timestamp', 'inventory_id', 'user_id',
+                   'quantity_before', 'quantity_after', 'threshold_before', 'threshold_after']
+
+ARCHIVE_FILE = re.compile(r'^inventory_log_(\d{4})-(\d{2})\.npz$')
+
+# 展開済みのアーカイブをプロセス内に置いておく月数(/logs のページ送りのたびにファイルを展開し直さない)
+ARCHIVE_CACHE_MONTHS = 2
+# アーカイブの行に店舗名・商品名・ユーザー名を付けるとき、一度に名前を引く行数(最初は小さく、徐々に増やす)
+LABEL_BATCH_MIN = 64
+LABEL_BATCH_MAX = 1000
+
+# アーカイブから読んだログを、log_rows_query の結果と同じ属性名で扱うための行
+ArchivedLogRow = namedtuple('ArchivedLogRow', [
+    'id', 'timestamp', 'quantity_before', 'quantity_after', 'threshold_before', 'threshold_after',
+    'inventory_id', 'username', 'store_name', 'product_name', 'item_number'
+])
+
+
+def archive_dir():
+    return current_app.config.get('LOG_ARCHIVE_DIR') or os.path.join(current_app.instance_path, 'log_archive')
+
+
+def _next_month(month):
+    return datetime(month.year + (month.month == 12), month.month % 12 + 1, 1)
+
+
+def archive_path(month):
+    return os.path.join(archive_dir(), f'inventory_log_{month:%Y-%m}.npz')
+
+
+def archived_months():
+    """アーカイブ済みの月(各月1日の datetime)を古い順に返す"""
+    directory = archive_dir()
+    if not os.path.isdir(directory):
+        return []
+    months = []
+    for name in os.listdir(directory):
+        match = ARCHIVE_FILE.match(name)
+        if match:
+            months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+_archive_cache = OrderedDict()
+_archive_cache_lock = threading.Lock()
+
+
+def load_archive(month):
+    """
+    1か月分のアーカイブを {列名: numpy配列} で返す。ファイルがなければ None
+
+    直近に読んだ ARCHIVE_CACHE_MONTHS か月分は、ファイルの更新日時が変わらない限り展開済みの配列を使い回す。
+    返す配列は共有されるので、呼び出し側で変更しないこと。
+    """
+    path = archive_path(month)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _archive_cache_lock:
+        cached = _archive_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            _archive_cache.move_to_end(path)
+            return cached[1]
+
+    with np.load(path) as data:
+        columns = {name: data[name] for name in ARCHIVE_COLUMNS}
+    with _archive_cache_lock:
+        _archive_cache[path] = (mtime, columns)
+        _archive_cache.move_to_end(path)
+        while len(_archive_cache) > ARCHIVE_CACHE_MONTHS:
+            _archive_cache.popitem(last=False)
+    return columns
+
+
+def _save_archive(month, columns):
+    """アーカイブを一時ファイルに書いてから置き換える(途中で止まっても壊れたファイルを残さない)"""
+    os.makedirs(archive_dir(), exist_ok=True)
+    path = archive_path(month)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **columns)
+    os.replace(tmp_path, path)
+
+
+def _read_log_columns(start, end, batch_size):
+    """[start, end) の操作ログを列ごとの numpy 配列として読み込む"""
+    values = {name: [] for name in ARCHIVE_COLUMNS}
+    query = (
+        db.select(*[getattr(InventoryLog, name) for name in ARCHIVE_COLUMNS])
+        .where(InventoryLog.timestamp >= start, InventoryLog.timestamp < end)
+        .order_by(InventoryLog.timestamp, InventoryLog.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in db.session.execute(query):
+        for name, value in zip(ARCHIVE_COLUMNS, row):
+            values[name].append(value)
+
+    columns = {name: np.array(values[name], dtype=np.int64) for name in ARCHIVE_COLUMNS if name != 'timestamp'}
+    columns['timestamp'] = np.array(values['timestamp'], dtype='datetime64[us]')
+    return columns
+
+
+def _merge_columns(existing, columns):
+    """既存のアーカイブと新しく読んだログを合わせ、IDの重複を除いて (日時, ID) 順に並べる"""
+    if existing is not None:
+        columns = {name: np.concatenate([existing[name], columns[name]]) for name in ARCHIVE_COLUMNS}
+    _, unique = np.unique(columns['id'], return_index=True)
+    order = unique[np.lexsort((columns['id'][unique], columns['timestamp'][unique]))]
+    return {name: columns[name][order] for name in ARCHIVE_COLUMNS}
+
+
+def _daily_summaries(columns):
+    """1か月分のログから、在庫ごと・日ごとの集計行を作る"""
+    df = pd.DataFrame(columns)
+    delta = df['quantity_after'] - df['quantity_before']
+    df['day'] = df['timestamp'].dt.date
+    df['quantity_in'] = delta.clip(lower=0)
+    df['quantity_out'] = (-delta).clip(lower=0)
+    # ログは日時順に並んでいるので、first / last がその日の最初と最後の値になる
+    summary = df.groupby(['inventory_id', 'day'], sort=False).agg(
+        change_count=('id', 'size'),
+        quantity_open=('quantity_before', 'first'),
+        quantity_close=('quantity_after', 'last'),
+        quantity_in=('quantity_in', 'sum'),
+        quantity_out=('quantity_out', 'sum'),
+        threshold_close=('threshold_after', 'last'),
+    ).reset_index()
+    return [
+        {key: (value.item() if hasattr(value, 'item') else value) for key, value in record.items()}
+        for record in summary.to_dict('records')
+    ]
+
+
+def archive_inventory_logs(retention_days=None, batch_size=None):
+    """
+    保存期間を過ぎた操作ログをアーカイブファイルへ移し、データベースから削除する関数
+
+    ログは月ごとに instance/log_archive/inventory_log_YYYY-MM.npz へ列ごとに圧縮して保存し、
+    その月の在庫ごと・日ごとの集計を InventoryLogSummary に書き込んでから、元の行を batch_size 件ずつ削除する。
+    途中で止まっても、再実行すればアーカイブ済みの行はIDで重複を除いて書き直すので、ログが失われることはない。
+
+    戻り値は {'archived_rows': 件数, 'months': [YYYY-MM, ...], 'cutoff': 日時}
+    """
+    config = current_app.config
+    retention_days = config['LOG_RETENTION_DAYS'] if retention_days is None else retention_days
+    batch_size = batch_size or config['LOG_ARCHIVE_BATCH_SIZE']
+
+    # 保存期間の境目は日の始まりに揃える(集計が1日の途中で切れないようにする)
+    today = get_jst_now().replace(tzinfo=None).date()
+    cutoff = datetime.combine(today - timedelta(days=retention_days), time.min)
+
+    oldest = db.session.scalar(db.select(db.func.min(InventoryLog.timestamp)).where(InventoryLog.timestamp < cutoff))
+    archived_rows = 0
+    months = []
+    if oldest is None:
+        return {'archived_rows': 0, 'months': [], 'cutoff': cutoff}
+
+    month = datetime(oldest.year, oldest.month, 1)
+    while month < cutoff:
+        next_month = _next_month(month)
+        columns = _read_log_columns(month, min(next_month, cutoff), batch_size)
+        log_ids = columns['id'].tolist()
+        if log_ids:
+            merged = _merge_columns(load_archive(month), columns)
+            _save_archive(month, merged)
+
+            # 集計はその月のアーカイブ全体から作り直す
+            db.session.execute(db.delete(InventoryLogSummary).where(
+                InventoryLogSummary.day >= month.date(), InventoryLogSummary.day < next_month.date()
+            ))
+            db.session.execute(db.insert(InventoryLogSummary), _daily_summaries(merged))
+            db.session.commit()
+
+            for i in range(0, len(log_ids), batch_size):
+                db.session.execute(db.delete(InventoryLog).where(InventoryLog.id.in_(log_ids[i:i + batch_size])))
+                db.session.commit()
+
+            archived_rows += len(log_ids)
+            months.append(f'{month:%Y-%m}')
+        month = next_month
+
+    return {'archived_rows': archived_rows, 'months': months, 'cutoff': cutoff}
+
+
+class _LogLabels:
+    """
+    アーカイブの在庫ID・ユーザーIDを表示用の名前に変換するクラス
+
+    名前は実際に返す行に出てくるIDの分だけをまとめて引き、引いた名前は覚えておく。
+    在庫の名前は (店舗名, 商品名, 品番)、見つからない(削除済みの)在庫・ユーザーは空欄にする。
+    """
+
+    def __init__(self):
+        self.inventories = {}
+        self.users = {}
+
+    def load(self, inventory_ids, user_ids):
+        missing = list({int(i) for i in inventory_ids} - self.inventories.keys())
+        for i in range(0, len(missing), LABEL_BATCH_MAX):
+            chunk = missing[i:i + LABEL_BATCH_MAX]
+            self.inventories.update(dict.fromkeys(chunk, ('', '', '')))
+            self.inventories.update(
+                (inventory_id, (store_name, product_name, item_number))
+                for inventory_id, store_name, product_name, item_number in db.session.execute(
+                    db.select(Inventory.id, Store.name, Product.name, Product.item_number)
+                    .join(Store, Store.id == Inventory.store_id)
+                    .join(Product, Product.id == Inventory.product_id)
+                    .where(Inventory.id.in_(chunk))
+                )
+            )
+        missing = list({int(i) for i in user_ids} - self.users.keys())
+        for i in range(0, len(missing), LABEL_BATCH_MAX):
+            chunk = missing[i:i + LABEL_BATCH_MAX]
+            self.users.update(dict.fromkeys(chunk, ''))
+            self.users.update(db.session.execute(db.select(User.id, User.username).where(User.id.in_(chunk))).all())
+
+
+def iter_archived_log_rows(store_id=None, start=None, end=None, before=None, after=None, reverse=False):
+    """
+    アーカイブされた操作ログを ArchivedLogRow として (日時, ID) の順に返すジェネレータ
+
+    start / end で日時の範囲 [start, end) を、before / after で (日時, ID) のカーソルを指定できる。
+    reverse=True の場合は新しい順に返す。範囲にかからない月のファイルは読まない。
+    """
+    lower = max(filter(None, [start, after[0] if after else None]), default=None)
+    upper = min(filter(None, [end, before[0] if before else None]), default=None)
+    months = [
+        month for month in archived_months()
+        if (lower is None or _next_month(month) > lower) and (upper is None or month <= upper)
+    ]
+    if not months:
+        return
+    if reverse:
+        months.reverse()
+
+    labels = _LogLabels()
+    store_inventory_ids = None
+    if store_id is not None:
+        store_inventory_ids = np.array(
+            db.session.scalars(db.select(Inventory.id).where(Inventory.store_id == store_id)).all(), dtype=np.int64
+        )
+
+    for month in months:
+        columns = load_archive(month)
+        timestamps, ids = columns['timestamp'], columns['id']
+        mask = np.ones(len(ids), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= np.datetime64(start)
+        if end is not None:
+            mask &= timestamps < np.datetime64(end)
+        if before is not None:
+            ts, log_id = np.datetime64(before[0]), before[1]
+            mask &= (timestamps < ts) | ((timestamps == ts) & (ids < log_id))
+        if after is not None:
+            ts, log_id = np.datetime64(after[0]), after[1]
+            mask &= (timestamps > ts) | ((timestamps == ts) & (ids > log_id))
+        if store_inventory_ids is not None:
+            mask &= np.isin(columns['inventory_id'], store_inventory_ids)
+
+        selected = np.flatnonzero(mask)
+        if reverse:
+            selected = selected[::-1]
+        # 呼び出し側は必要な行数だけ読むので(/logs は1ページ分)、少しずつ取り出して名前もその分だけ引く
+        offset, batch_size = 0, LABEL_BATCH_MIN
+        while offset < len(selected):
+            batch = selected[offset:offset + batch_size]
+            offset += len(batch)
+            batch_size = min(batch_size * 2, LABEL_BATCH_MAX)
+            values = {name: columns[name][batch].tolist() for name in ARCHIVE_COLUMNS}
+            labels.load(values['inventory_id'], values['user_id'])
+            for i in range(len(batch)):
+                store_name, product_name, item_number = labels.inventories[values['inventory_id'][i]]
+                yield ArchivedLogRow(
+                    id=values['id'][i],
+                    timestamp=values['timestamp'][i],
+                    quantity_before=values['quantity_before'][i],
+                    quantity_after=values['quantity_after'][i],
+                    threshold_before=values['threshold_before'][i],
+                    threshold_after=values['threshold_after'][i],
+                    inventory_id=values['inventory_id'][i],
+                    username=labels.users[values['user_id'][i]],
+                    store_name=store_name,
+                    product_name=product_name,
+                    item_number=item_number,
+                )
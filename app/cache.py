@@ -0,0 +1,315 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from . import db
+from .models import User, Store, Product, CacheGeneration
+
+
+class UserCache:
+    """
+    ログイン中のユーザーを USER_CACHE_TTL 秒だけプロセス内にキャッシュするクラス
+
+    Flask-Login はリクエストごとに load_user() でユーザーを読み込むので、キャッシュがあればデータベースを読まずに済む。
+    キャッシュにはどのセッションにも属さないコピーを置き、リクエストごとに session.merge(load=False) で
+    そのリクエストのセッションに載せる(SELECTは発行されず、スレッド間で同じオブジェクトを共有しない)。
+
+    ユーザーの権限・所属店舗を変更したときは invalidate() で消す。
+    他のプロセスのキャッシュは消せないので、他のプロセスには最長 USER_CACHE_TTL 秒遅れて反映される。
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # invalidate() のたびに進める。読み込み中に無効化されたユーザーをキャッシュに置かないために使う
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('USER_CACHE_TTL', 30)
+        app.extensions['user_cache'] = self
+
+    @staticmethod
+    def _detached_copy(user):
+        """列の値だけを写した、どのセッションにも属さない User を作る"""
+        copy = User(**{attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs})
+        make_transient_to_detached(copy)
+        return copy
+
+    def get(self, user_id):
+        """ユーザーを返す(見つからなければ None)。返すオブジェクトは現在のセッションに属している"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                cached = entry[1]
+            else:
+                self.misses += 1
+                self._entries.pop(user_id, None)
+                cached = None
+            generation = self._generation
+
+        if cached is not None:
+            return db.session.merge(cached, load=False)
+
+        user = db.session.get(User, user_id)
+        if user is not None and self.ttl > 0:
+            copy = self._detached_copy(user)
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[user_id] = (now + self.ttl, copy)
+        return user
+
+    def invalidate(self, user_id):
+        """ユーザーのキャッシュを消す(ユーザー情報を変更したときに呼ぶ)"""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """ヒット数・ミス数などの統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None,
+            }
+
+
+user_cache = UserCache()
+
+
+# キャッシュする店舗。ORMオブジェクトではないので、スレッド間で共有しても安全
+StoreRef = namedtuple('StoreRef', ['id', 'name', 'address'])
+
+# CacheGeneration.name: 店舗・商品の世代番号
+# (在庫は書き込みが多く、1つの行を毎回書き換えると競合するので世代番号を持たない。在庫の変化は行ごとのバージョンで判定する)
+REFERENCE_GENERATION = 'reference'
+
+
+def bump_generation(name, session=None):
+    """
+    世代番号を1つ進める
+
+    呼び出し側のトランザクションの中で書き込むので、元データの書き込みと一緒にコミット・ロールバックされる。
+    ORM経由の書き込みは before_flush のフックで自動的に呼ばれるので、
+    バルクINSERT/UPDATEで書き込む処理だけが bump_reference_generation() などを呼ぶ。
+    """
+    session = session or db.session
+    written = session.info.setdefault('written_generations', set())
+    if name in written:
+        # 同じトランザクションの中では1回進めれば十分
+        return
+    table = CacheGeneration.__table__
+    connection = session.connection()
+    result = connection.execute(
+        table.update().where(table.c.name == name).values(value=table.c.value + 1)
+    )
+    if not result.rowcount:
+        connection.execute(table.insert().values(name=name, value=1))
+    written.add(name)
+
+
+def bump_reference_generation(session=None):
+    """店舗・商品をバルクINSERT/UPDATEで書き込んだときに呼ぶ"""
+    bump_generation(REFERENCE_GENERATION, session)
+
+
+def current_generation(name):
+    """
+    世代番号を返す
+
+    世代番号はリクエスト(アプリケーションコンテキスト)ごとに1回だけ、全種類をまとめて読む。
+    """
+    if 'cache_generations' not in g:
+        g.cache_generations = dict(db.session.execute(db.select(CacheGeneration.name, CacheGeneration.value)).all())
+    return g.cache_generations.get(name, 0)
+
+
+def _is_written(session, obj, classes):
+    return isinstance(obj, classes) and (
+        obj in session.new or obj in session.deleted or session.is_modified(obj, include_collections=False)
+    )
+
+
+@event.listens_for(Session, 'before_flush')
+def _detect_generation_writes(session, flush_context, instances):
+    """ORM経由で店舗・商品を作成・変更・削除したときに、同じトランザクションで世代番号を進める"""
+    objects = [*session.new, *session.dirty, *session.deleted]
+    if any(_is_written(session, obj, (Store, Product)) for obj in objects):
+        bump_generation(REFERENCE_GENERATION, session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _generations_committed(session):
+    if session.info.pop('written_generations', None) and has_app_context():
+        # 同じリクエストの中で、書き込んだ後のデータを読めるよう世代番号を読み直させる
+        g.pop('cache_generations', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _generations_rolled_back(session):
+    session.info.pop('written_generations', None)
+
+
+class _ReferenceData:
+    """ある世代の店舗・商品の読み込み結果(作成後は変更しない)"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.stores = tuple(
+            StoreRef(*row) for row in db.session.execute(
+                db.select(Store.id, Store.name, Store.address).order_by(Store.name)
+            )
+        )
+        self.stores_by_id = {s.id: s for s in self.stores}
+        self.store_ids = {s.name: s.id for s in self.stores}
+        self.product_ids = dict(db.session.execute(db.select(Product.item_number, Product.id)).all())
+
+
+class ReferenceCache:
+    """
+    店舗の一覧と品番→商品IDの対応表をプロセス内にキャッシュするクラス
+
+    店舗・商品を書き換えると CacheGeneration の世代番号が進む(ORMのフックと bump_reference_generation())。
+    キャッシュはリクエストごとに1回だけ世代番号を読み(current_generation())、
+    変わっていたときだけ店舗・商品を読み直す。世代番号はデータベースにあるので、
+    他のプロセスが書き換えた場合も、次のリクエストで読み直される。
+
+    返す値は全スレッドで共有するので、呼び出し側で変更しないこと(変更する場合はコピーする)。
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._data = None
+        self.hits = 0
+        self.reloads = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['reference_cache'] = self
+
+    def _get(self):
+        if REFERENCE_GENERATION in db.session.info.get('written_generations', ()):
+            # このトランザクションで書き換えた(まだコミットしていない)店舗・商品は、共有のキャッシュに置かない
+            return _ReferenceData(None)
+
+        generation = current_generation(REFERENCE_GENERATION)
+        data = self._data
+        if data is not None and data.generation == generation:
+            with self._lock:
+                self.hits += 1
+            return data
+
+        with self._lock:
+            data = self._data
+            if data is None or data.generation != generation:
+                data = self._data = _ReferenceData(generation)
+                self.reloads += 1
+            else:
+                self.hits += 1
+        return data
+
+    def stores(self):
+        """店舗名順の店舗(StoreRef)のタプル"""
+        return self._get().stores
+
+    def store(self, store_id):
+        """店舗IDから店舗(StoreRef)を返す。なければ None"""
+        return self._get().stores_by_id.get(store_id)
+
+    def store_ids(self):
+        """店舗名→店舗IDの辞書"""
+        return self._get().store_ids
+
+    def product_ids(self):
+        """品番→商品IDの辞書"""
+        return self._get().product_ids
+
+    def product_id(self, item_number):
+        """品番から商品IDを返す。未登録なら None"""
+        return self._get().product_ids.get(item_number)
+
+    def clear(self):
+        with self._lock:
+            self._data = None
+
+    def stats(self):
+        with self._lock:
+            data = self._data
+            return {
+                'generation': data.generation if data else None,
+                'stores': len(data.stores) if data else 0,
+                'products': len(data.product_ids) if data else 0,
+                'hits': self.hits,
+                'reloads': self.reloads,
+            }
+
+
+reference_cache = ReferenceCache()
+
+
+class FragmentCache:
+    """
+    描画済みのHTMLの断片を、内容を決める値(キー)ごとにプロセス内にキャッシュするクラス
+
+    キーには断片に表示する値そのもの(在庫のバージョンなど)を含めるので、データが変わればキーも変わり、
+    古い断片が使われることはない。使われなくなった断片は ROW_FRAGMENT_CACHE_SIZE 件を超えた分から古い順に捨てる。
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = 5000
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('ROW_FRAGMENT_CACHE_SIZE', 5000)
+        app.extensions['row_fragment_cache'] = self
+
+    def get_or_render(self, key, render):
+        """key の断片を返す。なければ render() で描画してキャッシュする"""
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        fragment = render()
+        with self._lock:
+            self._fragments[key] = fragment
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._fragments), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+row_fragment_cache = FragmentCache()
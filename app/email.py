@@ -1,71 +1,204 @@
 import os.path
 import base64
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from flask import current_app, render_template
+from jinja2 import TemplateNotFound
+from . import db
+from .models import OutboxMessage, get_jst_now
 
 # 認証スコープ（メール送信権限）
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 
-def get_gmail_service():
+
+class GmailTransport:
     """
-    認証を行い、Gmail APIサービスを操作するためのオブジェクトを返す関数
+    Gmail APIでメールを送信するトランスポート
+
+    token.json の読み込みとサービスオブジェクトの構築は最初の送信時に1回だけ行い、以降は使い回す。
+    アクセストークンは期限が切れたときだけリフレッシュして token.json に書き戻す。
+    Gmail APIのクライアントはスレッドセーフではないので、送信はロックで直列化する。
     """
-    creds = None
-    # token.jsonから認証情報を読み込む
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    
-    # 認証情報が無効な場合は、リフレッシュまたは再認証を試みる
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            # この部分はauthenticate_gmail.pyで実行済みなので、通常は通らない
-            # もしtoken.jsonがない場合は、再度認証が必要
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'client_secret.json', SCOPES)
-            creds = flow.run_local_server(port=8080)
-        
-        # 新しい認証情報を保存
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
 
+    def __init__(self, token_file='token.json'):
+        self.token_file = token_file
+        self._lock = threading.Lock()
+        self._creds = None
+        self._service = None
+
+    def _get_service(self):
+        # Googleのライブラリは Gmail を使う場合だけ必要なので、ここで読み込む
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from googleapiclient.discovery import build
+
+        if self._service is None:
+            if not os.path.exists(self.token_file):
+                # ブラウザでの認証はバックグラウンドでは行えないので、authenticate_gmail.py で事前に作成しておく
+                raise RuntimeError(f'{self.token_file} がありません。authenticate_gmail.py を実行して認証してください')
+            self._creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
+            self._service = build('gmail', 'v1', credentials=self._creds, cache_discovery=False)
+
+        if not self._creds.valid:
+            if not (self._creds.expired and self._creds.refresh_token):
+                raise RuntimeError('Gmailの認証情報が無効です。authenticate_gmail.py を実行して再認証してください')
+            self._creds.refresh(Request())
+            # 新しい認証情報を保存
+            with open(self.token_file, 'w') as token:
+                token.write(self._creds.to_json())
+
+        return self._service
+
+    def send(self, message):
+        # base64エンコードして、APIで送信できる形式にする
+        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        with self._lock:
+            service = self._get_service()
+            result = service.users().messages().send(userId='me', body={'raw': encoded_message}).execute()
+        return result['id']
+
+
+class SmtpTransport:
+    """MAIL_SERVER などの設定を使って SMTP でメールを送信するトランスポート"""
+
+    def __init__(self, server, port, use_tls=False, username=None, password=None, sender=None):
+        self.server = server
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.sender = sender
+
+    def send(self, message):
+        if self.sender:
+            # Gmail API 用の 'me' を送信者のアドレスに置き換える
+            del message['from']
+            message['from'] = self.sender
+        with smtplib.SMTP(self.server, self.port, timeout=30) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message, from_addr=self.username)
+        return message['Message-ID']
+
+
+class FileTransport:
+    """メールを送信せず、.eml ファイルとしてディレクトリに保存するトランスポート(テスト・オフライン用)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def send(self, message):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._count += 1
+            name = f"{get_jst_now().strftime('%Y%m%d%H%M%S%f')}_{self._count}.eml"
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(message.as_bytes())
+        return name
+
+
+def create_transport(app):
+    """設定の MAIL_TRANSPORT に応じたトランスポートを作る"""
+    config = app.config
+    kind = config.get('MAIL_TRANSPORT', 'gmail')
+    if kind == 'gmail':
+        return GmailTransport(config.get('GMAIL_TOKEN_FILE', 'token.json'))
+    if kind == 'smtp':
+        return SmtpTransport(
+            config['MAIL_SERVER'], config['MAIL_PORT'], config['MAIL_USE_TLS'],
+            config['MAIL_USERNAME'], config['MAIL_PASSWORD'], config.get('MAIL_SENDER')
+        )
+    if kind == 'file':
+        return FileTransport(config.get('MAIL_FILE_DIR') or os.path.join(app.instance_path, 'mail'))
+    raise ValueError(f'未対応の MAIL_TRANSPORT です: {kind}')
+
+
+def get_transport():
+    """アプリごとに1つだけ作ったトランスポートを返す(Gmailのサービスオブジェクトもこれと一緒に使い回される)"""
+    app = current_app._get_current_object()
+    transport = app.extensions.get('mail_transport')
+    if transport is None:
+        transport = app.extensions.setdefault('mail_transport', create_transport(app))
+    return transport
+
+
+def build_message(outbox_message):
+    """送信待ちのメールからMIMEメッセージを作る"""
+    message = MIMEMultipart('alternative')
+    message['to'] = outbox_message.recipients
+    message['from'] = 'me' # 'me'は認証済みのアカウントを指す
+    message['subject'] = outbox_message.subject
+    if outbox_message.text_body:
+        message.attach(MIMEText(outbox_message.text_body, 'plain', 'utf-8'))
+    message.attach(MIMEText(outbox_message.html_body, 'html', 'utf-8'))
+    return message
+
+
+def _render_text(template, **kwargs):
     try:
-        service = build('gmail', 'v1', credentials=creds)
-        return service
-    except HttpError as error:
-        print(f'An error occurred: {error}')
+        return render_template(template + '.txt', **kwargs)
+    except TemplateNotFound:
         return None
 
+
+def render_email(to, subject, template, **kwargs):
+    """テンプレートからメール本文を作り、送信待ちのメール(未保存の OutboxMessage)を返す"""
+    return OutboxMessage(
+        recipients=", ".join(to), # 複数の宛先に対応
+        subject=subject,
+        html_body=render_template(template + '.html', **kwargs),
+        text_body=_render_text(template, **kwargs)
+    )
+
+
+def render_emails(specs, max_workers=4):
+    """
+    複数のメールを並行して描画し、未保存の OutboxMessage のリストを返す
+
+    specs は [(宛先のリスト, 件名, テンプレート, テンプレートに渡す値), ...]。
+    各スレッドは同じアプリのアプリケーションコンテキストで描画する。
+    """
+    app = current_app._get_current_object()
+
+    def render(spec):
+        to, subject, template, context = spec
+        with app.app_context():
+            return render_email(to, subject, template, **context)
+
+    specs = list(specs)
+    if len(specs) <= 1:
+        return [render(spec) for spec in specs]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(specs)), thread_name_prefix='mail-render') as executor:
+        return list(executor.map(render, specs))
+
+
+def enqueue_messages(messages):
+    """送信待ちのメールを保存し、送信ワーカーに知らせる"""
+    messages = list(messages)
+    if not messages:
+        return messages
+    db.session.add_all(messages)
+    db.session.commit()
+
+    outbox = current_app.extensions.get('mail_outbox')
+    if outbox is not None:
+        outbox.wake()
+    return messages
+
+
 def send_email(to, subject, template, **kwargs):
     """
-    Gmail APIを使ってメールを送信する新しい関数
+    メールを送信待ちに登録する関数
+
+    ここではテンプレートの描画と OutboxMessage への保存だけを行い、実際の送信は
+    バックグラウンドの送信ワーカー(app/outbox.py)がまとめて行う。
     """
-    try:
-        service = get_gmail_service()
-        # メール本文をHTMLテンプレートから生成
-        html_body = render_template(template + '.html', **kwargs)
-        
-        # メールメッセージを作成
-        message = MIMEText(html_body, 'html')
-        message['to'] = ", ".join(to) # 複数の宛先に対応
-        message['from'] = 'me' # 'me'は認証済みのアカウントを指す
-        message['subject'] = subject
-        
-        # base64エンコードして、APIで送信できる形式にする
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        create_message = {'raw': encoded_message}
-        
-        # Gmail APIを呼び出してメールを送信
-        send_message = (service.users().messages().send(userId="me", body=create_message).execute())
-        print(f"Message Id: {send_message['id']} sent to {to}")
-
-    except HttpError as error:
-        print(f'An error occurred during email sending: {error}')
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
\ No newline at end of file
+    message, = enqueue_messages([render_email(to, subject, template, **kwargs)])
+    return message
@@ -0,0 +1,207 @@
+import threading
+import uuid
+from collections import deque
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import db
+from .models import Inventory, InventoryLog
+
+
+def inventory_event(inventory_id, product_id, store_id, quantity, threshold, version, deleted=False):
+    """
+    在庫の変更を、画面に送る小さな辞書にする
+
+    id: 在庫ID, p: 商品ID, s: 店舗ID, q: 在庫数, t: 閾値, v: バージョン, a: 閾値以下(アラート)か
+    削除された在庫は d: 1 だけを付けて送る(画面では「-」のセルに戻す)。
+    """
+    if deleted:
+        return {'id': inventory_id, 'p': product_id, 's': store_id, 'd': 1}
+    return {
+        'id': inventory_id, 'p': product_id, 's': store_id,
+        'q': quantity, 't': threshold, 'v': version,
+        'a': quantity is not None and threshold is not None and quantity <= threshold,
+    }
+
+
+class InventoryEventBroker:
+    """
+    在庫の変更イベントをプロセス内で配信するクラス
+
+    書き込みがコミットされると publish() でイベントに連番を振ってバックログに積み、待っている購読者を起こす。
+    購読者(/api/inventory/events)は最後に受け取った連番を覚えておき、それより後のイベントを wait() で受け取る。
+    バックログは INVENTORY_EVENTS_BACKLOG 件までで、それより古いイベントは捨てる。
+
+    連番はプロセスごとなので、イベントのIDには stream_id(プロセスの起動ごとに変わる)を付ける。
+    バックログから消えたイベントを待っていた場合や、別のプロセスのIDを渡された場合は、
+    取りこぼしがあったとして画面に表示中の在庫を読み直させる(resync)。
+
+    イベントを待つ接続(SSE・ロングポーリング)はその間ワーカーのスレッドを1つ使い続けるので、
+    同時に待てる接続の数を INVENTORY_EVENTS_MAX_STREAMS までに制限する(acquire_slot / release_slot)。
+    """
+
+    def __init__(self, app=None):
+        self.stream_id = uuid.uuid4().hex[:12]
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=1000)
+        self._seq = 0
+        self.max_streams = 2
+        self._streams = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        with self._cond:
+            self._events = deque(self._events, maxlen=app.config.get('INVENTORY_EVENTS_BACKLOG', 1000))
+        self.max_streams = app.config.get('INVENTORY_EVENTS_MAX_STREAMS', 2)
+        app.extensions['inventory_events'] = self
+
+    def publish(self, events):
+        """1回のコミットで変更された在庫のイベントを配信する"""
+        with self._cond:
+            for payload in events:
+                self._seq += 1
+                self._events.append((self._seq, payload))
+            self._cond.notify_all()
+
+    def acquire_slot(self):
+        """イベントを待つ接続の枠を1つ確保する。上限に達していれば False"""
+        with self._cond:
+            if self._streams >= self.max_streams:
+                return False
+            self._streams += 1
+            return True
+
+    def release_slot(self):
+        with self._cond:
+            self._streams -= 1
+
+    def latest_values(self):
+        """バックログに残っているイベントから、在庫ごとに最後に配信した (在庫数, 閾値) を返す"""
+        with self._cond:
+            return {payload['id']: (payload.get('q'), payload.get('t')) for _, payload in self._events if 'id' in payload}
+
+    def last_seq(self):
+        """最後に配信したイベントの連番"""
+        with self._cond:
+            return self._seq
+
+    def format_id(self, seq):
+        return f'{self.stream_id}:{seq}'
+
+    def parse_id(self, event_id):
+        """イベントのIDから連番を返す。別のプロセス・古い起動のIDや不正なIDなら None"""
+        stream_id, _, seq = (event_id or '').partition(':')
+        if stream_id != self.stream_id or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def wait(self, after, timeout):
+        """
+        連番 after より後のイベントを返す。なければ timeout 秒まで待つ
+
+        戻り値は (イベントのリスト, 最後の連番, 取りこぼしがあったか)
+        """
+        with self._cond:
+            if after > self._seq:
+                # このプロセスが再起動する前のIDなど
+                return [], self._seq, True
+            if self._seq == after:
+                self._cond.wait_for(lambda: self._seq > after, timeout)
+            missed = bool(self._events) and self._events[0][0] > after + 1
+            events = [payload for seq, payload in self._events if seq > after]
+            return events, self._seq, missed
+
+
+inventory_events = InventoryEventBroker()
+
+
+class RemoteChangeDetector:
+    """
+    他のプロセスで在庫が書き換えられたことを検出するクラス
+
+    在庫の書き込みはすべて InventoryLog に記録されるので、前回から増えたログ(主キーの範囲で読む)の変更後の値を、
+    このプロセスで配信したイベントの値と比べる。配信していない在庫や値が違う在庫があれば他のプロセスでの書き込みとみなす。
+    他のプロセスのイベントはこのプロセスには届かないので、検出したら画面に在庫を読み直させる。
+    増えたログが MAX_ROWS 件を超える場合(インポートなど)は、1件ずつ比べずに読み直させる。
+    """
+
+    MAX_ROWS = 500
+
+    def __init__(self):
+        self.last_log_id = self._last_log_id()
+        # 配信の合間にトランザクションや接続を持ち続けないよう、読んだらすぐに閉じる
+        db.session.close()
+
+    @staticmethod
+    def _last_log_id():
+        return db.session.scalar(db.select(db.func.coalesce(db.func.max(InventoryLog.id), 0)))
+
+    def changed(self):
+        rows = db.session.execute(
+            db.select(InventoryLog.id, InventoryLog.inventory_id, InventoryLog.quantity_after, InventoryLog.threshold_after)
+            .where(InventoryLog.id > self.last_log_id).order_by(InventoryLog.id).limit(self.MAX_ROWS + 1)
+        ).all()
+        if len(rows) > self.MAX_ROWS:
+            self.last_log_id = self._last_log_id()
+            db.session.close()
+            return True
+        db.session.close()
+        if not rows:
+            return False
+
+        self.last_log_id = rows[-1].id
+        latest = {inventory_id: (quantity, threshold) for _, inventory_id, quantity, threshold in rows}
+        published = inventory_events.latest_values()
+        return any(published.get(inventory_id) != values for inventory_id, values in latest.items())
+
+
+def record_inventory_changes(rows, session=None):
+    """
+    バルクUPDATEなどORMを通らない書き込みで変更した在庫を、コミット後に配信するよう登録する
+
+    rows は (在庫ID, 商品ID, 店舗ID, 在庫数, 閾値, バージョン) のイテラブル。
+    ORM経由の変更は after_flush のフックで自動的に登録されるので、この関数を呼ぶ必要はない。
+    """
+    session = session or db.session
+    changes = session.info.setdefault('inventory_changes', {})
+    for inventory_id, product_id, store_id, quantity, threshold, version in rows:
+        changes[inventory_id] = inventory_event(inventory_id, product_id, store_id, quantity, threshold, version)
+
+
+def request_inventory_resync(session=None):
+    """
+    1件ずつ配信するには多すぎる在庫を書き換えたとき(インポートなど)に、
+    コミット後に画面へ表示中の在庫の読み直しを指示する
+    """
+    (session or db.session).info['inventory_resync'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_inventory_changes(session, flush_context):
+    """ORM経由で作成・変更・削除された在庫を、コミット後に配信するよう登録する"""
+    changes = session.info.setdefault('inventory_changes', {})
+    for obj in session.new:
+        if isinstance(obj, Inventory):
+            changes[obj.id] = inventory_event(obj.id, obj.product_id, obj.store_id, obj.quantity, obj.threshold, obj.version)
+    for obj in session.dirty:
+        if isinstance(obj, Inventory) and session.is_modified(obj, include_collections=False):
+            changes[obj.id] = inventory_event(obj.id, obj.product_id, obj.store_id, obj.quantity, obj.threshold, obj.version)
+    for obj in session.deleted:
+        if isinstance(obj, Inventory):
+            changes[obj.id] = inventory_event(obj.id, obj.product_id, obj.store_id, None, None, None, deleted=True)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_inventory_changes(session):
+    changes = session.info.pop('inventory_changes', None)
+    resync = session.info.pop('inventory_resync', False)
+    if resync:
+        inventory_events.publish([{'resync': 1}])
+    elif changes:
+        inventory_events.publish(list(changes.values()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_inventory_changes(session):
+    session.info.pop('inventory_changes', None)
+    session.info.pop('inventory_resync', None)
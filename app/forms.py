@@ -3,6 +3,7 @@ from wtforms import StringField, PasswordField, BooleanField, SubmitField, Integ
 from wtforms.validators import DataRequired, ValidationError, Email, EqualTo, Optional, NumberRange
 from app.models import User, Product, Store, Inventory # --- Userモデルをインポート ---
 from flask_wtf.file import FileField, FileRequired, FileAllowed
+from app.cache import reference_cache
 
 class LoginForm(FlaskForm):
     username = StringField('ユーザー名', validators=[DataRequired()])
@@ -43,14 +44,14 @@ class ProductForm(FlaskForm):
     submit = SubmitField('商品を登録')
 
     def validate_item_number(self, item_number):
-        product = Product.query.filter_by(item_number=item_number.data).first()
-        if product is not None:
+        if reference_cache.product_id(item_number.data) is not None:
             raise ValidationError('この商品は既に使用されています。')
 
 
 class EditInventoryForm(FlaskForm):
     quantity = IntegerField('新しい在庫数', validators=[DataRequired(), NumberRange(min=0)])
     threshold = IntegerField('警告閾値', validators=[DataRequired(), NumberRange(min=0)])
+    version = HiddenField() # 編集を始めた時点の在庫のバージョン(競合検出用)
     submit = SubmitField('更新')
 
 
@@ -90,7 +91,7 @@ class AdminEditProfileForm(FlaskForm):
     def __init__(self, user, *args, **kwargs):
         super(AdminEditProfileForm, self).__init__(*args, **kwargs)
         # 店舗の選択肢を動的に設定
-        self.store.choices = [(s.id, s.name) for s in Store.query.order_by('name').all()]
+        self.store.choices = [(s.id, s.name) for s in reference_cache.stores()]
         # 「未所属」の選択肢を追加
         self.store.choices.insert(0, (0, '--- 未所属 ---'))
         self.user = user
@@ -108,8 +109,7 @@ class StoreForm(FlaskForm):
     submit = SubmitField('保存')
 
     def validate_name(self, name):
-        store = Store.query.filter_by(name=name.data).first()
-        if store:
+        if name.data in reference_cache.store_ids():
             raise ValidationError('この店舗名は既に使用されています。')
 
         
@@ -129,8 +129,7 @@ class EditProductForm(FlaskForm):
     # 品番が、自分以外の既存商品と重複していないかチェックするバリデータ
     def validate_item_number(self, item_number):
         if item_number.data != self.original_item_number: # 品番が変更された場合のみチェック
-            product = Product.query.filter_by(item_number=item_number.data).first()
-            if product:
+            if reference_cache.product_id(item_number.data) is not None:
                 raise ValidationError('この品番は既に使用されています。')
             
 
@@ -0,0 +1,440 @@
+import chardet
+import pandas as pd
+from openpyxl import load_workbook
+from . import db
+from .alerts import record_stock_transitions
+from .cache import reference_cache, bump_reference_generation
+from .events import request_inventory_resync
+from .models import Store, Product, Inventory, InventoryLog, ProductLog
+
+# 在庫データのインポートに必須の列
+INVENTORY_REQUIRED_COLUMNS = ['品番', '店舗名', '在庫数']
+# 商品マスタのインポートに必須の列
+PRODUCT_REQUIRED_COLUMNS = ['品番', '商品名']
+
+# 文字コード判定に使う先頭部分のバイト数
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+class ImportValidationError(Exception):
+    """インポートするファイルの内容が不正な場合に送出される例外"""
+    pass
+
+
+def detect_encoding(filepath, sample_size=ENCODING_SAMPLE_SIZE):
+    """ファイルの先頭部分だけを読んで文字コードを判定する"""
+    with open(filepath, 'rb') as rawdata:
+        sample = rawdata.read(sample_size)
+    # 判定できない場合はUTF-8として扱う
+    return chardet.detect(sample)['encoding'] or 'utf-8'
+
+
+def iter_import_chunks(filepath, chunksize):
+    """
+    CSV/Excelファイルを chunksize 行ずつのDataFrameとして順に返すジェネレータ
+
+    CSVは pandas のチャンク読み込み、Excelは openpyxl の read-only モードの行イテレータを使うため、
+    ファイルの大きさに関係なくメモリに載るのは1チャンク分だけになる。
+
+    セルはすべて文字列で返し、空欄は '' にする。列の型をチャンクごとに推測させると、
+    空欄を含むチャンクだけ品番が "103.0" になったり、先頭の0が落ちたり("0101" → "101")するため。
+    """
+    if filepath.endswith(('.xlsx', '.xlsm')):
+        yield from _iter_excel_chunks(filepath, chunksize)
+    else:
+        encoding = detect_encoding(filepath)
+        with pd.read_csv(filepath, encoding=encoding, on_bad_lines='warn', chunksize=chunksize,
+                         dtype=str, keep_default_na=False) as reader:
+            yield from reader
+
+
+def _cell_text(value):
+    """Excelのセルの値を、CSVと同じ文字列に変換する"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _iter_excel_chunks(filepath, chunksize):
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(c).strip() if c is not None else f'Unnamed: {i}' for i, c in enumerate(header)]
+
+        buffer = []
+        for row in rows:
+            # 書式だけが残った空行は読み飛ばす
+            if all(v is None for v in row):
+                continue
+            buffer.append([_cell_text(v) for v in row])
+            if len(buffer) >= chunksize:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+    finally:
+        workbook.close()
+
+
+def _invalid_rows(df, first_line, checks):
+    """
+    必須のセルが空欄・不正な行を見つけ、(不正な行のマスク, エラーメッセージのリスト) を返す
+
+    checks は (列名, 不正な行のマスク) のリスト。first_line はチャンクの先頭行のファイル上の行番号。
+    """
+    invalid = pd.Series(False, index=df.index)
+    messages = []
+    for column, mask in checks:
+        for position in (mask & ~invalid).to_numpy().nonzero()[0]:
+            messages.append(f'{first_line + position}行目: 「{column}」が空欄または不正なため読み飛ばしました')
+        invalid |= mask
+    return invalid, messages
+
+
+class InventoryImporter:
+    """
+    在庫データをチャンク単位で一括反映するクラス
+
+    店舗・商品・在庫の既存キーを最初に1回だけ読み込んで対応表を作り、
+    新規作成と更新の振り分けはpandasの列演算で行う。
+    書き込みはバルクINSERT/UPDATEで行い、コミットは呼び出し側に任せる。
+    対応表はチャンクをまたいで使い回すので、チャンクごとの再読み込みは発生しない。
+    在庫数の変更と新規作成は、画面からの更新と同じく InventoryLog に記録する(過去の時点の在庫の再現に使う)。
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.created = 0
+        self.updated = 0
+        self.skipped = []
+        # 必須のセルが空欄・不正で読み飛ばした行のメッセージ
+        self.invalid = []
+        # これまでに読んだ行数(エラーメッセージの行番号に使う)
+        self.rows_read = 0
+        # 店舗・商品の対応表はキャッシュからコピーして、このインポートで作成した分を書き足していく
+        self.store_ids = dict(reference_cache.store_ids())
+        self.product_ids = dict(reference_cache.product_ids())
+        self.inventory_ids = {
+            (product_id, store_id): inventory_id
+            for inventory_id, product_id, store_id in db.session.execute(
+                db.select(Inventory.id, Inventory.product_id, Inventory.store_id)
+            ).all()
+        }
+
+    def import_chunk(self, df):
+        if not all(col in df.columns for col in INVENTORY_REQUIRED_COLUMNS):
+            raise ImportValidationError('CSVのヘッダーに「品番」「店舗名」「在庫数」が含まれている必要があります')
+
+        columns = INVENTORY_REQUIRED_COLUMNS + (['商品名'] if '商品名' in df.columns else [])
+        df = df[columns].copy()
+        df['品番'] = df['品番'].str.strip()
+        df['店舗名'] = df['店舗名'].str.strip()
+        quantity = pd.to_numeric(df['在庫数'].str.strip(), errors='coerce')
+        if '商品名' not in df.columns:
+            df['商品名'] = None
+
+        # 必須のセルが空欄・不正な行は、何も書き込む前に取り除いてエラーとして報告する
+        # (ヘッダーが1行目なので、データの先頭行は2行目)
+        invalid, messages = _invalid_rows(df, self.rows_read + 2, [
+            ('品番', df['品番'] == ''),
+            ('店舗名', df['店舗名'] == ''),
+            ('在庫数', quantity.isna() | (quantity % 1 != 0)),
+        ])
+        self.rows_read += len(df)
+        self.invalid.extend(messages)
+        df = df[~invalid].copy()
+        df['在庫数'] = quantity[~invalid].astype(int)
+
+        # 同じ品番・店舗の行が複数ある場合は、ファイルの後ろの行を優先する
+        df = df.drop_duplicates(subset=['品番', '店舗名'], keep='last')
+
+        # --- 1. 店舗: 未登録の店舗名だけをまとめて作成 ---
+        new_store_names = [name for name in df['店舗名'].unique() if name not in self.store_ids]
+        if new_store_names:
+            db.session.execute(db.insert(Store), [{'name': name} for name in new_store_names])
+            bump_reference_generation()
+            self.store_ids.update(db.session.execute(
+                db.select(Store.name, Store.id).where(Store.name.in_(new_store_names))
+            ).all())
+
+        # --- 2. 商品: 未登録の品番は商品名があるものだけをまとめて作成 ---
+        is_new_product = ~df['品番'].isin(self.product_ids.keys())
+        has_name = df['商品名'].notna() & (df['商品名'].astype(str).str.strip() != '')
+
+        skipped = df.loc[is_new_product & ~has_name, '品番'].unique().tolist()
+        new_products = (
+            df.loc[is_new_product & has_name, ['品番', '商品名']]
+            .drop_duplicates(subset='品番', keep='first')
+        )
+        if not new_products.empty:
+            db.session.execute(db.insert(Product), [
+                {'item_number': item_number, 'name': str(name).strip()}
+                for item_number, name in new_products.itertuples(index=False)
+            ])
+            bump_reference_generation()
+            self.product_ids.update(db.session.execute(
+                db.select(Product.item_number, Product.id).where(Product.item_number.in_(new_products['品番'].tolist()))
+            ).all())
+
+        df = df[~df['品番'].isin(skipped)].copy()
+        df['product_id'] = df['品番'].map(self.product_ids).astype(int)
+        df['store_id'] = df['店舗名'].map(self.store_ids).astype(int)
+
+        # --- 3. 在庫: 既存在庫との対応を求め、新規と更新に振り分ける ---
+        df['inventory_id'] = [
+            self.inventory_ids.get(key) for key in zip(df['product_id'], df['store_id'])
+        ]
+        to_update = df[df['inventory_id'].notna()]
+        to_create = df[df['inventory_id'].isna()]
+
+        transitions = []
+        if not to_update.empty:
+            # アラート状態の変化を判定するため、更新前の在庫数と閾値をまとめて読んでおく
+            update_ids = [int(inventory_id) for inventory_id in to_update['inventory_id']]
+            current = {
+                inventory_id: (quantity, threshold)
+                for inventory_id, quantity, threshold in db.session.execute(
+                    db.select(Inventory.id, Inventory.quantity, Inventory.threshold).where(Inventory.id.in_(update_ids))
+                )
+            }
+            transitions.extend(
+                (inventory_id, *current[inventory_id], int(quantity), current[inventory_id][1])
+                for inventory_id, quantity in zip(update_ids, to_update['在庫数'])
+            )
+
+            # 画面からの更新と競合を検出できるよう、バージョン番号もSQL側で1つ進める
+            table = Inventory.__table__
+            db.session.execute(
+                db.update(table)
+                .where(table.c.id == db.bindparam('b_id'))
+                .values(quantity=db.bindparam('b_quantity'), version=table.c.version + 1),
+                [
+                    {'b_id': int(inventory_id), 'b_quantity': int(quantity)}
+                    for inventory_id, quantity in zip(to_update['inventory_id'], to_update['在庫数'])
+                ]
+            )
+        if not to_create.empty:
+            db.session.execute(db.insert(Inventory), [
+                {'product_id': int(product_id), 'store_id': int(store_id), 'quantity': int(quantity)}
+                for product_id, store_id, quantity in zip(to_create['product_id'], to_create['store_id'], to_create['在庫数'])
+            ])
+            # 後続のチャンクで同じ在庫が出てきた場合に備えて対応表に追加する
+            created_keys = db.select(Inventory.id, Inventory.product_id, Inventory.store_id).where(
+                Inventory.product_id.in_(to_create['product_id'].unique().tolist())
+            )
+            for inventory_id, product_id, store_id in db.session.execute(created_keys).all():
+                self.inventory_ids[(product_id, store_id)] = inventory_id
+
+            default_threshold = Inventory.__table__.c.threshold.default.arg
+            transitions.extend(
+                (self.inventory_ids[(product_id, store_id)], None, None, int(quantity), default_threshold)
+                for product_id, store_id, quantity in zip(to_create['product_id'], to_create['store_id'], to_create['在庫数'])
+            )
+
+        # バルクUPDATE/INSERTは ORM のフックを通らないので、変更ログとアラート状態の変化はここで記録する
+        # (新規作成は画面からの作成と同じく「0から」のログ、更新は在庫数が変わったものだけ)
+        logs = [
+            {
+                'inventory_id': inventory_id,
+                'user_id': self.user_id,
+                'quantity_before': quantity_before or 0,
+                'quantity_after': quantity_after,
+                'threshold_before': 0 if quantity_before is None else threshold_before,
+                'threshold_after': threshold_after
+            }
+            for inventory_id, quantity_before, threshold_before, quantity_after, threshold_after in transitions
+            if quantity_before != quantity_after
+        ]
+        if logs:
+            db.session.execute(db.insert(InventoryLog), logs)
+        record_stock_transitions(transitions)
+        if not to_update.empty or not to_create.empty:
+            # 1件ずつ配信するには多いので、コミット後に画面へ在庫の読み直しを指示する
+            request_inventory_resync()
+
+        self.created += len(to_create)
+        self.updated += len(to_update)
+        self.skipped.extend(skipped)
+
+
+def import_inventory_dataframe(df, user_id):
+    """
+    在庫データのDataFrameを一括でデータベースに反映する関数
+
+    df のセルは iter_import_chunks() が返すものと同じく、すべて文字列('' は空欄)であること。
+    在庫の変更ログは user_id のユーザーで記録する。
+
+    戻り値は {'created': 新規在庫数, 'updated': 更新在庫数, 'skipped': 商品名がなく登録できなかった品番のリスト,
+              'invalid': 必須のセルが空欄・不正で読み飛ばした行のメッセージのリスト}
+    """
+    importer = InventoryImporter(user_id)
+    importer.import_chunk(df)
+    return {'created': importer.created, 'updated': importer.updated, 'skipped': importer.skipped, 'invalid': importer.invalid}
+
+
+def import_inventory_file(filepath, chunksize, user_id, on_progress=None):
+    """
+    在庫データのファイルをチャンク単位で読み込み、チャンクごとにコミットする関数
+
+    ファイル全体をメモリに載せないため、ファイルの大きさに関係なく使用メモリはほぼ一定になる。
+    on_progress が指定された場合は、各チャンクのコミット直前に
+    on_progress(処理済み行数, 新規数, 更新数) を呼び出す。
+    在庫の変更ログは user_id のユーザーで記録する。
+    """
+    importer = InventoryImporter(user_id)
+    processed_rows = 0
+    for chunk in iter_import_chunks(filepath, chunksize):
+        importer.import_chunk(chunk)
+        processed_rows += len(chunk)
+        if on_progress:
+            on_progress(processed_rows, importer.created, importer.updated)
+        db.session.commit()
+    return {'created': importer.created, 'updated': importer.updated, 'skipped': importer.skipped, 'invalid': importer.invalid}
+
+
+# 商品マスタの列と、変更ログ(ProductLog)に記録する項目名の対応
+PRODUCT_FIELDS = {
+    'name': '商品名',
+    'price': '販売価格',
+    'cost': '原価',
+}
+
+
+def _to_price_str(series):
+    """価格の列を、Productに保存する文字列(整数表記)またはNoneに変換する。数値でないセルもNoneになる"""
+    numbers = pd.to_numeric(series.str.strip(), errors='coerce')
+    return numbers.map(lambda v: str(int(v)) if pd.notna(v) else None).astype(object)
+
+
+def _invalid_price(df, column):
+    """価格の列のうち、空欄ではないのに数値として読めないセルのマスク(列がない場合はすべて False)"""
+    if column not in df.columns:
+        return pd.Series(False, index=df.index)
+    values = df[column].str.strip()
+    return (values != '') & pd.to_numeric(values, errors='coerce').isna()
+
+
+class ProductImporter:
+    """
+    商品マスタをチャンク単位で差分反映するクラス
+
+    チャンク内の品番に対応する現在の商品を1回のクエリで読み込み、
+    pandasの列演算で新規・変更・変更なしに振り分ける。
+    実際に値が変わった商品だけをバルクUPDATEし、変わった項目ごとの ProductLog もまとめてINSERTする。
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.invalid = []
+        self.rows_read = 0
+
+    def import_chunk(self, df):
+        # 必須列のチェック
+        if not all(col in df.columns for col in PRODUCT_REQUIRED_COLUMNS):
+            raise ImportValidationError(f'CSV/Excelファイルには「{", ".join(PRODUCT_REQUIRED_COLUMNS)}」の列が必要です。')
+
+        # 品番・商品名が空欄の行と、価格が数値でない行は、何も書き込む前に取り除いてエラーとして報告する
+        invalid, messages = _invalid_rows(df, self.rows_read + 2, [
+            ('品番', df['品番'].str.strip() == ''),
+            ('商品名', df['商品名'].str.strip() == ''),
+            ('販売価格', _invalid_price(df, '販売価格')),
+            ('原価', _invalid_price(df, '原価')),
+        ])
+        self.rows_read += len(df)
+        self.invalid.extend(messages)
+        df = df[~invalid]
+
+        incoming = pd.DataFrame({
+            'item_number': df['品番'].str.strip(), # 品番は文字列として扱い、前後空白を除去
+            'name': df['商品名'].str.strip(),
+            # 任意の列がファイルにない場合は、これまで通り空欄(None)で上書きする
+            'price': _to_price_str(df['販売価格']) if '販売価格' in df.columns else None,
+            'cost': _to_price_str(df['原価']) if '原価' in df.columns else None,
+        })
+        # 同じ品番の行が複数ある場合は、ファイルの後ろの行を優先する
+        incoming = incoming.drop_duplicates(subset='item_number', keep='last')
+
+        current = pd.DataFrame(
+            db.session.execute(
+                db.select(Product.id, Product.item_number, Product.name, Product.price, Product.cost)
+                .where(Product.item_number.in_(incoming['item_number'].tolist()))
+            ).all(),
+            columns=['id', 'item_number', 'name', 'price', 'cost']
+        ).astype(object)
+        merged = incoming.merge(current, on='item_number', how='left', suffixes=('', '_before')).astype(object)
+        # 欠損値はNoneに揃えて、DBの値と同じ形で比較・保存する
+        merged = merged.where(merged.notna(), None)
+
+        # --- 1. 新規の品番はまとめて作成 ---
+        is_new = merged['id'].isna()
+        new_rows = merged[is_new]
+        if not new_rows.empty:
+            db.session.execute(db.insert(Product), [
+                {'item_number': r.item_number, 'name': r.name, 'price': r.price, 'cost': r.cost}
+                for r in new_rows.itertuples(index=False)
+            ])
+            bump_reference_generation()
+
+        # --- 2. 既存の品番は、値が変わった項目だけを検出する ---
+        existing = merged[~is_new]
+        changed_masks = {}
+        for field in PRODUCT_FIELDS:
+            after = existing[field]
+            before = existing[f'{field}_before']
+            changed_masks[field] = (after != before) & ~(after.isna() & before.isna())
+        changed_any = pd.concat(changed_masks.values(), axis=1).any(axis=1)
+        changed_rows = existing[changed_any]
+
+        if not changed_rows.empty:
+            db.session.execute(db.update(Product), [
+                {'id': int(r.id), 'name': r.name, 'price': r.price, 'cost': r.cost}
+                for r in changed_rows.itertuples(index=False)
+            ])
+            bump_reference_generation()
+
+            # 変更があった項目ごとに ProductLog を作成(edit_product_master と同じ形式)
+            logs = []
+            for field, label in PRODUCT_FIELDS.items():
+                rows = existing[changed_masks[field]]
+                logs.extend(
+                    {
+                        'product_id': int(product_id),
+                        'user_id': self.user_id,
+                        'field_changed': label,
+                        'value_before': str(before),
+                        'value_after': str(after),
+                    }
+                    for product_id, before, after in zip(rows['id'], rows[f'{field}_before'], rows[field])
+                )
+            db.session.execute(db.insert(ProductLog), logs)
+
+        self.created += len(new_rows)
+        self.updated += len(changed_rows)
+        self.unchanged += len(existing) - len(changed_rows)
+
+
+def import_products_file(filepath, chunksize, user_id, on_progress=None):
+    """
+    商品マスタのファイルをチャンク単位で読み込み、チャンクごとにコミットする関数
+
+    on_progress の扱いは import_inventory_file と同じ。
+    戻り値は {'created': 新規登録数, 'updated': 変更があった商品数, 'unchanged': 変更がなかった商品数,
+              'invalid': 品番・商品名が空欄、または価格が数値でないため読み飛ばした行のメッセージのリスト}
+    """
+    importer = ProductImporter(user_id)
+    processed_rows = 0
+    for chunk in iter_import_chunks(filepath, chunksize):
+        importer.import_chunk(chunk)
+        processed_rows += len(chunk)
+        if on_progress:
+            on_progress(processed_rows, importer.created, importer.updated)
+        db.session.commit()
+    return {'created': importer.created, 'updated': importer.updated, 'unchanged': importer.unchanged, 'invalid': importer.invalid}
@@ -0,0 +1,250 @@
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from . import db
+from .models import Product, Store, Inventory, InventoryLog
+from .alerts import record_stock_transitions
+from .events import record_inventory_changes
+
+# 他のユーザーが先に同じ在庫を更新していた場合のメッセージ
+CONFLICT_MESSAGE = '他のユーザーが先にこの在庫を更新しました。最新の値を確認してから再度操作してください'
+
+# 1回のバッチ更新で受け付ける最大件数
+MAX_BATCH_ITEMS = 500
+
+
+def _error(index, code, message):
+    return {'index': index, 'status': 'error', 'code': code, 'message': message}
+
+
+def _to_int(value, default=None):
+    if value is None or value == '':
+        return default
+    return int(value)
+
+
+def apply_inventory_batch(items, user):
+    """
+    複数の在庫セルの更新を1トランザクションでまとめて反映する関数
+
+    items の各要素は {'inventory_id': ...} または {'product_id': ..., 'store_id': ...} で対象を指定し、
+    'quantity' と 'threshold' に新しい値を持つ(省略時は現在の値、新規作成時は 0 / 10)。
+    'version' を指定した場合は、その値から在庫が変わっていれば競合として扱う。
+    権限チェックは /api/update_inventory と同じで、店長は所属店舗の在庫だけを更新できる。
+
+    1件でもエラーがあれば何も書き込まずに (False, 結果リスト) を返す。
+    全件問題なければ在庫とログを書き込んでコミットし、(True, 結果リスト) を返す。
+    """
+    if user.role not in ['admin', 'manager']:
+        return False, [_error(i, 403, 'この操作を行う権限がありません') for i in range(len(items))]
+
+    # --- 1. 入力を解釈し、対象の在庫をまとめて読み込む ---
+    parsed = []
+    results = []
+    for index, item in enumerate(items):
+        try:
+            inventory_id = item.get('inventory_id')
+            entry = {
+                'index': index,
+                'inventory_id': _to_int(inventory_id) if inventory_id not in (None, 'new') else None,
+                'product_id': _to_int(item.get('product_id')),
+                'store_id': _to_int(item.get('store_id')),
+                'quantity': _to_int(item.get('quantity')),
+                'threshold': _to_int(item.get('threshold')),
+                'version': _to_int(item.get('version')),
+            }
+        except (TypeError, ValueError, AttributeError):
+            results.append(_error(index, 400, '数値の形式が正しくありません'))
+            continue
+        if entry['inventory_id'] is None and not (entry['product_id'] and entry['store_id']):
+            results.append(_error(index, 400, '在庫ID、または商品と店舗のIDが必要です'))
+            continue
+        if (entry['quantity'] is not None and entry['quantity'] < 0) or (entry['threshold'] is not None and entry['threshold'] < 0):
+            results.append(_error(index, 400, '在庫数と閾値は0以上で指定してください'))
+            continue
+        parsed.append(entry)
+
+    ids = [e['inventory_id'] for e in parsed if e['inventory_id'] is not None]
+    pairs = [(e['product_id'], e['store_id']) for e in parsed if e['inventory_id'] is None]
+
+    by_id = {}
+    if ids:
+        by_id = {inv.id: inv for inv in Inventory.query.filter(Inventory.id.in_(ids))}
+    by_pair = {}
+    if pairs:
+        product_ids = {pid for pid, sid in pairs}
+        store_ids = {sid for pid, sid in pairs}
+        # 行値の IN はインデックス全体の走査になるため、商品と店舗のIDで別々に絞り込む
+        by_pair = {
+            (inv.product_id, inv.store_id): inv
+            for inv in Inventory.query.filter(Inventory.product_id.in_(product_ids), Inventory.store_id.in_(store_ids))
+        }
+        known_products = set(db.session.scalars(db.select(Product.id).where(Product.id.in_(product_ids))))
+        known_stores = set(db.session.scalars(db.select(Store.id).where(Store.id.in_(store_ids))))
+
+    # --- 2. 全件を検証し、適用内容を決める ---
+    plans = []
+    seen = set()
+    for entry in parsed:
+        index = entry['index']
+        if entry['inventory_id'] is not None:
+            inventory = by_id.get(entry['inventory_id'])
+            if inventory is None:
+                results.append(_error(index, 404, '在庫が見つかりません'))
+                continue
+            key = (inventory.product_id, inventory.store_id)
+            store_id = inventory.store_id
+        else:
+            key = (entry['product_id'], entry['store_id'])
+            inventory = by_pair.get(key)
+            store_id = entry['store_id']
+            if inventory is None and (key[0] not in known_products or key[1] not in known_stores):
+                results.append(_error(index, 404, '商品または店舗が見つかりません'))
+                continue
+
+        if user.role == 'manager' and user.store_id != store_id:
+            results.append(_error(index, 403, '所属ストア以外の在庫は編集できません'))
+            continue
+        if entry['version'] is not None and (inventory is None or inventory.version != entry['version']):
+            # 画面で読み込んだ時点から在庫が変わっている
+            results.append(_error(index, 409, CONFLICT_MESSAGE))
+            continue
+        if key in seen:
+            results.append(_error(index, 409, '同じ在庫が複数回指定されています'))
+            continue
+        seen.add(key)
+        plans.append((entry, key, inventory))
+
+    if any(r['status'] == 'error' for r in results):
+        results.sort(key=lambda r: r['index'])
+        return False, results
+
+    # --- 3. 在庫とログを書き込み、1回だけコミットする ---
+    applied = []
+    for entry, key, inventory in plans:
+        if inventory is None:
+            inventory = Inventory(
+                product_id=key[0],
+                store_id=key[1],
+                quantity=entry['quantity'] if entry['quantity'] is not None else 0,
+                threshold=entry['threshold'] if entry['threshold'] is not None else 10
+            )
+            db.session.add(inventory)
+            # ログは新規作成なので「0から」として記録
+            db.session.add(InventoryLog(inventory=inventory, user=user, quantity_before=0, quantity_after=inventory.quantity,
+                                        threshold_before=0, threshold_after=inventory.threshold))
+            applied.append((entry['index'], 'created', inventory))
+            continue
+
+        new_quantity = entry['quantity'] if entry['quantity'] is not None else inventory.quantity
+        new_threshold = entry['threshold'] if entry['threshold'] is not None else inventory.threshold
+        if inventory.quantity == new_quantity and inventory.threshold == new_threshold:
+            applied.append((entry['index'], 'unchanged', inventory))
+            continue
+
+        db.session.add(InventoryLog(inventory=inventory, user=user, quantity_before=inventory.quantity, quantity_after=new_quantity,
+                                    threshold_before=inventory.threshold, threshold_after=new_threshold))
+        inventory.quantity = new_quantity
+        inventory.threshold = new_threshold
+        applied.append((entry['index'], 'updated', inventory))
+
+    try:
+        db.session.commit()
+    except (StaleDataError, IntegrityError):
+        # 検証後、コミットまでの間に他のリクエストが同じ在庫を更新した、または同じ商品×店舗の在庫を先に作成した
+        db.session.rollback()
+        current = {
+            (inv.product_id, inv.store_id): inv
+            for inv in Inventory.query.filter(
+                Inventory.product_id.in_({key[0] for entry, key, inventory in plans}),
+                Inventory.store_id.in_({key[1] for entry, key, inventory in plans})
+            )
+        }
+        results = []
+        for entry, key, inventory in plans:
+            error = _error(entry['index'], 409, CONFLICT_MESSAGE)
+            latest = current.get(key)
+            if latest is not None:
+                # 画面のセルを最新の値に直せるよう、現在の値を返す(/api/update_inventory の競合時と同じ)
+                error.update(inventory_id=latest.id, quantity=latest.quantity,
+                             threshold=latest.threshold, version=latest.version)
+            results.append(error)
+        return False, results
+
+    results = [
+        {
+            'index': index,
+            'status': status,
+            'inventory_id': inventory.id,
+            'product_id': inventory.product_id,
+            'store_id': inventory.store_id,
+            'quantity': inventory.quantity,
+            'threshold': inventory.threshold,
+            'version': inventory.version
+        }
+        for index, status, inventory in applied
+    ]
+    return True, results
+
+
+def adjust_inventory_quantity(inventory_id, delta, user, expected_version=None):
+    """
+    在庫数を差分(入荷 +5、販売 -2 など)で更新する関数
+
+    UPDATE inventory SET quantity = quantity + :delta ... RETURNING の1文で更新と結果の取得を行うため、
+    読み込んでから書き戻す間に他の更新が割り込むことはなく、ログの変更前の値も正確になる。
+    在庫数がマイナスになる更新、権限のない店舗の在庫、expected_version が一致しない更新は行わない。
+
+    成功時は (True, 結果), 失敗時は (False, {'code': ..., 'message': ...}) を返す。
+    """
+    if user.role not in ['admin', 'manager']:
+        return False, {'code': 403, 'message': 'この操作を行う権限がありません'}
+
+    table = Inventory.__table__
+    conditions = [table.c.id == inventory_id, table.c.quantity + delta >= 0]
+    if user.role == 'manager':
+        conditions.append(table.c.store_id == user.store_id)
+    if expected_version is not None:
+        conditions.append(table.c.version == expected_version)
+
+    row = db.session.execute(
+        db.update(table)
+        .where(*conditions)
+        .values(quantity=table.c.quantity + delta, version=table.c.version + 1)
+        .returning(table.c.quantity, table.c.threshold, table.c.version, table.c.store_id, table.c.product_id)
+    ).first()
+
+    if row is None:
+        # 更新されなかった理由を調べて返す
+        db.session.rollback()
+        current = db.session.execute(
+            db.select(table.c.store_id, table.c.quantity, table.c.version).where(table.c.id == inventory_id)
+        ).first()
+        if current is None:
+            return False, {'code': 404, 'message': '在庫が見つかりません'}
+        if user.role == 'manager' and current.store_id != user.store_id:
+            return False, {'code': 403, 'message': '所属ストア以外の在庫は編集できません'}
+        if expected_version is not None and current.version != expected_version:
+            return False, {'code': 409, 'message': CONFLICT_MESSAGE}
+        return False, {'code': 409, 'message': f'在庫数がマイナスになるため更新できません(現在の在庫数: {current.quantity})'}
+
+    quantity, threshold, version, store_id, product_id = row
+    db.session.execute(db.insert(InventoryLog).values(
+        inventory_id=inventory_id,
+        user_id=user.id,
+        quantity_before=quantity - delta,
+        quantity_after=quantity,
+        threshold_before=threshold,
+        threshold_after=threshold
+    ))
+    # Core の UPDATE は ORM のフックを通らないので、アラート状態の変化と画面への変更の配信はここで記録する
+    record_stock_transitions([(inventory_id, quantity - delta, threshold, quantity, threshold)])
+    record_inventory_changes([(inventory_id, product_id, store_id, quantity, threshold, version)])
+    db.session.commit()
+
+    return True, {
+        'inventory_id': inventory_id,
+        'store_id': store_id,
+        'quantity': quantity,
+        'threshold': threshold,
+        'version': version
+    }
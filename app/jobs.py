@@ -0,0 +1,199 @@
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from . import db
+from .models import ImportJob, get_jst_now
+from .importer import import_inventory_file, import_products_file, ImportValidationError
+
+# ジョブの種類ごとのインポート処理
+IMPORT_FUNCTIONS = {
+    'inventory': import_inventory_file,
+    'products': import_products_file,
+}
+
+
+class ImportJobRunner:
+    """
+    CSV/Excelインポートをバックグラウンドのスレッドプールで実行するクラス
+
+    ジョブの状態・件数・エラーは ImportJob テーブルに記録するので、
+    リクエストがタイムアウトしても /admin/import_jobs/<id> で結果を確認できる。
+
+    ジョブはこのプロセスのスレッドプールでしか実行されないので、プロセスが終了すると(gunicorn のワーカーの
+    入れ替え・デプロイなど)待機中・実行中のまま残る。そのため、ジョブには登録したプロセス(owner)を記録し、
+    プロセスが生きている間は待機中のものも含めて IMPORT_JOB_STALE_SECONDS の1/3ごとに heartbeat_at を更新する
+    (scheduler のリースと同じ考え方)。fail_stale_jobs() は heartbeat_at が IMPORT_JOB_STALE_SECONDS 秒以上
+    更新されていないジョブだけを失敗にして、アップロードされたファイルを削除する。
+    ジョブの開始は state が 'queued' のときだけ成功する条件付きの UPDATE で行うので、失敗にされたジョブは実行されない。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        # このプロセスのスレッドプールに渡した、終了していないジョブのID
+        self._active = set()
+        self._lock = threading.Lock()
+        # gunicorn の preload ではアプリを作ってから fork するので、owner とハートビートは最初のジョブの登録時に決める
+        self.owner = None
+        self._heartbeat = None
+        self._heartbeat_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config.get('IMPORT_WORKERS', 2),
+            thread_name_prefix='import-job'
+        )
+        app.extensions['import_jobs'] = self
+
+    def _upload_path(self, filename):
+        # アップロードされたファイルの保存先(routes._save_upload と同じ instance/uploads)
+        return os.path.join(self.app.instance_path, 'uploads', filename)
+
+    def submit(self, kind, filepath, user):
+        """ジョブを登録してワーカーに渡し、登録した ImportJob を返す"""
+        if kind not in IMPORT_FUNCTIONS:
+            raise ValueError(f'未対応のインポート種別です: {kind}')
+
+        self._start_heartbeat()
+        self.fail_stale_jobs()
+        job = ImportJob(
+            kind=kind, filename=os.path.basename(filepath), user_id=user.id,
+            owner=self.owner, heartbeat_at=get_jst_now()
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        with self._lock:
+            self._active.add(job.id)
+        self.executor.submit(self._run, job.id, filepath)
+        return job
+
+    def _start_heartbeat(self):
+        with self._lock:
+            # fork された子プロセスにはスレッドが引き継がれないので、プロセスごとに作り直す
+            if self._heartbeat is not None and self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+            self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+            self._heartbeat = threading.Thread(target=self._beat, name='import-job-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self):
+        """このプロセスの終了していないジョブの heartbeat_at を定期的に更新する"""
+        interval = self.app.config['IMPORT_JOB_STALE_SECONDS'] / 3
+        stop = threading.Event()
+        while not stop.wait(interval):
+            with self._lock:
+                active = set(self._active)
+            if not active:
+                continue
+            with self.app.app_context():
+                try:
+                    db.session.execute(
+                        db.update(ImportJob)
+                        .where(ImportJob.id.in_(active), ImportJob.state.in_(['queued', 'running']))
+                        .values(heartbeat_at=get_jst_now())
+                    )
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('failed to update import job heartbeat')
+                finally:
+                    db.session.remove()
+
+    def fail_stale_jobs(self):
+        """実行していたプロセスが終了して止まったままのジョブを失敗にし、アップロードされたファイルを削除する"""
+        cutoff = get_jst_now().replace(tzinfo=None) - timedelta(seconds=self.app.config['IMPORT_JOB_STALE_SECONDS'])
+        with self._lock:
+            active = set(self._active)
+        # heartbeat_at のない(この仕組みより前に登録された)ジョブは、最後に進捗を書き込んだ日時で判定する
+        last_seen = db.func.coalesce(ImportJob.heartbeat_at, ImportJob.updated_at, ImportJob.created_at)
+        is_stale = (ImportJob.state.in_(['queued', 'running']), last_seen < cutoff, ImportJob.id.not_in(active))
+        stale = db.session.execute(db.select(ImportJob.id, ImportJob.filename, ImportJob.errors).where(*is_stale)).all()
+
+        failed = []
+        for job_id, filename, errors in stale:
+            # 選んだ後にハートビートや開始が間に合ったジョブは失敗にしない
+            result = db.session.execute(
+                db.update(ImportJob).where(ImportJob.id == job_id, *is_stale).values(
+                    state='failed',
+                    errors='\n'.join(filter(None, [
+                        errors, 'インポートを実行していたプロセスが終了したため、ジョブを中断しました。もう一度アップロードしてください'
+                    ])),
+                    finished_at=get_jst_now(),
+                    updated_at=get_jst_now()
+                )
+            )
+            if result.rowcount:
+                failed.append(filename)
+        db.session.commit()
+
+        for filename in failed:
+            filepath = self._upload_path(filename)
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        return len(failed)
+
+    def _run(self, job_id, filepath):
+        with self.app.app_context():
+            # 待機中のまま失敗にされたジョブは実行しない(ファイルは失敗にした側で削除済み)
+            now = get_jst_now()
+            claimed = db.session.execute(
+                db.update(ImportJob).where(ImportJob.id == job_id, ImportJob.state == 'queued')
+                .values(state='running', started_at=now, heartbeat_at=now, updated_at=now)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                db.session.remove()
+                with self._lock:
+                    self._active.discard(job_id)
+                self.app.logger.warning('import job %s was not queued any more; skipped', job_id)
+                return
+            job = db.session.get(ImportJob, job_id)
+
+            def on_progress(processed_rows, created_count, updated_count):
+                # チャンクのコミットと同じトランザクションで進捗を記録する
+                job.processed_rows = processed_rows
+                job.created_count = created_count
+                job.updated_count = updated_count
+
+            try:
+                # 変更ログはジョブを登録したユーザーで記録する
+                result = IMPORT_FUNCTIONS[job.kind](
+                    filepath, self.app.config['IMPORT_CHUNK_SIZE'], job.user_id, on_progress=on_progress
+                )
+                job.state = 'succeeded'
+                job.created_count = result['created']
+                job.updated_count = result['updated']
+                errors = result.get('invalid', []) + [
+                    f'新しい品番 {item_number}には「商品名」が必要です' for item_number in result.get('skipped', [])
+                ]
+                if errors:
+                    job.errors = '\n'.join(errors)
+            except Exception as e:
+                db.session.rollback()
+                job = db.session.get(ImportJob, job_id)
+                job.state = 'failed'
+                if isinstance(e, ImportValidationError):
+                    job.errors = str(e)
+                else:
+                    job.errors = f'インポート中にエラーが発生しました : {e}'
+                    self.app.logger.exception('import job %s failed', job_id)
+            finally:
+                job.finished_at = get_jst_now()
+                db.session.commit()
+                db.session.remove()
+                with self._lock:
+                    self._active.discard(job_id)
+                # アップロードされたファイルを削除
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+
+
+import_jobs = ImportJobRunner()
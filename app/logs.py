@@ -0,0 +1,158 @@
+import csv
+import heapq
+import io
+from datetime import datetime
+from itertools import islice
+from openpyxl import Workbook
+from . import db
+from .models import User, Store, Product, Inventory, InventoryLog
+from .archive import iter_archived_log_rows
+
+# 操作ログ画面の1ページあたりの件数
+LOGS_PER_PAGE = 20
+
+
+def log_rows_query(store_id=None):
+    """
+    操作ログと、表示に必要なユーザー名・店舗名・商品名をまとめて取得するSELECT文を返す
+
+    店舗の絞り込みは在庫テーブルとの結合で行うので、在庫IDのリストを作る必要はない。
+    """
+    query = (
+        db.select(
+            InventoryLog.id, InventoryLog.timestamp,
+            InventoryLog.quantity_before, InventoryLog.quantity_after,
+            InventoryLog.threshold_before, InventoryLog.threshold_after,
+            InventoryLog.inventory_id,
+            User.username, Store.name.label('store_name'), Product.name.label('product_name'),
+            Product.item_number
+        )
+        .join(Inventory, Inventory.id == InventoryLog.inventory_id)
+        .join(Store, Store.id == Inventory.store_id)
+        .join(Product, Product.id == Inventory.product_id)
+        .join(User, User.id == InventoryLog.user_id)
+    )
+    if store_id is not None:
+        query = query.where(Inventory.store_id == store_id)
+    return query
+
+
+def parse_log_cursor(timestamp, log_id):
+    """クエリパラメータの (日時, ログID) をカーソルに変換する。不正な場合は None"""
+    if not timestamp or log_id is None:
+        return None
+    try:
+        return (datetime.fromisoformat(timestamp), log_id)
+    except ValueError:
+        return None
+
+
+def _log_key(row):
+    return (row.timestamp, row.id)
+
+
+def fetch_log_page(store_id=None, before=None, after=None, per_page=LOGS_PER_PAGE, include_archive=False):
+    """
+    操作ログを (日時, ID) のシーク方式で1ページ分取得する関数
+
+    OFFSET と COUNT(*) を使わないため、何ページ目でも1ページ目と同じ速さで表示できる。
+    before を指定するとそれより古いログを、after を指定するとそれより新しいログを返す。
+    include_archive=True の場合は、アーカイブ済みのログも同じ並び順で合わせて返す。
+
+    戻り値は (新しい順のログ行のリスト, より古いログがあるか, より新しいログがあるか)
+    """
+    query = log_rows_query(store_id)
+
+    if after is not None:
+        # 新しい方向へ戻る場合は古い順に読み、最後に並べ替える
+        ts, log_id = after
+        query = query.where(
+            (InventoryLog.timestamp > ts) | ((InventoryLog.timestamp == ts) & (InventoryLog.id > log_id))
+        ).order_by(InventoryLog.timestamp.asc(), InventoryLog.id.asc())
+    else:
+        if before is not None:
+            ts, log_id = before
+            query = query.where(
+                (InventoryLog.timestamp < ts) | ((InventoryLog.timestamp == ts) & (InventoryLog.id < log_id))
+            )
+        query = query.order_by(InventoryLog.timestamp.desc(), InventoryLog.id.desc())
+
+    rows = db.session.execute(query.limit(per_page + 1)).all()
+    if include_archive:
+        archived = iter_archived_log_rows(store_id=store_id, before=before, after=after, reverse=after is None)
+        merged = heapq.merge(rows, islice(archived, per_page + 1), key=_log_key, reverse=after is None)
+        rows = list(islice(merged, per_page + 1))
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if after is not None:
+        rows.reverse()
+        return rows, True, has_more
+    return rows, has_more, before is not None
+
+
+# エクスポートするファイルの列見出し
+EXPORT_HEADER = ['日時', 'ユーザー', '店舗', '品番', '商品名', '在庫数(変更前)', '在庫数(変更後)', '閾値(変更前)', '閾値(変更後)']
+
+# エクスポート時にデータベースから一度に読み込む行数
+EXPORT_BATCH_SIZE = 1000
+
+
+def iter_log_export_rows(store_id=None, start=None, end=None, include_archive=False):
+    """
+    エクスポート用に操作ログを1行ずつ返すジェネレータ
+
+    yield_per でサーバー側から EXPORT_BATCH_SIZE 行ずつ読み込むため、
+    何百万行あってもメモリに載るのは1バッチ分だけになる。
+    start 以上 end 未満の日時のログを古い順に返す。
+    include_archive=True の場合は、アーカイブ済みのログも日時順に合わせて返す。
+    """
+    query = log_rows_query(store_id)
+    if start is not None:
+        query = query.where(InventoryLog.timestamp >= start)
+    if end is not None:
+        query = query.where(InventoryLog.timestamp < end)
+    query = query.order_by(InventoryLog.timestamp.asc(), InventoryLog.id.asc())
+
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    if include_archive:
+        archived = iter_archived_log_rows(store_id=store_id, start=start, end=end)
+        result = heapq.merge(archived, result, key=_log_key)
+    for row in result:
+        yield [
+            row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            row.username,
+            row.store_name,
+            row.item_number,
+            row.product_name,
+            row.quantity_before,
+            row.quantity_after,
+            row.threshold_before,
+            row.threshold_after,
+        ]
+
+
+def iter_log_csv(rows):
+    """行のイテレータをCSVの文字列として少しずつ返すジェネレータ(Excelで開けるようBOM付き)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    yield '\ufeff'
+    writer.writerow(EXPORT_HEADER)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def write_log_xlsx(path, rows):
+    """行のイテレータを openpyxl の write-only モードでExcelファイルに書き出す"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('操作ログ')
+    sheet.append(EXPORT_HEADER)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
@@ -0,0 +1,157 @@
+from . import db
+from .models import Product, Inventory
+
+# /products と /api/products で1回に読み込む商品の行数
+PAGE_SIZE = 200
+
+
+def _product_conditions(store_id=None, alert_only=False, prefix=None):
+    """商品の絞り込み条件をSQLの条件式のリストとして返す"""
+    conditions = []
+    if store_id:
+        conditions.append(Product.id.in_(
+            db.select(Inventory.product_id).where(Inventory.store_id == store_id)
+        ))
+    if prefix:
+        conditions.append(
+            Product.item_number.startswith(prefix, autoescape=True) |
+            Product.name.startswith(prefix, autoescape=True)
+        )
+    if alert_only:
+        alert_products = db.select(Inventory.product_id).where(Inventory.quantity <= Inventory.threshold)
+        if store_id:
+            alert_products = alert_products.where(Inventory.store_id == store_id)
+        conditions.append(Product.id.in_(alert_products))
+    return conditions
+
+
+def build_inventory_matrix(stores, store_id=None, alert_only=False, prefix=None, after=None, limit=None):
+    """
+    商品×店舗の在庫マトリクスを1回の結合クエリで組み立てる関数
+
+    Product と Inventory を外部結合して必要な列だけを取得し、
+    メモリ上でピボットする。アラート行の判定と最終更新日も同じループで計算するため、
+    商品数・店舗数に関係なく発行されるクエリは1本だけになる。
+
+    絞り込み条件はすべてSQL側で適用する。
+    - store_id: その店舗に在庫がある商品だけを、その店舗の在庫行だけ読み込む
+    - alert_only: 在庫数が閾値以下の在庫を持つ商品(アラート行)だけに絞る
+    - prefix: 品番または商品名の前方一致
+    - after, limit: (商品名, 商品ID) のキーセットで after より後ろの商品を limit 件だけ読む
+
+    戻り値は {product_id: {'product': {...}, 'inventories': {...}, 'last_updated': ..., 'is_alert_row': ...}}
+    """
+    store_names = {s.id: s.name for s in stores}
+
+    query = db.select(
+        Product.id, Product.item_number, Product.name,
+        Inventory.id, Inventory.store_id, Inventory.quantity,
+        Inventory.threshold, Inventory.last_updated, Inventory.version
+    )
+
+    if store_id:
+        # 店舗指定時は内部結合にして、対象店舗の在庫行だけを読む
+        query = query.join(Inventory, (Inventory.product_id == Product.id) & (Inventory.store_id == store_id))
+    else:
+        query = query.outerjoin(Inventory, Inventory.product_id == Product.id)
+
+    # 店舗の絞り込みは上の内部結合で済んでいるので、それ以外の条件だけを付ける
+    conditions = _product_conditions(store_id=None, alert_only=alert_only, prefix=prefix)
+
+    if after is not None or limit is not None:
+        # ページ単位の読み込みでは、対象商品のIDをサブクエリで先に確定させる
+        page = db.select(Product.id).where(*_product_conditions(store_id, alert_only, prefix))
+        if after is not None:
+            after_name, after_id = after
+            page = page.where(
+                (Product.name > after_name) |
+                ((Product.name == after_name) & (Product.id > after_id))
+            )
+        page = page.order_by(Product.name, Product.id)
+        if limit is not None:
+            page = page.limit(limit)
+        conditions = [Product.id.in_(page)]
+
+    rows = db.session.execute(query.where(*conditions).order_by(Product.name, Product.id)).all()
+
+    matrix = {}
+    for pid, item_number, name, inv_id, inv_store_id, quantity, threshold, last_updated, version in rows:
+        data = matrix.get(pid)
+        if data is None:
+            # 店舗ごとのセルは未登録(None)で初期化しておく
+            data = matrix[pid] = {
+                'product': {'id': pid, 'item_number': item_number, 'name': name},
+                'inventories': {s_name: None for s_name in store_names.values()},
+                'last_updated': None,
+                'is_alert_row': False
+            }
+
+        # 在庫が1件もない商品は外部結合でNULLになる
+        if inv_id is None or inv_store_id not in store_names:
+            continue
+
+        data['inventories'][store_names[inv_store_id]] = {
+            'quantity': quantity,
+            'id': inv_id,
+            'threshold': threshold,
+            'version': version
+        }
+        if last_updated and (data['last_updated'] is None or last_updated > data['last_updated']):
+            data['last_updated'] = last_updated
+        if quantity <= threshold:
+            data['is_alert_row'] = True
+
+    return matrix
+
+
+def build_inventory_page(stores, after=None, limit=PAGE_SIZE, **filters):
+    """
+    キーセットページネーションで在庫マトリクスを1ページ分だけ組み立てる関数
+
+    limit + 1 件を読み込んで次のページの有無を判定し、
+    (マトリクス, 次ページのカーソル) を返す。最後のページではカーソルは None。
+    """
+    matrix = build_inventory_matrix(stores, after=after, limit=limit + 1, **filters)
+
+    next_cursor = None
+    if len(matrix) > limit:
+        # 余分に読んだ1件を捨て、このページ最後の商品をカーソルにする
+        matrix.pop(next(reversed(matrix)))
+        last = matrix[next(reversed(matrix))]['product']
+        next_cursor = {'after_name': last['name'], 'after_id': last['id']}
+
+    return matrix, next_cursor
+
+
+def matrix_to_columns(matrix, stores):
+    """
+    在庫マトリクスをJSON用の列指向の形式に変換する関数
+
+    店舗ごとに商品の並びと同じ長さの配列(在庫ID・在庫数・閾値・バージョン)を持たせる。
+    在庫が未登録のセルは null になる。
+    """
+    rows = list(matrix.values())
+    columns = {
+        'product_id': [r['product']['id'] for r in rows],
+        'item_number': [r['product']['item_number'] for r in rows],
+        'name': [r['product']['name'] for r in rows],
+        'last_updated': [r['last_updated'].isoformat() if r['last_updated'] else None for r in rows],
+        'is_alert_row': [r['is_alert_row'] for r in rows],
+    }
+
+    cells = []
+    for s in stores:
+        infos = [r['inventories'].get(s.name) for r in rows]
+        cells.append({
+            'store_id': s.id,
+            'inventory_id': [i['id'] if i else None for i in infos],
+            'quantity': [i['quantity'] if i else None for i in infos],
+            'threshold': [i['threshold'] if i else None for i in infos],
+            'version': [i['version'] if i else None for i in infos],
+        })
+
+    return {
+        'stores': [{'id': s.id, 'name': s.name} for s in stores],
+        'products': columns,
+        'cells': cells,
+    }
@@ -0,0 +1,220 @@
+import bisect
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 応答時間(秒)のヒストグラムの区切り
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 1リクエストあたりのSQL文の数のヒストグラムの区切り
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# IN (?, ?, ?) のような展開されたパラメータの並び。件数が違っても同じ形の文として数える
+_PARAMETER_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def statement_shape(statement):
+    """SQL文から、パラメータの並びの長さと空白の違いを除いた「形」を返す"""
+    return _SPACES.sub(' ', _PARAMETER_LIST.sub('(?)', statement)).strip()
+
+
+class _EndpointStats:
+    """エンドポイント・メソッドごとの集計"""
+
+    def __init__(self):
+        self.statuses = Counter()
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.statement_buckets = [0] * (len(STATEMENT_BUCKETS) + 1)
+        self.statements = 0
+        self.statement_seconds = 0.0
+        self.n_plus_one = 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class RequestMetrics:
+    """
+    リクエストごとの応答時間とSQL文の数・時間を集計するクラス
+
+    before_request から teardown_request まで(ストリーミングの応答は配信が終わって閉じられるまで)の応答時間を測り、SQLAlchemy のエンジンのイベント
+    (before/after_cursor_execute)で、そのリクエストの中で実行されたSQL文の数と時間を数える。
+    同じ形のSQL文が1リクエストで METRICS_N_PLUS_ONE_THRESHOLD 回以上実行された場合は N+1 の疑いとして
+    数え、ログに警告を出す。
+
+    SQL文ごとの処理はリクエストの g の値を増やすだけで、ロックを取るのはリクエストの終わりに1回だけ。
+    集計はプロセスごとなので、gunicorn の複数ワーカーではワーカーごとの値になる(/admin/cache_stats と同じ)。
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.n_plus_one_threshold = 10
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.started = time.time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.n_plus_one_threshold = app.config.get('METRICS_N_PLUS_ONE_THRESHOLD', 10)
+        app.extensions['request_metrics'] = self
+        if not self.enabled:
+            return
+        app.before_request(self._start_request)
+        app.teardown_request(self._finish_request)
+        app.after_request(self._record_status)
+
+    def _start_request(self):
+        g.request_metrics = {'started': time.perf_counter(), 'statements': 0, 'seconds': 0.0, 'shapes': Counter()}
+
+    @staticmethod
+    def _endpoint():
+        # URLに一致しなかったリクエスト(404など)は、ラベルの種類が増えないよう1つにまとめる
+        return request.url_rule.endpoint if request.url_rule is not None else 'unmatched'
+
+    def _record_status(self, response):
+        state = g.get('request_metrics')
+        if state is None:
+            return response
+        state['status'] = response.status_code
+        if response.is_streamed:
+            # ストリーミングの応答は teardown_request の後に本文を送るので、配信が終わって閉じられたときに記録する。
+            # 配信中の SQL 文も数えられるよう、state は g に残しておく(stream_with_context は同じ g を使う)
+            state['streamed'] = True
+            endpoint, method, app = self._endpoint(), request.method, current_app._get_current_object()
+            response.call_on_close(lambda: self._record(app, state, endpoint, method, state['status']))
+        return response
+
+    def _finish_request(self, exc):
+        state = g.get('request_metrics')
+        if state is None or state.get('streamed'):
+            return
+        g.pop('request_metrics', None)
+        status = 500 if exc is not None else state.get('status', 500)
+        self._record(current_app, state, self._endpoint(), request.method, status)
+
+    def _record(self, app, state, endpoint, method, status):
+        elapsed = time.perf_counter() - state['started']
+        suspects = [
+            (shape, count) for shape, count in state['shapes'].items()
+            if count >= self.n_plus_one_threshold
+        ]
+        with self._lock:
+            stats = self._endpoints.get((endpoint, method))
+            if stats is None:
+                stats = self._endpoints[(endpoint, method)] = _EndpointStats()
+            stats.statuses[status] += 1
+            stats.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            stats.latency_sum += elapsed
+            stats.statement_buckets[bisect.bisect_left(STATEMENT_BUCKETS, state['statements'])] += 1
+            stats.statements += state['statements']
+            stats.statement_seconds += state['seconds']
+            stats.n_plus_one += bool(suspects)
+
+        for shape, count in suspects:
+            app.logger.warning(
+                'N+1 の疑い: %s %s で同じSQL文が %d 回実行されました: %s',
+                method, endpoint, count, shape[:300]
+            )
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.started = time.time()
+
+    def render(self):
+        """集計をPrometheusのテキスト形式で返す"""
+        with self._lock:
+            items = sorted(self._endpoints.items())
+            lines = [
+                '# HELP http_requests_total リクエスト数',
+                '# TYPE http_requests_total counter',
+            ]
+            for (endpoint, method), stats in items:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f'http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+            lines += [
+                '# HELP http_request_duration_seconds 応答時間(ストリーミングの応答は配信が終わるまで)',
+                '# TYPE http_request_duration_seconds histogram',
+            ]
+            for (endpoint, method), stats in items:
+                lines += self._histogram('http_request_duration_seconds', endpoint, method,
+                                         LATENCY_BUCKETS, stats.latency_buckets, stats.latency_sum)
+
+            lines += [
+                '# HELP db_statements_per_request 1リクエストで実行したSQL文の数',
+                '# TYPE db_statements_per_request histogram',
+            ]
+            for (endpoint, method), stats in items:
+                lines += self._histogram('db_statements_per_request', endpoint, method,
+                                         STATEMENT_BUCKETS, stats.statement_buckets, stats.statements)
+
+            lines += [
+                '# HELP db_statement_duration_seconds_total SQL文の実行にかかった時間の合計',
+                '# TYPE db_statement_duration_seconds_total counter',
+            ]
+            for (endpoint, method), stats in items:
+                lines.append(f'db_statement_duration_seconds_total{_labels(endpoint=endpoint, method=method)} '
+                             f'{stats.statement_seconds:g}')
+
+            lines += [
+                '# HELP db_n_plus_one_requests_total 同じ形のSQL文を閾値以上の回数実行した(N+1の疑いがある)リクエスト数',
+                '# TYPE db_n_plus_one_requests_total counter',
+            ]
+            for (endpoint, method), stats in items:
+                lines.append(f'db_n_plus_one_requests_total{_labels(endpoint=endpoint, method=method)} {stats.n_plus_one}')
+
+            lines += [
+                '# HELP metrics_start_time_seconds 集計を始めた時刻(このプロセスの起動・リセット時)',
+                '# TYPE metrics_start_time_seconds gauge',
+                f'metrics_start_time_seconds {self.started:.3f}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram(name, endpoint, method, bounds, buckets, total):
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*bounds, '+Inf'), buckets):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(endpoint=endpoint, method=method, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{_labels(endpoint=endpoint, method=method)} {total:g}')
+        lines.append(f'{name}_count{_labels(endpoint=endpoint, method=method)} {cumulative}')
+        return lines
+
+
+request_metrics = RequestMetrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'request_metrics' in g:
+        # 開始時刻は実行ごとの context に置く(エラーで after が呼ばれなくても残らない)
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is None or not has_request_context():
+        return
+    state = g.get('request_metrics')
+    if state is None:
+        return
+    state['statements'] += 1
+    state['seconds'] += time.perf_counter() - started
+    state['shapes'][statement_shape(statement)] += 1
@@ -25,7 +25,9 @@ class User(UserMixin, db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # リクエストごとにデータベースを読まないよう、短時間キャッシュしたユーザーを使う
+    from .cache import user_cache
+    return user_cache.get(int(user_id))
 
 class Store(db.Model):
     # ...変更なし...
@@ -58,8 +60,27 @@ class Inventory(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     store = db.relationship('Store', back_populates='inventories')
     store_id = db.Column(db.Integer, db.ForeignKey('store.id'), nullable=False)
+    # 楽観的排他制御のためのバージョン番号(更新のたびに1ずつ増える)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # ▼▼▼ 在庫からログを参照するためのリレーションシップを追加 ▼▼▼
     inventory_logs = db.relationship('InventoryLog', back_populates='inventory', lazy='dynamic', cascade="all, delete-orphan")
+    stock_alerts = db.relationship('StockAlert', back_populates='inventory', lazy='dynamic', cascade="all, delete-orphan")
+    log_summaries = db.relationship('InventoryLogSummary', back_populates='inventory', lazy='dynamic', cascade="all, delete-orphan")
+    snapshots = db.relationship('InventorySnapshot', back_populates='inventory', lazy='dynamic', cascade="all, delete-orphan")
+
+    # ORM経由の更新は UPDATE ... WHERE version = (読み込んだ時の値) となり、
+    # 他の人が先に更新していた場合は StaleDataError になる
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        # 商品×店舗の在庫は1件だけ。インポートや更新APIでの (商品, 店舗) の検索にも使う
+        db.UniqueConstraint('product_id', 'store_id', name='uq_inventory_product_store'),
+        db.Index('ix_inventory_store_id', 'store_id'),
+        # 在庫アラート(quantity <= threshold)の行だけを持つ部分インデックス
+        db.Index('ix_inventory_low_stock', 'store_id',
+                 sqlite_where=db.text('quantity <= threshold'),
+                 postgresql_where=db.text('quantity <= threshold')),
+    )
 
 # --- ▼▼▼ InventoryLogモデルを修正 ▼▼▼ ---
 class InventoryLog(db.Model):
@@ -76,10 +97,128 @@ class InventoryLog(db.Model):
     inventory = db.relationship('Inventory', back_populates='inventory_logs')
     user = db.relationship('User', back_populates='inventory_logs')
 
+    __table_args__ = (
+        db.Index('ix_inventory_log_inventory_id_timestamp', 'inventory_id', 'timestamp'),
+        db.Index('ix_inventory_log_timestamp', 'timestamp'),
+    )
+
     def __repr__(self):
         return f'<Log {self.timestamp}>'
 
 
+class OutboxMessage(db.Model):
+    """送信待ちのメール。Webリクエストや定期ジョブはここに登録するだけで、送信はバックグラウンドで行う"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False) # カンマ区切り
+    subject = db.Column(db.String(256), nullable=False)
+    html_body = db.Column(db.Text, nullable=False)
+    text_body = db.Column(db.Text)
+    state = db.Column(db.String(16), nullable=False, default='queued') # queued / sending / sent / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=get_jst_now, nullable=False)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=get_jst_now, nullable=False)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # 送信待ち(queued / sending)の行だけを持つ部分インデックス
+        db.Index('ix_outbox_message_due', 'next_attempt_at',
+                 sqlite_where=db.text("state IN ('queued', 'sending')"),
+                 postgresql_where=db.text("state IN ('queued', 'sending')")),
+    )
+
+    def __repr__(self):
+        return f'<OutboxMessage {self.id} {self.state}>'
+
+
+class SchedulerLease(db.Model):
+    """定期ジョブを実行するワーカーを1つに決めるためのリース(期限内は owner のワーカーだけがジョブを実行する)"""
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(128), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<SchedulerLease {self.name} {self.owner}>'
+
+
+class CacheGeneration(db.Model):
+    """プロセス内のキャッシュの世代番号。キャッシュ元のテーブルを書き換えるたびに value を1つ進める"""
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CacheGeneration {self.name} {self.value}>'
+
+
+class StockAlert(db.Model):
+    """在庫数が閾値以下になった(low)・閾値を上回った(recovered)変化。在庫の書き込み時に記録する"""
+    id = db.Column(db.Integer, primary_key=True)
+    state = db.Column(db.String(16), nullable=False) # 'low' or 'recovered'
+    quantity = db.Column(db.Integer, nullable=False)
+    threshold = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=get_jst_now, nullable=False)
+    processed_at = db.Column(db.DateTime) # 定期ジョブが通知を処理した日時(未処理は NULL)
+    # 外部キー
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
+    # リレーションシップ
+    inventory = db.relationship('Inventory', back_populates='stock_alerts')
+
+    __table_args__ = (
+        # 未処理の変化だけを持つ部分インデックス(定期ジョブはここだけを読む)
+        db.Index('ix_stock_alert_pending', 'id',
+                 sqlite_where=db.text('processed_at IS NULL'),
+                 postgresql_where=db.text('processed_at IS NULL')),
+    )
+
+    def __repr__(self):
+        return f'<StockAlert {self.inventory_id} {self.state}>'
+
+
+class InventoryLogSummary(db.Model):
+    """アーカイブ済みの操作ログを在庫ごと・日ごとに集計した行"""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    change_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity_open = db.Column(db.Integer, nullable=False) # その日最初の変更前の在庫数
+    quantity_close = db.Column(db.Integer, nullable=False) # その日最後の変更後の在庫数
+    quantity_in = db.Column(db.Integer, nullable=False, default=0) # 増えた数の合計
+    quantity_out = db.Column(db.Integer, nullable=False, default=0) # 減った数の合計
+    threshold_close = db.Column(db.Integer, nullable=False)
+    # 外部キー
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
+    inventory = db.relationship('Inventory', back_populates='log_summaries')
+
+    __table_args__ = (
+        db.UniqueConstraint('inventory_id', 'day', name='uq_inventory_log_summary_inventory_day'),
+        db.Index('ix_inventory_log_summary_day', 'day'),
+    )
+
+    def __repr__(self):
+        return f'<InventoryLogSummary {self.inventory_id} {self.day}>'
+
+
+class InventorySnapshot(db.Model):
+    """夜間ジョブで記録する、ある時点の在庫数と閾値(1日1回・在庫ごとに1行)"""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    last_log_id = db.Column(db.Integer, nullable=False, default=0) # 記録時点で最後の InventoryLog のID
+    quantity = db.Column(db.Integer, nullable=False)
+    threshold = db.Column(db.Integer, nullable=False)
+    # 外部キー
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
+    store_id = db.Column(db.Integer, db.ForeignKey('store.id'), nullable=False)
+    inventory = db.relationship('Inventory', back_populates='snapshots')
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'inventory_id', name='uq_inventory_snapshot_day_inventory'),
+        db.Index('ix_inventory_snapshot_taken_at', 'taken_at'),
+    )
+
+    def __repr__(self):
+        return f'<InventorySnapshot {self.inventory_id} {self.day}>'
+
+
 class ProductLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=get_jst_now, nullable=False)
@@ -94,4 +233,62 @@ class ProductLog(db.Model):
     user = db.relationship('User', back_populates='product_logs')
 
     def __repr__(self):
-        return f'<ProductLog {self.timestamp}>'
\ No newline at end of file
+        return f'<ProductLog {self.timestamp}>'
+
+class ImportJob(db.Model):
+    """バックグラウンドで実行するCSV/Excelインポートのジョブ"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False) # 'inventory' or 'products'
+    filename = db.Column(db.String(256), nullable=False)
+    state = db.Column(db.String(16), nullable=False, default='queued') # queued / running / succeeded / failed
+    processed_rows = db.Column(db.Integer, nullable=False, default=0)
+    created_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text) # 警告・エラーメッセージ(改行区切り)
+    created_at = db.Column(db.DateTime, default=get_jst_now, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # 最後に状態・進捗を書き込んだ日時。長く進まない実行中のジョブは、実行していたプロセスが終了したとみなす
+    updated_at = db.Column(db.DateTime, default=get_jst_now, onupdate=get_jst_now)
+    # ジョブを登録・実行するプロセス(ホスト名:PID:乱数)と、そのプロセスが生きていることを最後に書き込んだ日時
+    owner = db.Column(db.String(128))
+    heartbeat_at = db.Column(db.DateTime)
+    # 外部キー
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # リレーションシップ
+    user = db.relationship('User')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'filename': self.filename,
+            'state': self.state,
+            'processed_rows': self.processed_rows,
+            'created_count': self.created_count,
+            'updated_count': self.updated_count,
+            'errors': self.errors.splitlines() if self.errors else [],
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.state}>'
+
+
+class SalesBatch(db.Model):
+    """POSレジから受け取った売上バッチ(冪等キーで再送を判定する)"""
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(128), unique=True, nullable=False)
+    received_at = db.Column(db.DateTime, default=get_jst_now, nullable=False)
+    line_count = db.Column(db.Integer, nullable=False, default=0)
+    first_sold_at = db.Column(db.DateTime)
+    last_sold_at = db.Column(db.DateTime)
+    result = db.Column(db.Text) # 初回の処理結果(JSON)。再送時はこれをそのまま返す
+    # 外部キー
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    def __repr__(self):
+        return f'<SalesBatch {self.idempotency_key}>'
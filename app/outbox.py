@@ -0,0 +1,150 @@
+import threading
+import time
+from datetime import timedelta
+from . import db
+from .email import build_message, get_transport
+from .models import OutboxMessage, get_jst_now
+
+# 送信中(sending)のまま止まったメールを、送信待ちに戻すまでの時間
+SENDING_LEASE = timedelta(minutes=10)
+# 再試行の間隔の上限
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+
+class OutboxWorker:
+    """
+    OutboxMessage に登録された送信待ちのメールを、バックグラウンドのスレッドで送信するクラス
+
+    送信待ちのメールを MAIL_OUTBOX_BATCH_SIZE 件ずつ取り出し、MAIL_OUTBOX_RATE 件/秒を超えないよう間隔を空けて送る。
+    送信に失敗したメールは MAIL_OUTBOX_RETRY_BASE 秒から倍々に間隔を空けて再試行し、
+    MAIL_OUTBOX_MAX_ATTEMPTS 回失敗したら failed にする。
+    取り出しは UPDATE の条件で行うので、複数のプロセスで動かしても同じメールを二重に送ることはない。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._next_send_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['mail_outbox'] = self
+
+    def start(self):
+        """送信スレッドを開始する(Webリクエストを処理するプロセスでは開始しなくてよい)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mail-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        """新しいメールが登録されたことを送信スレッドに知らせる"""
+        self._wake.set()
+
+    def _run(self):
+        config = self.app.config
+        while not self._stop.is_set():
+            sent = 0
+            with self.app.app_context():
+                try:
+                    sent = self.deliver_due()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('mail outbox delivery failed')
+                finally:
+                    db.session.remove()
+            if sent < config['MAIL_OUTBOX_BATCH_SIZE']:
+                # 送信待ちが残っていなければ、新しいメールが登録されるか一定時間経つまで待つ
+                self._wake.wait(config['MAIL_OUTBOX_POLL_INTERVAL'])
+                self._wake.clear()
+
+    def _claim(self, limit):
+        """送信時刻を過ぎたメールを limit 件まで sending にして、取り出したメールを返す"""
+        now = get_jst_now()
+        due = db.session.scalars(
+            db.select(OutboxMessage.id)
+            .where(OutboxMessage.state.in_(['queued', 'sending']), OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+            .limit(limit)
+        ).all()
+        if not due:
+            return []
+
+        # 他のプロセスが先に取り出したメールは next_attempt_at が進んでいるので、ここでは更新されない
+        table = OutboxMessage.__table__
+        claimed = db.session.scalars(
+            db.update(table)
+            .where(table.c.id.in_(due), table.c.state.in_(['queued', 'sending']), table.c.next_attempt_at <= now)
+            .values(state='sending', next_attempt_at=now + SENDING_LEASE)
+            .returning(table.c.id)
+        ).all()
+        db.session.commit()
+        if not claimed:
+            return []
+        return OutboxMessage.query.filter(OutboxMessage.id.in_(claimed)).order_by(OutboxMessage.id).all()
+
+    def _throttle(self):
+        """MAIL_OUTBOX_RATE 件/秒を超えないよう、前回の送信から間隔を空ける"""
+        interval = 1.0 / self.app.config['MAIL_OUTBOX_RATE']
+        now = time.monotonic()
+        if self._next_send_at > now:
+            time.sleep(self._next_send_at - now)
+        self._next_send_at = max(now, self._next_send_at) + interval
+
+    def deliver_due(self):
+        """
+        送信時刻を過ぎたメールを1バッチ分送信する
+
+        メールごとに結果をコミットするので、途中で止まっても送信済みのメールを再送することはない。
+        戻り値は取り出したメールの件数
+        """
+        config = self.app.config
+        messages = self._claim(config['MAIL_OUTBOX_BATCH_SIZE'])
+        transport = get_transport()
+
+        for message in messages:
+            self._throttle()
+            try:
+                transport.send(build_message(message))
+            except Exception as e:
+                message.attempts += 1
+                message.last_error = str(e)
+                if message.attempts >= config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+                    message.state = 'failed'
+                    self.app.logger.error('mail %s to %s failed: %s', message.id, message.recipients, e)
+                else:
+                    delay = timedelta(seconds=config['MAIL_OUTBOX_RETRY_BASE'] * 2 ** (message.attempts - 1))
+                    message.state = 'queued'
+                    message.next_attempt_at = get_jst_now() + min(delay, MAX_RETRY_DELAY)
+                    self.app.logger.warning('mail %s to %s failed (attempt %s): %s',
+                                            message.id, message.recipients, message.attempts, e)
+            else:
+                message.state = 'sent'
+                message.sent_at = get_jst_now()
+                message.last_error = None
+            db.session.commit()
+
+        return len(messages)
+
+    def drain(self):
+        """送信時刻を過ぎたメールがなくなるまで送信する(CLIやテスト用)。戻り値は取り出した件数"""
+        total = 0
+        while True:
+            count = self.deliver_due()
+            total += count
+            if count < self.app.config['MAIL_OUTBOX_BATCH_SIZE']:
+                return total
+
+
+mail_outbox = OutboxWorker()
@@ -0,0 +1,86 @@
+import re
+from . import db
+from .models import User, Store, Product, Inventory, InventoryLog, InventorySnapshot, StockAlert, OutboxMessage
+
+# 実行計画の行のうち、テーブル全体(またはインデックス全体)を読むもの
+# 「SCAN テーブル」「SCAN テーブル USING INDEX ...」のどちらも件数に比例して遅くなる
+FULL_SCAN = re.compile(r'^SCAN (\w+)\b(?! CONSTANT)')
+
+
+def _key_queries():
+    """
+    実行計画を確認する主要なクエリの一覧を返す
+
+    (名前, SELECT文, 全件スキャンを許可するテーブル) のタプル。
+    一覧表示(LIMIT付きの並び順どおりのインデックス走査)や部分インデックスの走査のように、
+    件数が増えても読む量が増えないものだけを許可する。
+    """
+    return [
+        ('在庫の (商品, 店舗) 検索',
+         db.select(Inventory.id).where(Inventory.product_id == 1, Inventory.store_id == 1), ()),
+        ('在庫の (商品, 店舗) 一括検索',
+         db.select(Inventory.id).where(Inventory.product_id.in_([1, 2]), Inventory.store_id.in_([1])), ()),
+        ('店舗で絞り込んだ在庫マトリクス',
+         db.select(Product.id, Inventory.quantity)
+         .join(Inventory, (Inventory.product_id == Product.id) & (Inventory.store_id == 1)), ()),
+        ('在庫マトリクス(全店舗)',
+         db.select(Product.id, Inventory.quantity)
+         .outerjoin(Inventory, Inventory.product_id == Product.id)
+         .order_by(Product.name, Product.id), ('product',)),
+        ('在庫アラートの検索',
+         db.select(Inventory.id).where(Inventory.quantity <= Inventory.threshold), ('inventory',)),
+        ('店舗ごとの在庫アラートの検索',
+         db.select(Inventory.id).where(Inventory.quantity <= Inventory.threshold, Inventory.store_id == 1), ()),
+        ('未処理の在庫アラート状態の変化',
+         db.select(StockAlert.id, StockAlert.inventory_id).where(StockAlert.processed_at.is_(None)).order_by(StockAlert.id), ('stock_alert',)),
+        ('送信時刻を過ぎた送信待ちメール',
+         db.select(OutboxMessage.id).where(OutboxMessage.state.in_(['queued', 'sending']), OutboxMessage.next_attempt_at <= '2025-01-01')
+         .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id).limit(20), ()),
+        ('品番による商品検索',
+         db.select(Product.id).where(Product.item_number == 'A001'), ()),
+        ('店舗名による店舗検索',
+         db.select(Store.id).where(Store.name == '東京'), ()),
+        ('在庫ごとの操作ログ',
+         db.select(InventoryLog.id).where(InventoryLog.inventory_id == 1)
+         .order_by(InventoryLog.timestamp.desc()).limit(20), ()),
+        ('操作ログ一覧(新しい順)',
+         db.select(InventoryLog.id).order_by(InventoryLog.timestamp.desc()).limit(20), ('inventory_log',)),
+        ('期間を指定した操作ログ',
+         db.select(InventoryLog.id).where(InventoryLog.timestamp >= '2025-01-01', InventoryLog.timestamp < '2025-02-01'), ()),
+        ('指定時点に最も近いスナップショット',
+         db.select(InventorySnapshot.day).where(InventorySnapshot.taken_at <= '2025-01-01')
+         .order_by(InventorySnapshot.taken_at.desc()).limit(1), ()),
+        ('スナップショットの在庫の読み込み',
+         db.select(InventorySnapshot.quantity).where(InventorySnapshot.day == '2025-01-01', InventorySnapshot.inventory_id.in_([1, 2])), ()),
+        ('ログインユーザーの読み込み',
+         db.select(User.id).where(User.id == 1), ()),
+    ]
+
+
+def explain(statement):
+    """SQLiteの EXPLAIN QUERY PLAN の結果を、計画の説明文のリストとして返す"""
+    sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    rows = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)).all()
+    return [row[-1] for row in rows]
+
+
+def check_query_plans():
+    """
+    主要なクエリの実行計画を取得し、許可されていない全件スキャンを探す関数
+
+    戻り値は [(名前, 実行計画, 全件スキャンしているテーブルのリスト), ...]。
+    SQLite以外のデータベースでは EXPLAIN QUERY PLAN が使えないため RuntimeError を送出する。
+    """
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError('実行計画の確認はSQLiteでのみ実行できます')
+
+    results = []
+    for name, statement, allowed_scans in _key_queries():
+        plan = explain(statement)
+        full_scans = []
+        for detail in plan:
+            match = FULL_SCAN.match(detail)
+            if match and match.group(1) not in allowed_scans:
+                full_scans.append(match.group(1))
+        results.append((name, plan, full_scans))
+    return results
@@ -1,13 +1,29 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app, abort
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app, abort, Response, stream_with_context, session, make_response, get_template_attribute
 from werkzeug.utils import secure_filename
 from flask_login import login_user, logout_user, login_required, current_user
-from .models import User, Product, Store, Inventory, InventoryLog, ProductLog
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from .models import User, Product, Store, Inventory, InventoryLog, ProductLog, ImportJob
 from . import db
 from .forms import RegistrationForm, LoginForm, ProductForm, EditInventoryForm, AllocateInventoryForm, InventoryEntryForm, CsvUploadForm, AdminEditProfileForm, StoreForm, EditProductForm
-import pandas as pd
 import os
-import chardet
+import json
+import time
+import uuid
+import hashlib
+import functools
+import tempfile
+from datetime import date, datetime, timedelta
 from .decorators import admin_required
+from .inventory import apply_inventory_batch, adjust_inventory_quantity, CONFLICT_MESSAGE, MAX_BATCH_ITEMS
+from .jobs import import_jobs
+from .logs import fetch_log_page, parse_log_cursor, iter_log_export_rows, iter_log_csv, write_log_xlsx
+from .sales import ingest_sales_batch, MAX_SALES_LINES
+from .matrix import build_inventory_page, matrix_to_columns, PAGE_SIZE
+from .snapshots import apply_as_of, parse_as_of
+from .events import inventory_events, RemoteChangeDetector
+from .metrics import request_metrics
+from .cache import user_cache, reference_cache, row_fragment_cache, current_generation, REFERENCE_GENERATION
 
 main = Blueprint('main', __name__)
 
@@ -55,58 +71,291 @@ def register():
     return render_template('register.html', title='Register', form=form)
 
 
+def _inventory_filters():
+    """/products と /api/products に共通する絞り込み条件をクエリパラメータから取得する"""
+    store_id_filter = request.args.get('store_id', type=int)
+    alert_only = request.args.get('alert_only', type=int) == 1
+    prefix = request.args.get('q', '').strip()
+
+    # 店舗の一覧は店舗が追加・変更されるまでキャッシュを使う
+    stores = reference_cache.stores()
+
+    # 店舗が指定された場合は、その店舗の列だけを表示する
+    display_stores = stores
+    if store_id_filter:
+        filtered_store = next((s for s in stores if s.id == store_id_filter), None)
+        if filtered_store:
+            display_stores = [filtered_store]
+        else:
+            store_id_filter = None
+
+    filters = {
+        'store_id': store_id_filter,
+        'alert_only': alert_only,
+        'prefix': prefix or None
+    }
+    return stores, display_stores, filters
+
+
+def _inventory_cursor():
+    """キーセットページネーションのカーソル(商品名, 商品ID)をクエリパラメータから取得する"""
+    after_name = request.args.get('after_name')
+    after_id = request.args.get('after_id', type=int)
+    if after_name is None or after_id is None:
+        return None
+    return (after_name, after_id)
+
+
+def _inventory_as_of():
+    """過去の時点を表示する場合の日時(as_of)をクエリパラメータから取得する。未指定なら None、不正なら ValueError"""
+    value = request.args.get('as_of', '').strip()
+    if not value:
+        return None
+    return parse_as_of(value)
+
+
+def _build_inventory_page(display_stores, filters, as_of, after=None, limit=PAGE_SIZE):
+    """
+    在庫マトリクスを1ページ分組み立てる。as_of を指定した場合はその時点の在庫数に置き換える
+
+    過去の時点のアラートは現在の在庫数では判定できないので、as_of 指定時の「アラートのみ」は
+    ページを読み込んだ後に過去の値で絞り込む(ページの行数が limit より少なくなることがある)。
+    """
+    if as_of is None:
+        return build_inventory_page(display_stores, after=after, limit=limit, **filters)
+
+    matrix, next_cursor = build_inventory_page(display_stores, after=after, limit=limit, **dict(filters, alert_only=False))
+    apply_as_of(matrix, as_of)
+    if filters['alert_only']:
+        matrix = {pid: data for pid, data in matrix.items() if data['is_alert_row']}
+    return matrix, next_cursor
+
+
+@functools.lru_cache(maxsize=None)
+def _template_version(template_folder):
+    """テンプレートの最終更新日時。ETagに含めて、テンプレートを更新した後に古いページが使われないようにする"""
+    return max(
+        (os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(template_folder) for name in names),
+        default=0
+    )
+
+
+def _page_etag(*parts):
+    """
+    ページの内容を決める値(データのバージョン・ユーザー・URLなど)から強いETagを作る
+
+    flashメッセージを表示するページは同じ値でも内容が変わるので、None(ETagを付けない)を返す。
+    """
+    if session.get('_flashes'):
+        return None
+    template_folder = os.path.join(current_app.root_path, current_app.template_folder)
+    key = repr((_template_version(template_folder), *parts))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _not_modified(etag):
+    """ブラウザが持っているページのETag(If-None-Match)が etag と同じなら 304 の応答を返す。違えば None"""
+    if etag is not None and request.if_none_match.contains(etag):
+        return _with_etag(current_app.response_class(status=304), etag)
+    return None
+
+
+def _with_etag(response, etag):
+    """応答にETagを付け、ブラウザが毎回ETagで変更を確認するようにする"""
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _row_key(pid, data, display_stores):
+    """在庫マトリクスの1行に表示する値(在庫のID・バージョン・在庫数など)"""
+    cells = tuple(
+        (info['id'], info['version'], info['quantity'], info['threshold']) if info else None
+        for info in (data['inventories'][s.name] for s in display_stores)
+    )
+    return (pid, data['product']['item_number'], data['product']['name'], data['last_updated'], cells)
+
+
+def _inventory_page_etag(name, matrix, next_cursor, display_stores, *parts):
+    """
+    在庫マトリクスのページのETag
+
+    在庫は書き込みが多いので全体の世代番号は持たず、このページに表示する行の値そのものから作る。
+    そのため、ページを組み立てるクエリは毎回実行するが、変わっていなければ描画・JSONへの変換を省ける。
+    """
+    rows = tuple(_row_key(pid, data, display_stores) for pid, data in matrix.items())
+    return _page_etag(name, current_generation(REFERENCE_GENERATION), rows, next_cursor, *parts)
+
+
+def _render_inventory_rows(matrix, display_stores, read_only):
+    """
+    在庫マトリクスの行を1行ずつ描画する
+
+    行の描画結果は、行に表示する値(在庫のID・バージョン・在庫数など)をキーにキャッシュするので、
+    1つのセルを更新した後の再読み込みで描画し直すのはその行だけになる。
+    """
+    render_row = get_template_attribute('inventory_row.html', 'inventory_row')
+    store_key = tuple((s.id, s.name) for s in display_stores)
+    rows = []
+    for pid, data in matrix.items():
+        key = (*_row_key(pid, data, display_stores), read_only, store_key)
+        rows.append(row_fragment_cache.get_or_render(key, lambda: render_row(data, display_stores, read_only)))
+    return rows
+
+
 @main.route('/products')
 @login_required
 def products():
-    # 店舗で絞り込むためのクエリパラメータを取得
-    store_id_filter = request.args.get('store_id', type=int)
+    stores, display_stores, filters = _inventory_filters()
+    try:
+        as_of = _inventory_as_of()
+    except ValueError:
+        flash('日時の形式が正しくありません。', 'danger')
+        return redirect(url_for('main.products'))
 
-    # 全ての店舗と商品を取得
-    stores = Store.query.order_by('name').all()
-    products = Product.query.order_by('name').all()
+    # 絞り込みはすべてSQL側で行い、最初のページだけを描画する
+    # 続きのページはスクロールに合わせて /api/products から読み込む
+    product_inventory_data, next_cursor = _build_inventory_page(display_stores, filters, as_of)
+
+    # 表示する在庫・店舗・商品が前回の表示から変わっていなければ、ページを描画せずに 304 を返す
+    etag = _inventory_page_etag('products', product_inventory_data, next_cursor, display_stores,
+                                current_user.id, current_user.role, current_user.store_id, request.full_path)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    return _with_etag(render_template('products.html', 
+                                      stores=stores, 
+                                      display_stores=display_stores,
+                                      rows=_render_inventory_rows(product_inventory_data, display_stores, as_of is not None),
+                                      next_cursor=next_cursor,
+                                      selected_store_id=filters['store_id'],
+                                      alert_only=filters['alert_only'],
+                                      prefix=filters['prefix'] or '',
+                                      as_of=as_of), etag)
+
+
+@main.route('/api/products')
+@login_required
+def api_products():
+    """在庫マトリクスを列指向のJSONでページ単位に返すAPI(as_of を指定するとその時点の在庫を返す)"""
+    stores, display_stores, filters = _inventory_filters()
+    limit = min(request.args.get('limit', PAGE_SIZE, type=int), PAGE_SIZE)
+    if limit < 1:
+        return jsonify({'status': 'error', 'message': 'limitは1以上を指定してください'}), 400
 
-    # 表示用のデータを格納する辞書を準備
-    product_inventory_data = {}
+    try:
+        as_of = _inventory_as_of()
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'as_of の日時の形式が正しくありません'}), 400
 
-    for p in products:
-        # ▼▼▼ 在庫数を格納する辞書を改良 ▼▼▼
-        # { '店舗名': (数量, 在庫ID), ... } という形式で保存
-        inventory_by_store = {s.name: None for s in stores}
-        last_updated = None
-        is_alert_row = False
-        
-        for inv in p.inventories:
-            inventory_by_store[inv.store.name] = {
-                'quantity': inv.quantity,
-                'id': inv.id,
-                'threshold': inv.threshold
-            } # 数量とIDをタプルで保存
-            last_updated = inv.last_updated
-            if inv.quantity <= inv.threshold:
-                is_alert_row = True
-
-        product_inventory_data[p.id] = {
-            'product': p,
-            'inventories': inventory_by_store,
-            'last_updated': last_updated,
-            'is_alert_row': is_alert_row
-        }
-    
-    # 絞り込みが指定されている場合は、その店舗の在庫がある商品だけにフィルタリング
-    if store_id_filter:
-        filtered_store = Store.query.get(store_id_filter)
-        if filtered_store:
-            product_inventory_data = {
-                pid: data for pid, data in product_inventory_data.items()
-                if data['inventories'].get(filtered_store.name) is not None
-            }
-    
+    matrix, next_cursor = _build_inventory_page(display_stores, filters, as_of, after=_inventory_cursor(), limit=limit)
+
+    etag = _inventory_page_etag('api_products', matrix, next_cursor, display_stores, request.full_path)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    payload = matrix_to_columns(matrix, display_stores)
+    payload['status'] = 'success'
+    payload['next_cursor'] = next_cursor
+    payload['as_of'] = as_of.isoformat() if as_of else None
+    return _with_etag(jsonify(payload), etag)
+
+
+# ロングポーリングで1回のリクエストが待つ最長の秒数
+LONG_POLL_TIMEOUT = 25
+# 同時に待てる接続の上限に達しているとき、画面に次の問い合わせまで空けてもらう間隔(ミリ秒)
+BUSY_POLL_INTERVAL = 5000
+
+
+def _sse(event, data, event_id=None):
+    """Server-Sent Events の1件分の文字列を作る"""
+    lines = [f'id: {event_id}'] if event_id else []
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
 
 
-    return render_template('products.html', 
-                           stores=stores, 
-                           product_data=product_inventory_data,
-                           selected_store_id=store_id_filter)
+@main.route('/api/inventory/events')
+@login_required
+def inventory_events_stream():
+    """
+    在庫の変更イベントを配信するAPI
+
+    Accept: text/event-stream の場合は Server-Sent Events で配信し続ける(EventSource 用)。
+      event: inventory  変更された在庫のイベントのリスト(app/events.py の inventory_event)
+      event: resync     取りこぼしがあったので、表示中の在庫を読み直す
+    それ以外はロングポーリングで、last_id より後のイベントを最長 LONG_POLL_TIMEOUT 秒待ってJSONで返す。
+
+    待っている間はワーカーのスレッドを1つ使うので、同時に待てる接続はプロセスごとに INVENTORY_EVENTS_MAX_STREAMS まで。
+    上限に達しているときは SSE の要求にもJSONで待たずに応答し(EventSource はエラーになり、画面はポーリングに切り替える)、
+    retry に次の問い合わせまで空ける間隔(ミリ秒)を返す。
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    after = inventory_events.parse_id(last_id) if last_id else inventory_events.last_seq()
+    resync = after is None
+    if resync:
+        after = inventory_events.last_seq()
+
+    slot = inventory_events.acquire_slot()
+    if slot and request.accept_mimetypes.best == 'text/event-stream':
+        config = current_app.config
+        heartbeat = config['INVENTORY_EVENTS_HEARTBEAT']
+        detector = RemoteChangeDetector()
+
+        def generate(after, resync):
+            yield 'retry: 3000\n\n'
+            deadline = time.monotonic() + config['INVENTORY_EVENTS_STREAM_SECONDS']
+            next_check = time.monotonic() + heartbeat
+            while True:
+                if resync:
+                    yield _sse('resync', {}, inventory_events.format_id(after))
+                    resync = False
+                if time.monotonic() >= deadline:
+                    return
+                events, after, missed = inventory_events.wait(after, heartbeat)
+                if missed or any('resync' in e for e in events):
+                    resync = True
+                elif events:
+                    yield _sse('inventory', events, inventory_events.format_id(after))
+                if time.monotonic() >= next_check:
+                    # 他のプロセスでの書き込みはイベントが届かないので、在庫の変更ログから検出する
+                    next_check = time.monotonic() + heartbeat
+                    if detector.changed():
+                        resync = True
+                    elif not events:
+                        yield ': keepalive\n\n'
+
+        # 配信中にデータベースの接続を持ち続けないよう、ここで返しておく
+        db.session.close()
+        response = Response(stream_with_context(generate(after, resync)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no' # nginx などのプロキシでバッファリングさせない
+        # 枠は配信が終わってレスポンスが閉じられたときに返す
+        response.call_on_close(inventory_events.release_slot)
+        return response
+
+    timeout = min(request.args.get('timeout', LONG_POLL_TIMEOUT, type=float), LONG_POLL_TIMEOUT)
+    db.session.close()
+    try:
+        # 枠が取れなかったときは待たずに、今あるイベントだけを返す
+        wait = max(timeout, 0) if slot and not resync else 0
+        events, after, missed = inventory_events.wait(after, wait)
+    finally:
+        if slot:
+            inventory_events.release_slot()
+    if missed or any('resync' in e for e in events):
+        resync, events = True, []
+    return jsonify({
+        'status': 'success',
+        'last_id': inventory_events.format_id(after),
+        'resync': resync,
+        'events': events,
+        'retry': 0 if slot else BUSY_POLL_INTERVAL,
+    })
 
 
 @main.route('/add_product', methods=['GET', 'POST'])
@@ -148,12 +397,16 @@ def allocate_inventory(product_id):
                 )
                 db.session.add(inventory)
 
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'danger')
+            return redirect(url_for('main.allocate_inventory', product_id=product_id))
         flash(f'[{product.name}]の在庫情報を保存しました。')
         return redirect(url_for('main.products'))
     
-    all_stores = Store.query.order_by('name').all()
-    for store in all_stores:
+    for store in reference_cache.stores():
         form.inventories.append_entry({
             'store_id': store.id,
             'store_name': store.name
@@ -188,6 +441,11 @@ def edit_inventory(inventory_id):
     form = EditInventoryForm()
 
     if form.validate_on_submit():
+        # フォームを開いた後に他のユーザーが更新していた場合は、上書きせずにやり直してもらう
+        if form.version.data and int(form.version.data) != inventory.version:
+            flash(CONFLICT_MESSAGE, 'danger')
+            return redirect(url_for('main.edit_inventory', inventory_id=inventory.id))
+
         # --- 1. ログを記録 ---
         # 変更前の在庫数を記録
         quantity_before = inventory.quantity
@@ -208,7 +466,12 @@ def edit_inventory(inventory_id):
         inventory.threshold = form.threshold.data
         
         # --- 3. Log and inventory are commited ---
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'danger')
+            return redirect(url_for('main.edit_inventory', inventory_id=inventory_id))
 
         if inventory.quantity != quantity_before and inventory.threshold != threshold_before:
             flash(f'「{inventory.product.name}」の在庫と閾値が更新されました。')
@@ -224,6 +487,7 @@ def edit_inventory(inventory_id):
     # ページが最初に表示された(GETリクエストの)場合、フォームに現在の在庫数を表示
     elif request.method == 'GET':
         form.quantity.data = inventory.quantity
+        form.version.data = inventory.version
 
     return render_template('edit_inventory.html', title='在庫編集', form=form, inventory=inventory)
 
@@ -242,8 +506,14 @@ def delete_product(product_id):
 def update_inventory():
     data = request.get_json()
     inventory_id = data.get('inventory_id')
-    new_quantity = int(data.get('quantity', 0)) # 数値に変換
-    new_threshold = int(data.get('threshold', 10)) # 数値に変換
+    try:
+        new_quantity = int(data.get('quantity', 0)) # 数値に変換
+        new_threshold = int(data.get('threshold', 10)) # 数値に変換
+        # 画面で読み込んだ時点のバージョン(省略可)
+        version = data.get('version')
+        version = int(version) if version not in (None, '') else None
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': '在庫数・閾値・バージョンは数値で指定してください'}), 400
 
     if current_user.role not in ['admin', 'manager']:
         return jsonify({'status': 'error', 'message': 'この操作を行う権限がありません'}), 403 # 403: Forbidden
@@ -268,9 +538,9 @@ def update_inventory():
             threshold=new_threshold
         )
         db.session.add(inventory)
-        db.session.commit() # コミットしてinventory.idを確定させる
         
         # ログは新規作成なので「0から」として記録
+        # inventory.id は最後のコミット時に在庫とログをまとめて書き込む際に確定する
         log_entry = InventoryLog(inventory=inventory, user=current_user, quantity_before=0, quantity_after=new_quantity, threshold_before=0, threshold_after=new_threshold)
         db.session.add(log_entry)
 
@@ -281,6 +551,16 @@ def update_inventory():
             return jsonify({'status': 'error', 'message': '所属ストア以外の在庫は編集できません'}), 403
         if not inventory:
             return jsonify({'status': 'error', 'message': '在庫が見つかりません'}), 404
+        # 画面で読み込んだ時点のバージョンと違えば、他のユーザーが先に更新している
+        if version is not None and version != inventory.version:
+            return jsonify({
+                'status': 'error',
+                'message': CONFLICT_MESSAGE,
+                'inventory_id': inventory.id,
+                'new_quantity': inventory.quantity,
+                'new_threshold': inventory.threshold,
+                'new_version': inventory.version
+            }), 409
         if inventory.quantity == new_quantity and inventory.threshold == new_threshold:
             return jsonify({'status': 'error', 'message': '変更がありませんでした'}), 403
         
@@ -294,85 +574,160 @@ def update_inventory():
         inventory.quantity = new_quantity
         inventory.threshold = new_threshold
 
-    db.session.commit()
+    try:
+        db.session.commit()
+    except StaleDataError:
+        # 読み込んでからコミットするまでの間に、他のリクエストが同じ在庫を更新した
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': CONFLICT_MESSAGE}), 409
+    except IntegrityError:
+        # 同じ商品×店舗の在庫を、他のリクエストが先に作成した(uq_inventory_product_store)
+        db.session.rollback()
+        current = Inventory.query.filter_by(product_id=product_id, store_id=store_id).first() if inventory_id == 'new' else None
+        if current is None:
+            return jsonify({'status': 'error', 'message': '商品または店舗が見つかりません'}), 404
+        return jsonify({
+            'status': 'error',
+            'message': CONFLICT_MESSAGE,
+            'inventory_id': current.id,
+            'new_quantity': current.quantity,
+            'new_threshold': current.threshold,
+            'new_version': current.version
+        }), 409
 
     return jsonify({
         'status': 'success',
         'message': '在庫が更新されました',
         'inventory_id': inventory.id, # ★新しいIDを返す
         'new_quantity': inventory.quantity,
-        'new_threshold': inventory.threshold
+        'new_threshold': inventory.threshold,
+        'new_version': inventory.version
+    })
+
+
+@main.route('/api/adjust_inventory', methods=['POST'])
+@login_required
+def adjust_inventory():
+    """在庫数を差分で更新するAPI(入荷: delta=+5, 販売: delta=-2 など)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        inventory_id = int(data['inventory_id'])
+        delta = int(data['delta'])
+        version = data.get('version')
+        version = int(version) if version not in (None, '') else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': '在庫IDと差分(delta)を数値で指定してください'}), 400
+    if delta == 0:
+        return jsonify({'status': 'error', 'message': '変更がありませんでした'}), 400
+
+    ok, result = adjust_inventory_quantity(inventory_id, delta, current_user, expected_version=version)
+    if not ok:
+        return jsonify({'status': 'error', 'message': result['message']}), result['code']
+
+    return jsonify({
+        'status': 'success',
+        'message': '在庫が更新されました',
+        'inventory_id': result['inventory_id'],
+        'new_quantity': result['quantity'],
+        'new_threshold': result['threshold'],
+        'new_version': result['version']
     })
 
+@main.route('/api/sales', methods=['POST'])
+@login_required
+def ingest_sales():
+    """POSレジから売上明細をまとめて受け取り、在庫を減算するAPI"""
+    data = request.get_json(silent=True) or {}
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    lines = data.get('lines')
+
+    if not idempotency_key or len(idempotency_key) > 128:
+        return jsonify({'status': 'error', 'message': '冪等キー(idempotency_key)を128文字以内で指定してください'}), 400
+    if not isinstance(lines, list) or not lines:
+        return jsonify({'status': 'error', 'message': '売上明細(lines)がありません'}), 400
+    if len(lines) > MAX_SALES_LINES:
+        return jsonify({'status': 'error', 'message': f'一度に送信できる明細は{MAX_SALES_LINES}件までです'}), 400
+
+    result = ingest_sales_batch(idempotency_key, lines, current_user)
+    result['status'] = 'success'
+    return jsonify(result)
+
+def _save_upload(file_storage):
+    """アップロードされたファイルを instance/uploads に一意な名前で保存し、そのパスを返す"""
+    filename = f'{uuid.uuid4().hex}_{secure_filename(file_storage.filename)}'
+    filepath = os.path.join(current_app.instance_path, 'uploads', filename)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    file_storage.save(filepath)
+    return filepath
+
+
+@main.route('/api/update_inventory_batch', methods=['POST'])
+@login_required
+def update_inventory_batch():
+    """複数の在庫セルをまとめて更新するAPI(全件成功するか、全件失敗するか)"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'message': '更新内容(items)がありません'}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({'status': 'error', 'message': f'一度に更新できるのは{MAX_BATCH_ITEMS}件までです'}), 400
+
+    ok, results = apply_inventory_batch(items, current_user)
+    if not ok:
+        # 最初のエラーのステータスコードを全体の結果として返す
+        code = next(r['code'] for r in results if r['status'] == 'error')
+        return jsonify({'status': 'error', 'message': '在庫は更新されませんでした', 'results': results}), code
+
+    return jsonify({'status': 'success', 'message': '在庫が更新されました', 'results': results})
+
 @main.route('/admin/import_data', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def import_data():
     form = CsvUploadForm()
     if form.validate_on_submit():
-        f = form.csv_file.data
-        filename = secure_filename(f.filename)
-        filepath = os.path.join(current_app.instance_path, 'uploads', filename)
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        f.save(filepath)
+        filepath = _save_upload(form.csv_file.data)
 
-        try:
-            # --- ▼▼▼ ここからが新しいロジック ▼▼▼ ---
-            if filename.endswith(('.xlsx', '.xlsm')): # .xlsxにも対応
-                df = pd.read_excel(filepath)
-            else:
-                # 2. chardetで文字コードを自動検出
-                with open(filepath, 'rb') as rawdata:
-                    result = chardet.detect(rawdata.read())
-                
-                detected_encoding = result['encoding']
-                print(f"Detected encoding: {detected_encoding}") # ターミナルで確認用
-
-                # 3. 検出したエンコーディングでファイルを読み込む
-                df = pd.read_csv(filepath, encoding=detected_encoding, on_bad_lines='warn')
-            # --- ▲▲▲ 新しいロジックここまで ▲▲▲ ---
-
-            # --- ▼▼▼ データベース処理のロジック (変更なし) ▼▼▼ ---
-            updated_count = 0
-            created_count = 0
-
-            for index, row in df.iterrows():
-                if not all(k in row for k in ['品番', '店舗名', '在庫数']):
-                    flash('CSVのヘッダーに「品番」「店舗名」「在庫数」が含まれている必要があります', 'danger')
-                    return redirect(url_for('main.import_data'))
-                
-                store = Store.query.filter_by(name=row['店舗名']).first()
-                if not store:
-                    store = Store(name=row['店舗名'])
-                    db.session.add(store)
-
-                product = Product.query.filter_by(item_number=row['品番']).first()
-                if not product:
-                    if '商品名' not in row:
-                        flash(f"新しい品番 {row['品番']}には「商品名」が必要です", 'danger')
-                        continue
-                    product = Product(item_number=row['品番'], name=row['商品名'])
-                    db.session.add(product)
-
-                inventory = Inventory.query.filter_by(product=product, store=store).first()
-                if inventory:
-                    inventory.quantity = int(row['在庫数'])
-                    updated_count += 1
-                else:
-                    inventory = Inventory(product=product, store=store, quantity=int(row['在庫数']))
-                    db.session.add(inventory)
-                    created_count += 1
-            
-            db.session.commit()
-            flash(f'インポート完了！ {created_count}件の新規在庫を登録し、{updated_count}件の在庫を更新しました。', 'success')
-
-        except Exception as e:
-            db.session.rollback()
-            flash(f'インポート中にエラーが発生しました : {e}', 'danger')
-        
-        return redirect(url_for('main.products'))
+        # インポートはバックグラウンドのジョブとして実行し、進捗はこのページでポーリングする
+        # ファイルの削除はジョブの終了時に行われる
+        job = import_jobs.submit('inventory', filepath, current_user)
+        flash('在庫データのインポートを開始しました。', 'info')
+        return redirect(url_for('main.import_data', job_id=job.id))
     
-    return render_template('import_data.html', title='データインポート', form=form)
+    return render_template('import_data.html', title='データインポート', form=form,
+                           job_id=request.args.get('job_id', type=int))
+
+
+@main.route('/admin/import_jobs/<int:job_id>')
+@login_required
+@admin_required
+def import_job_status(job_id):
+    """インポートジョブの状態をJSONで返す"""
+    # 実行していたプロセスが終了したジョブが、いつまでも実行中と表示されないようにする
+    import_jobs.fail_stale_jobs()
+    job = db.session.get(ImportJob, job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'ジョブが見つかりません'}), 404
+    return jsonify({'status': 'success', 'job': job.to_dict()})
+
+@main.route('/admin/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    """このプロセスのキャッシュのヒット数・ミス数をJSONで返す"""
+    return jsonify({
+        'status': 'success',
+        'user_cache': user_cache.stats(),
+        'reference_cache': reference_cache.stats(),
+        'row_fragment_cache': row_fragment_cache.stats(),
+    })
+
+@main.route('/admin/metrics')
+@login_required
+@admin_required
+def metrics():
+    """このプロセスのエンドポイントごとの応答時間・SQL文の数などをPrometheusのテキスト形式で返す"""
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @main.route('/user/<username>')
 @login_required
@@ -400,6 +755,8 @@ def edit_user(user_id):
         user.role = form.role.data
         user.store_id = form.store.data if form.store.data != 0 else None
         db.session.commit()
+        # 変更前の権限・所属店舗でキャッシュされたユーザーを使わないよう消す
+        user_cache.invalidate(user.id)
         flash('ユーザー情報が更新されました')
         return redirect(url_for('main.manage_users'))
     
@@ -425,7 +782,7 @@ def manage_stores():
         flash('新しいストアが登録されました')
         return redirect(url_for('main.manage_stores'))
     
-    stores = Store.query.order_by('name').all()
+    stores = reference_cache.stores()
     return render_template('manage_stores.html', stores=stores, form=form)
 
 @main.route('/delete_inventory/<int:inventory_id>', methods=['POST'])
@@ -456,28 +813,106 @@ def view_logs():
     if current_user.role not in ['admin', 'manager']:
         abort(403)
 
-    page = request.args.get('page', 1, type=int)
-    
+    store_id = None
     # 店長の場合は、自分の店舗のログのみ表示
     if current_user.role == 'manager':
         # manager's store_id must exist
         if not current_user.store_id:
-             return render_template('logs.html', pagination=None)
-        
-        # Get inventories for the manager's store
-        store_inventories = Inventory.query.filter_by(store_id=current_user.store_id).all()
-        inventory_ids = [inv.id for inv in store_inventories]
-        
-        pagination = InventoryLog.query.filter(InventoryLog.inventory_id.in_(inventory_ids)).order_by(InventoryLog.timestamp.desc()).paginate(
-            page=page, per_page=20, error_out=False
-        )
-    else: # 管理者の場合
-        pagination = InventoryLog.query.order_by(InventoryLog.timestamp.desc()).paginate(
-            page=page, per_page=20, error_out=False
+             return render_template('logs.html', logs=[], has_older=False, has_newer=False, include_archive=False)
+        store_id = current_user.store_id
+
+    # (日時, ID) のカーソルでページを移動する
+    before = parse_log_cursor(request.args.get('before_ts'), request.args.get('before_id', type=int))
+    after = parse_log_cursor(request.args.get('after_ts'), request.args.get('after_id', type=int))
+
+    # ユーザー名・店舗名・商品名は同じクエリで結合して取得する
+    # archived=1 の場合は、アーカイブ済みの古いログも続けて表示する
+    include_archive = request.args.get('archived') == '1'
+    logs, has_older, has_newer = fetch_log_page(store_id=store_id, before=before, after=after, include_archive=include_archive)
+    stores = reference_cache.stores() if current_user.role == 'admin' else []
+    return render_template('logs.html', logs=logs, has_older=has_older, has_newer=has_newer, stores=stores,
+                           include_archive=include_archive)
+
+
+def _parse_export_date(name):
+    """YYYY-MM-DD 形式の日付パラメータを date に変換する。未指定なら None、不正なら ValueError"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    return date.fromisoformat(value)
+
+
+def _stream_file(path, chunk_size=64 * 1024):
+    """一時ファイルを少しずつ読み出して返し、読み終わったら削除するジェネレータ"""
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+@main.route('/logs/export')
+@login_required
+def export_logs():
+    """
+    操作ログを期間・店舗で絞り込んでCSVまたはExcelでダウンロードする
+
+    ログは yield_per で少しずつ読み込みながら書き出すので、全件をメモリに載せることはない。
+    CSVは書いた分から順にレスポンスとして送り出す。
+    """
+    # 権限チェック（管理者または店長のみ）
+    if current_user.role not in ['admin', 'manager']:
+        abort(403)
+
+    # 店長は自分の店舗のログのみ、管理者は店舗を指定できる
+    if current_user.role == 'manager':
+        if not current_user.store_id:
+            abort(403)
+        store_id = current_user.store_id
+    else:
+        store_id = request.args.get('store_id', type=int)
+
+    try:
+        start_date = _parse_export_date('start')
+        end_date = _parse_export_date('end')
+    except ValueError:
+        flash('日付の形式が正しくありません。', 'danger')
+        return redirect(url_for('main.view_logs'))
+    # 終了日はその日を含める
+    start = datetime.combine(start_date, datetime.min.time()) if start_date else None
+    end = datetime.combine(end_date + timedelta(days=1), datetime.min.time()) if end_date else None
+
+    export_format = request.args.get('format', 'csv')
+    filename = 'inventory_logs_{}_{}'.format(
+        start_date.strftime('%Y%m%d') if start_date else 'all',
+        end_date.strftime('%Y%m%d') if end_date else 'latest'
+    )
+    rows = iter_log_export_rows(store_id=store_id, start=start, end=end, include_archive=request.args.get('archived') == '1')
+
+    if export_format == 'xlsx':
+        # xlsx はZIP形式のため最後まで書かないと送れない。write-only モードで一時ファイルに書き出してから送る
+        fd, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            write_log_xlsx(path, rows)
+        except Exception:
+            os.remove(path)
+            raise
+        return Response(
+            _stream_file(path),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            headers={'Content-Disposition': f'attachment; filename={filename}.xlsx'}
         )
-        
-    logs = pagination.items
-    return render_template('logs.html', logs=logs, pagination=pagination)
+
+    return Response(
+        stream_with_context(iter_log_csv(rows)),
+        mimetype='text/csv; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename={filename}.csv'}
+    )
 
 
 @main.route('/products_master')
@@ -485,8 +920,15 @@ def view_logs():
 def products_master():
     """商品マスタ一覧ページ"""
     # 閲覧は全てのログインユーザーに許可
+    # 商品が前回の表示から変わっていなければ 304 を返す(商品を書き換えると店舗・商品の世代番号が進む)
+    etag = _page_etag('products_master', current_generation(REFERENCE_GENERATION),
+                      current_user.id, current_user.role, request.full_path)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
     products = Product.query.order_by(Product.name).all() # 商品名を基準にソート
-    return render_template('products_master.html', products=products)
+    return _with_etag(render_template('products_master.html', products=products), etag)
 
 
 @main.route('/edit_product_master/<int:product_id>', methods=['GET', 'POST'])
@@ -554,65 +996,12 @@ def import_products_master():
     form = CsvUploadForm() # 既存のファイルアップロードフォームを使用
 
     if form.validate_on_submit():
-        f = form.csv_file.data
-        filename = secure_filename(f.filename)
-        filepath = os.path.join(current_app.instance_path, 'uploads', filename)
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        f.save(filepath)
+        filepath = _save_upload(form.csv_file.data)
 
-        try:
-            # ExcelまたはCSVファイルをPandasで読み込み
-            if filename.endswith(('.xlsx', '.xlsm')):
-                df = pd.read_excel(filepath)
-            else:
-                with open(filepath, 'rb') as rawdata:
-                    result = chardet.detect(rawdata.read()) # 文字コード自動検出
-                df = pd.read_csv(filepath, encoding=result['encoding'], on_bad_lines='warn')
-
-            updated_count = 0
-            created_count = 0
-
-            # 必須列のチェック
-            required_columns = ['品番', '商品名']
-            if not all(col in df.columns for col in required_columns):
-                flash(f'CSV/Excelファイルには「{", ".join(required_columns)}」の列が必要です。', 'danger')
-                return redirect(url_for('main.import_products_master'))
-
-            # 各行の商品データを処理
-            for index, row in df.iterrows():
-                item_number = str(row['品番']).strip() # 品番は文字列として扱い、前後空白を除去
-
-                # 品番で既存商品を検索
-                product = Product.query.filter_by(item_number=item_number).first()
-
-                if product:
-                    # 商品が存在すれば更新
-                    product.name = str(row['商品名']).strip()
-                    product.price = int(row['販売価格']) if '販売価格' in row and pd.notna(row['販売価格']) else None
-                    product.cost = int(row['原価']) if '原価' in row and pd.notna(row['原価']) else None
-                    updated_count += 1
-                else:
-                    # 商品が存在しなければ新規作成
-                    product = Product(
-                        item_number=item_number,
-                        name=str(row['商品名']).strip(),
-                        price=int(row['販売価格']) if '販売価格' in row and pd.notna(row['販売価格']) else None,
-                        cost=int(row['原価']) if '原価' in row and pd.notna(row['原価']) else None
-                    )
-                    db.session.add(product)
-                    created_count += 1
-
-            db.session.commit()
-            flash(f'商品マスタのインポートが完了しました。{created_count}件を新規登録し、{updated_count}件を更新しました。', 'success')
-            return redirect(url_for('main.products_master'))
-
-        except Exception as e:
-            db.session.rollback() # エラー時はロールバック
-            flash(f'インポート中にエラーが発生しました: {e}', 'danger')
-        finally:
-            # アップロードされたファイルを削除
-            if os.path.exists(filepath):
-                os.remove(filepath)
+        # 在庫データと同じく、バックグラウンドのジョブとして実行する
+        job = import_jobs.submit('products', filepath, current_user)
+        flash('商品マスタのインポートを開始しました。', 'info')
+        return redirect(url_for('main.import_data', job_id=job.id))
         
     return render_template('import_products_master.html', title='商品マスタインポート', form=form)
 
@@ -0,0 +1,192 @@
+import json
+from collections import defaultdict
+from datetime import datetime
+import pytz
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .models import Inventory, InventoryLog, SalesBatch, get_jst_now
+from .alerts import record_stock_transitions
+from .cache import reference_cache
+from .events import record_inventory_changes
+
+JST = pytz.timezone('Asia/Tokyo')
+
+# 1回の売上バッチで受け付ける最大明細数
+MAX_SALES_LINES = 5000
+
+
+def _stored_result(idempotency_key):
+    batch = SalesBatch.query.filter_by(idempotency_key=idempotency_key).first()
+    if batch is None:
+        return None
+    result = json.loads(batch.result)
+    result['duplicate'] = True
+    return result
+
+
+def _parse_line(line, store_ids, store_names):
+    """売上明細を (店舗ID, 品番, 数量, 販売日時) に変換する。不正な場合は ValueError"""
+    if 'store_id' in line:
+        store_id = int(line['store_id'])
+        if store_id not in store_names:
+            raise ValueError('店舗が見つかりません')
+    else:
+        store_id = store_ids.get(str(line.get('store', '')).strip())
+        if store_id is None:
+            raise ValueError('店舗が見つかりません')
+
+    item_number = str(line.get('item_number', '')).strip()
+    if not item_number:
+        raise ValueError('品番がありません')
+
+    qty = int(line.get('qty', 0))
+    if qty <= 0:
+        raise ValueError('数量は1以上で指定してください')
+
+    sold_at = line.get('timestamp')
+    if sold_at:
+        if not isinstance(sold_at, str):
+            raise ValueError('販売日時の形式が正しくありません')
+        try:
+            sold_at = datetime.fromisoformat(sold_at)
+        except ValueError:
+            raise ValueError('販売日時の形式が正しくありません')
+        if sold_at.tzinfo is not None:
+            # 時差付きの日時は、他の日時の列(get_jst_now)と同じく時差なしの日本時間で保存する
+            sold_at = sold_at.astimezone(JST).replace(tzinfo=None)
+    else:
+        sold_at = None
+    return store_id, item_number, qty, sold_at
+
+
+def ingest_sales_batch(idempotency_key, lines, user):
+    """
+    POSレジからの売上明細をまとめて在庫に反映する関数
+
+    明細を在庫行ごとに集計し、在庫の減算は在庫行ごとに1回のバルクUPDATEで、
+    InventoryLog はバルクINSERTで書き込む。全体で1トランザクション・1コミット。
+    同じ冪等キーのバッチが既に処理済みの場合は何もせず、初回の結果を返す(再送しても二重に減算されない)。
+
+    店舗が見つからない・品番が未登録・その店舗に在庫がない・権限がない明細は反映せず、rejected に理由を返す。
+    売上は実際に起きた事実なので、在庫数が0を下回っても減算する。
+    """
+    stored = _stored_result(idempotency_key)
+    if stored is not None:
+        return stored
+
+    # --- 1. 明細を解釈し、店舗・商品・在庫をまとめて引き当てる ---
+    store_ids = reference_cache.store_ids()
+    store_names = {store_id: name for name, store_id in store_ids.items()}
+
+    rejected = []
+    parsed = []
+    for index, line in enumerate(lines):
+        try:
+            store_id, item_number, qty, sold_at = _parse_line(line, store_ids, store_names)
+        except (TypeError, ValueError, AttributeError) as e:
+            rejected.append({'index': index, 'message': str(e) or '明細の形式が正しくありません'})
+            continue
+        if user.role != 'admin' and user.store_id != store_id:
+            rejected.append({'index': index, 'message': '所属ストア以外の売上は登録できません'})
+            continue
+        parsed.append((index, store_id, item_number, qty, sold_at))
+
+    item_numbers = {item_number for _, _, item_number, _, _ in parsed}
+    all_product_ids = reference_cache.product_ids()
+    product_ids = {item_number: all_product_ids[item_number] for item_number in item_numbers if item_number in all_product_ids}
+
+    pairs = {(product_ids[item_number], store_id) for _, store_id, item_number, _, _ in parsed if item_number in product_ids}
+    # 行値の IN はインデックス全体の走査になるため、商品と店舗のIDで別々に絞り込む
+    inventory_ids = {
+        (product_id, store_id): inventory_id
+        for inventory_id, product_id, store_id in db.session.execute(
+            db.select(Inventory.id, Inventory.product_id, Inventory.store_id)
+            .where(Inventory.product_id.in_({p for p, s in pairs}), Inventory.store_id.in_({s for p, s in pairs}))
+        ).all()
+    } if pairs else {}
+
+    # --- 2. 在庫行ごとに販売数を集計する ---
+    sold = defaultdict(int)
+    sold_times = []
+    # 在庫行ごとの最後の販売日時(ログの日時にする)。販売日時のない明細は受け付けた時点の販売として扱う
+    received_at = get_jst_now().replace(tzinfo=None)
+    last_sold = {}
+    for index, store_id, item_number, qty, sold_at in parsed:
+        if item_number not in product_ids:
+            rejected.append({'index': index, 'message': f'品番 {item_number} が登録されていません'})
+            continue
+        inventory_id = inventory_ids.get((product_ids[item_number], store_id))
+        if inventory_id is None:
+            rejected.append({'index': index, 'message': f'品番 {item_number} の在庫がこの店舗に登録されていません'})
+            continue
+        sold[inventory_id] += qty
+        if sold_at:
+            sold_times.append(sold_at)
+        last_sold[inventory_id] = max(last_sold.get(inventory_id, sold_at or received_at), sold_at or received_at)
+
+    # --- 3. 冪等キーを確保してから、在庫とログを一括で書き込む ---
+    batch = SalesBatch(
+        idempotency_key=idempotency_key,
+        line_count=len(lines),
+        first_sold_at=min(sold_times) if sold_times else None,
+        last_sold_at=max(sold_times) if sold_times else None,
+        user_id=user.id
+    )
+    db.session.add(batch)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # 同じキーのバッチが並行して処理された
+        db.session.rollback()
+        return _stored_result(idempotency_key)
+
+    inventories = []
+    if sold:
+        table = Inventory.__table__
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == db.bindparam('b_id'))
+            .values(quantity=table.c.quantity - db.bindparam('b_qty'), version=table.c.version + 1),
+            [{'b_id': inventory_id, 'b_qty': qty} for inventory_id, qty in sold.items()]
+        )
+        # UPDATE の後は書き込みロックを持っているので、ここで読む値は他の更新に影響されない
+        after = db.session.execute(
+            db.select(
+                table.c.id, table.c.quantity, table.c.threshold,
+                table.c.product_id, table.c.store_id, table.c.version
+            ).where(table.c.id.in_(sold.keys()))
+        ).all()
+        db.session.execute(db.insert(InventoryLog), [
+            {
+                'inventory_id': inventory_id,
+                'user_id': user.id,
+                'quantity_before': quantity + sold[inventory_id],
+                'quantity_after': quantity,
+                'threshold_before': threshold,
+                'threshold_after': threshold,
+                'timestamp': last_sold[inventory_id]
+            }
+            for inventory_id, quantity, threshold, _, _, _ in after
+        ])
+        record_stock_transitions(
+            (inventory_id, quantity + sold[inventory_id], threshold, quantity, threshold)
+            for inventory_id, quantity, threshold, _, _, _ in after
+        )
+        record_inventory_changes(
+            (inventory_id, product_id, store_id, quantity, threshold, version)
+            for inventory_id, quantity, threshold, product_id, store_id, version in after
+        )
+        inventories = [{'inventory_id': row.id, 'quantity': row.quantity} for row in after]
+
+    rejected.sort(key=lambda r: r['index'])
+    result = {
+        'idempotency_key': idempotency_key,
+        'applied_lines': len(lines) - len(rejected),
+        'rejected': rejected,
+        'inventories': inventories,
+    }
+    batch.result = json.dumps(result, ensure_ascii=False)
+    db.session.commit()
+
+    result['duplicate'] = False
+    return result
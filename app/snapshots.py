@@ -0,0 +1,158 @@
+from datetime import datetime, time
+import pytz
+from . import db
+from .models import Inventory, InventoryLog, InventorySnapshot, get_jst_now
+
+JST = pytz.timezone('Asia/Tokyo')
+
+
+def take_inventory_snapshot(day=None):
+    """
+    全在庫の現在の在庫数と閾値を InventorySnapshot に記録する関数(夜間ジョブから1日1回呼ぶ)
+
+    INSERT ... SELECT の1文で書き込むので、在庫数が多くても行ごとの処理は発生しない。
+    同じ日のスナップショットが既にある場合は取り直す。
+    記録時点で最後の InventoryLog のIDも一緒に保存し、それより後のログだけを再生すれば任意の時点の在庫を求められるようにする。
+
+    戻り値は記録した行数
+    """
+    taken_at = get_jst_now().replace(tzinfo=None)
+    day = day or taken_at.date()
+
+    db.session.execute(db.delete(InventorySnapshot).where(InventorySnapshot.day == day))
+    last_log_id = db.select(db.func.coalesce(db.func.max(InventoryLog.id), 0)).scalar_subquery()
+    result = db.session.execute(
+        db.insert(InventorySnapshot).from_select(
+            ['day', 'taken_at', 'last_log_id', 'inventory_id', 'store_id', 'quantity', 'threshold'],
+            db.select(
+                db.literal(day, db.Date), db.literal(taken_at, db.DateTime), last_log_id,
+                Inventory.id, Inventory.store_id, Inventory.quantity, Inventory.threshold
+            )
+        )
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def parse_as_of(value):
+    """
+    クエリパラメータの日時を datetime に変換する。日付だけの場合はその日の終わりとする。不正な場合は ValueError
+
+    時差付きの日時は、ログやスナップショットの日時の列と比べられるよう時差なしの日本時間にする。
+    """
+    if len(value) == 10:
+        return datetime.combine(datetime.strptime(value, '%Y-%m-%d').date(), time.max)
+    as_of = datetime.fromisoformat(value)
+    if as_of.tzinfo is not None:
+        as_of = as_of.astimezone(JST).replace(tzinfo=None)
+    return as_of
+
+
+def _nearest_snapshot(as_of):
+    """as_of 以前で最も新しいスナップショットを (日, 記録日時, 最後のログID) で返す。なければ as_of より後で最も古いもの"""
+    columns = (InventorySnapshot.day, InventorySnapshot.taken_at, InventorySnapshot.last_log_id)
+    before = db.session.execute(
+        db.select(*columns).where(InventorySnapshot.taken_at <= as_of)
+        .order_by(InventorySnapshot.taken_at.desc()).limit(1)
+    ).first()
+    if before is not None:
+        return before, True
+    after = db.session.execute(
+        db.select(*columns).where(InventorySnapshot.taken_at > as_of)
+        .order_by(InventorySnapshot.taken_at.asc()).limit(1)
+    ).first()
+    return after, False
+
+
+def inventory_as_of(as_of, inventory_ids):
+    """
+    指定した在庫の as_of 時点の在庫数と閾値を {在庫ID: (在庫数, 閾値)} で返す関数
+
+    as_of に最も近いスナップショットから始め、その後のログだけを適用する。
+    - as_of 以前のスナップショットがある場合: スナップショット以降・as_of までの各在庫の最後のログの変更後の値
+    - ない場合: as_of より後のスナップショット(なければ現在の在庫)から、as_of より後の各在庫の最初のログの変更前の値
+    そのため、読むログの量は全履歴ではなく、スナップショットからの変更件数に比例する。
+    as_of の時点でまだ作られていなかった在庫は結果に含まれない。
+
+    アーカイブ済み(データベースから削除済み)のログは参照しないので、保存期間より前の時点は
+    スナップショットの粒度(1日単位)の値になる。
+    """
+    inventory_ids = list(inventory_ids)
+    if not inventory_ids:
+        return {}
+
+    snapshot, is_before = _nearest_snapshot(as_of)
+    logs = db.select(
+        InventoryLog.inventory_id, InventoryLog.quantity_before, InventoryLog.quantity_after,
+        InventoryLog.threshold_before, InventoryLog.threshold_after
+    ).where(InventoryLog.inventory_id.in_(inventory_ids))
+
+    if snapshot is not None:
+        day, taken_at, last_log_id = snapshot
+        values = {
+            inventory_id: (quantity, threshold)
+            for inventory_id, quantity, threshold in db.session.execute(
+                db.select(InventorySnapshot.inventory_id, InventorySnapshot.quantity, InventorySnapshot.threshold)
+                .where(InventorySnapshot.day == day, InventorySnapshot.inventory_id.in_(inventory_ids))
+            )
+        }
+    else:
+        last_log_id = None
+        values = {
+            inventory_id: (quantity, threshold)
+            for inventory_id, quantity, threshold in db.session.execute(
+                db.select(Inventory.id, Inventory.quantity, Inventory.threshold).where(Inventory.id.in_(inventory_ids))
+            )
+        }
+
+    if is_before:
+        # スナップショットより後、as_of までのログを古い順に適用する(最後の変更後の値が残る)
+        logs = logs.where(InventoryLog.id > last_log_id, InventoryLog.timestamp <= as_of).order_by(InventoryLog.id)
+        for inventory_id, _, quantity_after, _, threshold_after in db.session.execute(logs):
+            values[inventory_id] = (quantity_after, threshold_after)
+    else:
+        # as_of より後のログを新しい順に戻す(最初の変更前の値が残る)
+        logs = logs.where(InventoryLog.timestamp > as_of)
+        if last_log_id is not None:
+            logs = logs.where(InventoryLog.id <= last_log_id)
+        created = set()
+        for inventory_id, quantity_before, _, threshold_before, _ in db.session.execute(logs.order_by(InventoryLog.id.desc())):
+            if inventory_id in values:
+                values[inventory_id] = (quantity_before, threshold_before)
+                # 在庫の新規作成は「0から」のログとして記録されているので、その在庫は as_of の時点では存在しなかった
+                if (quantity_before, threshold_before) == (0, 0):
+                    created.add(inventory_id)
+                else:
+                    created.discard(inventory_id)
+        for inventory_id in created:
+            del values[inventory_id]
+
+    return values
+
+
+def apply_as_of(matrix, as_of):
+    """
+    build_inventory_matrix で組み立てたマトリクスのセルを as_of 時点の在庫数と閾値に置き換える関数
+
+    過去の時点の表示は閲覧専用なので、セルのバージョンは None にする。
+    as_of の時点で存在しなかった在庫のセルは未登録(None)になる。
+    """
+    inventory_ids = [
+        info['id'] for data in matrix.values() for info in data['inventories'].values() if info
+    ]
+    values = inventory_as_of(as_of, inventory_ids)
+
+    for data in matrix.values():
+        data['is_alert_row'] = False
+        data['last_updated'] = None
+        for store_name, info in data['inventories'].items():
+            if not info:
+                continue
+            if info['id'] not in values:
+                data['inventories'][store_name] = None
+                continue
+            quantity, threshold = values[info['id']]
+            data['inventories'][store_name] = {'quantity': quantity, 'id': info['id'], 'threshold': threshold, 'version': None}
+            if quantity <= threshold:
+                data['is_alert_row'] = True
+    return matrix
@@ -1,31 +1,46 @@
-from app import create_app, db
-from app.models import Inventory, User
-from app.email import send_email
-from flask import render_template
+from flask import current_app
+from app.alerts import pending_stock_alerts, build_alert_digests, mark_stock_alerts_processed
+from app.email import render_emails, enqueue_messages
+from app.archive import archive_inventory_logs
+from app.snapshots import take_inventory_snapshot
+
+# 定期ジョブはすべて、ワーカー(app/worker.py)が作ったアプリのアプリケーションコンテキストの中で呼ばれる
 
 def check_stock_levels():
-    app = create_app()
-    with app.app_context():
-        print("checking stock levels ...")
-
-        low_stock_items = Inventory.query.filter(Inventory.quantity <= Inventory.threshold).all()
-
-        if low_stock_items:
-            print(f"Found {len(low_stock_items)} low stock items.")
-
-            recipients = [user.email for user in User.query.filter_by(role='admin').all()]
-
-            if not recipients:
-                print('No recipients found')
-                return
-            
-            send_email(
-                recipients,
-                '【デイリーレポート】在庫アラート通知',
-                'email/summary_alert',
-                items=low_stock_items
-            )
-            print(f"Stock alert summary sent to {recipients}")
-        
+    print("checking stock levels ...")
+
+    # 在庫テーブル全体は読まず、書き込み時に記録された未処理のアラート状態の変化だけを読む
+    alert_ids, low_stock_items = pending_stock_alerts()
+
+    if low_stock_items:
+        print(f"Found {len(low_stock_items)} new low stock items.")
+
+        # 店舗ごとのダイジェスト(店長宛て)と全店舗のまとめ(管理者宛て)を並行して描画し、まとめて送信待ちに登録する
+        digests = build_alert_digests(low_stock_items)
+        if digests:
+            enqueue_messages(render_emails(digests, current_app.config['ALERT_RENDER_WORKERS']))
+            for recipients, subject, _, _ in digests:
+                print(f"{subject} queued for {recipients}")
         else:
-            print("No low stock items found.")
\ No newline at end of file
+            # 宛先がなくても処理済みにする(未処理のまま残すと、毎回同じ変化を読み直すことになる)
+            print('No recipients found')
+
+    else:
+        print("No new low stock items found.")
+
+    mark_stock_alerts_processed(alert_ids)
+
+
+def archive_old_logs():
+    print("archiving old inventory logs ...")
+    result = archive_inventory_logs()
+    if result['archived_rows']:
+        print(f"Archived {result['archived_rows']} logs older than {result['cutoff']} ({', '.join(result['months'])}).")
+    else:
+        print("No logs to archive.")
+
+
+def take_daily_snapshot():
+    print("taking inventory snapshot ...")
+    count = take_inventory_snapshot()
+    print(f"Recorded {count} inventory snapshot rows.")
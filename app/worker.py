@@ -0,0 +1,203 @@
+import os
+import signal
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from sqlalchemy.exc import IntegrityError
+from . import db, tasks
+from .models import SchedulerLease, get_jst_now
+from .outbox import mail_outbox
+
+# 定期ジョブを実行するワーカーを決めるリースの名前
+LEASE_NAME = 'scheduler'
+
+# ワーカーが実行する定期ジョブ(ジョブID: 処理)
+TASKS = {
+    'check_stock_levels': tasks.check_stock_levels,
+    'take_daily_snapshot': tasks.take_daily_snapshot,
+    'archive_old_logs': tasks.archive_old_logs,
+}
+
+# 実行中のワーカー。ジョブストアには関数の参照しか保存できないので、run_job からはここを通してアプリを使う
+_current_worker = None
+
+
+def acquire_lease(name, owner, ttl):
+    """
+    リースを取得または延長する。取得できた(自分が持っている)場合は True
+
+    期限切れのリースか自分のリースだけを UPDATE の条件で書き換えるので、
+    複数のワーカーが同時に取りに来ても、持ち主になれるのは1つだけになる。
+    """
+    now = get_jst_now()
+    table = SchedulerLease.__table__
+    result = db.session.execute(
+        db.update(table)
+        .where(table.c.name == name, (table.c.owner == owner) | (table.c.expires_at < now))
+        .values(owner=owner, expires_at=now + ttl)
+    )
+    if result.rowcount:
+        db.session.commit()
+        return True
+
+    if db.session.get(SchedulerLease, name) is not None:
+        # 他のワーカーが有効なリースを持っている
+        db.session.rollback()
+        return False
+    try:
+        db.session.add(SchedulerLease(name=name, owner=owner, expires_at=now + ttl))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # 同時に別のワーカーが最初のリースを作成した
+        db.session.rollback()
+        return False
+
+
+def holds_lease(name, owner):
+    """owner が期限内のリースを持っているか"""
+    return db.session.scalar(
+        db.select(SchedulerLease.name)
+        .where(SchedulerLease.name == name, SchedulerLease.owner == owner, SchedulerLease.expires_at > get_jst_now())
+    ) is not None
+
+
+def release_lease(name, owner):
+    """リースを手放し、他のワーカーがすぐに引き継げるようにする"""
+    db.session.execute(
+        db.update(SchedulerLease)
+        .where(SchedulerLease.name == name, SchedulerLease.owner == owner)
+        .values(expires_at=get_jst_now())
+    )
+    db.session.commit()
+
+
+def run_job(task_name):
+    """
+    スケジューラーから呼ばれる定期ジョブの入り口
+
+    ワーカーが最初に作ったアプリのコンテキストで処理を実行する。
+    ジョブの開始時にもリースを確認し、リースを失っていれば(別のワーカーが引き継いでいれば)何もしない。
+    """
+    worker = _current_worker
+    if worker is None:
+        return
+    with worker.app.app_context():
+        try:
+            if not holds_lease(LEASE_NAME, worker.owner):
+                worker.app.logger.warning('skip job %s: scheduler lease is not held by %s', task_name, worker.owner)
+                return
+            TASKS[task_name]()
+        except Exception:
+            db.session.rollback()
+            worker.app.logger.exception('job %s failed', task_name)
+        finally:
+            db.session.remove()
+
+
+class SchedulerWorker:
+    """
+    定期ジョブ(在庫アラート・スナップショット・ログのアーカイブ)とメール送信を実行するワーカー
+
+    `flask worker` で起動する。アプリは起動時に1回だけ作り、すべてのジョブで使い回す。
+    ワーカーをいくつ起動しても、データベースのリースを持っている1つだけがスケジューラーを動かす。
+    他のワーカーは待機し、リースの持ち主が止まってリースが切れると引き継ぐ。
+
+    ジョブの次回実行時刻はデータベースのジョブストアに保存するので、ワーカーを再起動・交代しても予定は失われない。
+    止まっている間に実行時刻を過ぎたジョブは、WORKER_MISFIRE_GRACE_TIME 秒以内なら引き継ぎ後に1回だけ実行する(coalesce)。
+    """
+
+    def __init__(self, app, owner=None):
+        self.app = app
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lease_ttl = timedelta(seconds=app.config['WORKER_LEASE_SECONDS'])
+        self.scheduler = None
+        self._stop = threading.Event()
+
+    def _triggers(self):
+        config = self.app.config
+        return {
+            'check_stock_levels': IntervalTrigger(seconds=config['WORKER_STOCK_CHECK_INTERVAL'], timezone='Asia/Tokyo'),
+            'take_daily_snapshot': CronTrigger(hour=0, minute=5, timezone='Asia/Tokyo'),
+            'archive_old_logs': CronTrigger(hour=3, minute=0, timezone='Asia/Tokyo'),
+        }
+
+    def _start_scheduler(self):
+        config = self.app.config
+        with self.app.app_context():
+            engine = db.engine
+        scheduler = BackgroundScheduler(
+            jobstores={'default': SQLAlchemyJobStore(engine=engine, tablename='apscheduler_jobs')},
+            executors={'default': ThreadPoolExecutor(len(TASKS))},
+            job_defaults={
+                'coalesce': True,
+                'max_instances': 1,
+                'misfire_grace_time': config['WORKER_MISFIRE_GRACE_TIME'],
+            },
+            timezone='Asia/Tokyo'
+        )
+        # 保存済みのジョブを読み込んでから、設定が変わったジョブだけを登録し直す
+        # (変わっていないジョブの次回実行時刻はそのまま残し、止まっていた間の実行漏れを検出できるようにする)
+        scheduler.start(paused=True)
+        for task_name, trigger in self._triggers().items():
+            job = scheduler.get_job(task_name)
+            if job is None or str(job.trigger) != str(trigger):
+                scheduler.add_job(run_job, trigger, args=[task_name], id=task_name, name=task_name, replace_existing=True)
+        for job in scheduler.get_jobs():
+            if job.id not in TASKS:
+                job.remove()
+        scheduler.resume()
+        self.scheduler = scheduler
+        self.app.logger.info('scheduler started by %s', self.owner)
+
+    def _stop_scheduler(self):
+        if self.scheduler is not None:
+            self.scheduler.shutdown(wait=True)
+            self.scheduler = None
+            self.app.logger.info('scheduler stopped by %s', self.owner)
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def run(self):
+        """リースの取得・延長を繰り返しながら、止められるまで動き続ける"""
+        global _current_worker
+        _current_worker = self
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+        mail_outbox.start()
+
+        # リースの期限の1/3ごとに延長するので、一時的な遅れがあってもリースは切れない
+        renew_interval = self.lease_ttl.total_seconds() / 3
+        try:
+            while not self._stop.is_set():
+                with self.app.app_context():
+                    try:
+                        leader = acquire_lease(LEASE_NAME, self.owner, self.lease_ttl)
+                    except Exception:
+                        db.session.rollback()
+                        self.app.logger.exception('failed to renew scheduler lease')
+                        leader = False
+                    finally:
+                        db.session.remove()
+
+                if leader and self.scheduler is None:
+                    self._start_scheduler()
+                elif not leader and self.scheduler is not None:
+                    self._stop_scheduler()
+                self._stop.wait(renew_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop_scheduler()
+            with self.app.app_context():
+                release_lease(LEASE_NAME, self.owner)
+                db.session.remove()
+            mail_outbox.stop(timeout=30)
+            _current_worker = None
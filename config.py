@@ -3,6 +3,23 @@ import os
 # アプリケーションのルートディレクトリのパスを取得
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+def engine_options(pool_size, max_overflow, pool_recycle, pool_pre_ping=True):
+    """
+    SQLAlchemyの接続プールの設定を作る関数(環境変数 DB_POOL_* で上書きできる)
+
+    接続プールはプロセスごとに作られるので、pool_size はプロセスあたりのスレッド数(WEB_THREADS)以上にする。
+    """
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', pool_size)),
+        'max_overflow': int(os.environ.get('DB_POOL_MAX_OVERFLOW', max_overflow)),
+        # 接続が空くのを待つ秒数
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        # この秒数より古い接続は作り直す(DBサーバー側のアイドル切断への対策)
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', pool_recycle)),
+        # 接続を貸し出す前に生きているかを確認する
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', str(pool_pre_ping)).lower() in ['true', 'on', '1'],
+    }
+
 class Config:
     """
     全ての設定の基本となるベースクラス
@@ -19,11 +36,73 @@ class Config:
 
     MAIL_SENDER = f"在庫管理システム <{os.environ.get('MAIL_USERNAME')}>"
 
+    # メールの送信方法: 'gmail'(Gmail API) / 'smtp'(MAIL_SERVER) / 'file'(MAIL_FILE_DIR に .eml で保存。テスト・オフライン用)
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT', 'gmail')
+    MAIL_FILE_DIR = os.environ.get('MAIL_FILE_DIR') # 未指定なら instance/mail
+    GMAIL_TOKEN_FILE = os.environ.get('GMAIL_TOKEN_FILE', 'token.json')
+    # 送信待ちメールを1回に取り出す件数・1秒あたりの最大送信数
+    MAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('MAIL_OUTBOX_BATCH_SIZE', 20))
+    MAIL_OUTBOX_RATE = float(os.environ.get('MAIL_OUTBOX_RATE', 2))
+    # 送信に失敗したときの再試行(MAIL_OUTBOX_RETRY_BASE 秒から倍々に間隔を空け、MAIL_OUTBOX_MAX_ATTEMPTS 回で諦める)
+    MAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('MAIL_OUTBOX_MAX_ATTEMPTS', 5))
+    MAIL_OUTBOX_RETRY_BASE = int(os.environ.get('MAIL_OUTBOX_RETRY_BASE', 30))
+    # 送信待ちがないときに次に確認するまでの秒数
+    MAIL_OUTBOX_POLL_INTERVAL = int(os.environ.get('MAIL_OUTBOX_POLL_INTERVAL', 10))
+    # 定期ジョブのワーカー(flask worker)の設定
+    # 在庫アラートの確認間隔(秒)
+    WORKER_STOCK_CHECK_INTERVAL = int(os.environ.get('WORKER_STOCK_CHECK_INTERVAL', 30))
+    # ジョブを実行するワーカーを決めるリースの有効期間(秒)。持ち主が止まるとこの時間で他のワーカーが引き継ぐ
+    WORKER_LEASE_SECONDS = int(os.environ.get('WORKER_LEASE_SECONDS', 30))
+    # 実行時刻を過ぎてしまったジョブを、それでも実行する猶予(秒)
+    WORKER_MISFIRE_GRACE_TIME = int(os.environ.get('WORKER_MISFIRE_GRACE_TIME', 6 * 60 * 60))
+    # 在庫アラートのメールを並行して描画するスレッドの数
+    ALERT_RENDER_WORKERS = int(os.environ.get('ALERT_RENDER_WORKERS', 4))
+
+    # ログイン中のユーザーをプロセス内にキャッシュする秒数(0でキャッシュしない)
+    # ユーザー情報の変更は、変更したプロセスではすぐに、他のプロセスではこの秒数以内に反映される
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+
+    # /products の行ごとの描画結果をキャッシュする行数(プロセスごと)
+    ROW_FRAGMENT_CACHE_SIZE = int(os.environ.get('ROW_FRAGMENT_CACHE_SIZE', 5000))
+
+    # リクエストごとの応答時間とSQL文の数・時間を集計するか(/admin/metrics)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ['true', 'on', '1']
+    # 1リクエストで同じ形のSQL文がこの回数以上実行されたら N+1 の疑いとして記録・警告する
+    METRICS_N_PLUS_ONE_THRESHOLD = int(os.environ.get('METRICS_N_PLUS_ONE_THRESHOLD', 10))
+
+    # 在庫の変更イベントの配信(/api/inventory/events)
+    # プロセスごとに保持するイベントの件数。これより多く遅れた画面には在庫を読み直させる
+    INVENTORY_EVENTS_BACKLOG = int(os.environ.get('INVENTORY_EVENTS_BACKLOG', 1000))
+    # イベントがないときに接続維持のコメントを送る間隔(秒)
+    INVENTORY_EVENTS_HEARTBEAT = int(os.environ.get('INVENTORY_EVENTS_HEARTBEAT', 15))
+    # 1本のSSE接続を保つ最長の秒数。切れた後はブラウザが自動で再接続する(その間ワーカーのスレッドを1つ使う)
+    INVENTORY_EVENTS_STREAM_SECONDS = int(os.environ.get('INVENTORY_EVENTS_STREAM_SECONDS', 300))
+    # プロセスごとに同時にイベントを待てる接続(SSE・ロングポーリング)の数。
+    # 通常のリクエスト用のスレッドが残るよう、gunicorn のスレッド数(WEB_THREADS)の半分にする。
+    # 上限に達したときは待たずに応答し、画面は間隔を空けたポーリングで受け取る
+    INVENTORY_EVENTS_MAX_STREAMS = int(os.environ.get('INVENTORY_EVENTS_MAX_STREAMS', int(os.environ.get('WEB_THREADS', 4)) // 2))
+
+    # CSV/Excelインポートで1回に読み込み・コミットする行数
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+    # インポートジョブを実行するバックグラウンドスレッドの数
+    IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 2))
+    # 待機中・実行中のまま、この秒数のあいだハートビート(この1/3ごとに書き込む)が途切れたジョブは、
+    # 実行していたプロセスが終了した(gunicorn のワーカーの入れ替え・デプロイなど)とみなして失敗にする
+    IMPORT_JOB_STALE_SECONDS = int(os.environ.get('IMPORT_JOB_STALE_SECONDS', 5 * 60))
+
+    # 操作ログをデータベースに残す日数。これより古いログはアーカイブファイルへ移す
+    LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 180))
+    # アーカイブファイルの保存先(未指定なら instance/log_archive)
+    LOG_ARCHIVE_DIR = os.environ.get('LOG_ARCHIVE_DIR')
+    # アーカイブ済みのログを削除するときに1回で消す行数
+    LOG_ARCHIVE_BATCH_SIZE = int(os.environ.get('LOG_ARCHIVE_BATCH_SIZE', 5000))
+
 class DevelopmentConfig(Config):
     """
     開発環境用の設定
     """
     DEBUG = True
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=False)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'db.sqlite')
 
@@ -32,6 +111,10 @@ class ProductionConfig(Config):
     本番環境用の設定
     """
     DEBUG = False
+    # gunicorn のワーカー1つあたりのスレッド数(WEB_THREADS)に、メール送信などのバックグラウンド処理の分を足す
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        pool_size=int(os.environ.get('WEB_THREADS', 4)) + 2, max_overflow=5, pool_recycle=1800
+    )
     # 本番環境ではPostgreSQLなど、より堅牢なデータベースを使うのが一般的
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'db.sqlite')
@@ -0,0 +1,49 @@
+"""
+gunicorn の設定(本番環境の起動方法)
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+設定はすべて環境変数で変更できる。
+  WEB_BIND     待ち受けるアドレス(既定: 0.0.0.0:8000)
+  WEB_WORKERS  ワーカープロセスの数(既定: CPUコア数 * 2 + 1)
+  WEB_THREADS  ワーカー1つあたりのスレッド数(既定: 4)
+  WEB_TIMEOUT  1リクエストの処理がこの秒数を超えたらワーカーを再起動する(既定: 60)
+  WEB_ACCESS_LOG  アクセスログの出力先(既定: 標準出力。空にすると出力しない)
+
+gthread ワーカーでは、/products の画面が開いている間の在庫変更の配信(/api/inventory/events の SSE・
+ロングポーリング)が接続ごとにスレッドを1つ使い続ける(SSE は最長 INVENTORY_EVENTS_STREAM_SECONDS 秒)。
+同時に配信できる接続の数はワーカーごとに INVENTORY_EVENTS_MAX_STREAMS(既定: WEB_THREADS の半分)までで、
+残りのスレッドが通常のリクエストを処理する。上限を超えた画面は、待たずに応答するポーリングに切り替わる。
+画面を開いたままにする利用者が多い場合は、WEB_THREADS を増やす(INVENTORY_EVENTS_MAX_STREAMS も増える)。
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+# スレッドを使うワーカー(threads が 1 のときは sync と同じ動きになる)
+worker_class = 'gthread'
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+# アプリを親プロセスで1回だけ読み込んでからワーカーを fork する(起動が速く、メモリも共有される)
+preload_app = True
+
+# 長時間動かしたときのメモリの増加に備えて、一定数のリクエストを処理したワーカーを入れ替える
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-') or None # 空にするとアクセスログを出さない
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # preload したアプリの接続プールを親プロセスと共有しないよう、ワーカーごとに作り直す
+    # (close=False: 親プロセスの接続を閉じずに、参照だけを捨てる)
+    from app import db
+    from wsgi import app
+
+    with app.app_context():
+        db.engine.dispose(close=False)
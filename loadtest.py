@@ -0,0 +1,192 @@
+"""
+/products と /api/update_inventory の負荷試験を行うスクリプト
+
+gunicorn をワーカー数を変えながら起動し、それぞれのスループットと応答時間を表示する。
+
+    python loadtest.py --workers 1 2 4 --threads 4 --clients 16 --duration 10 --username admin --password ****
+
+--url を指定した場合は gunicorn を起動せず、起動済みのサーバーを1回だけ計測する。
+/api/update_inventory は実際に在庫を書き換えるので、開発用・検証用のデータベースで実行すること。
+在庫の書き換えは、各クライアントが別々の在庫を担当するので、同じ在庫の取り合い(409)は起きにくい。
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+def login(base_url, username, password):
+    """ログイン済みのセッションを返す"""
+    session = requests.Session()
+    page = session.get(f'{base_url}/login', timeout=30)
+    match = CSRF_PATTERN.search(page.text)
+    data = {'username': username, 'password': password}
+    if match:
+        data['csrf_token'] = match.group(1)
+    response = session.post(f'{base_url}/login', data=data, timeout=30)
+    if '/login' in response.url:
+        raise RuntimeError(f'{username} でログインできませんでした')
+    return session
+
+
+def fetch_inventories(session, base_url):
+    """書き換えに使う既存の在庫の (在庫ID, 在庫数, 閾値, バージョン) を /api/products から集める"""
+    data = session.get(f'{base_url}/api/products', timeout=30).json()
+    inventories = []
+    for cell in data['cells']:
+        for row in zip(cell['inventory_id'], cell['quantity'], cell['threshold'], cell['version']):
+            if row[0] is not None:
+                inventories.append(list(row))
+    return inventories
+
+
+def run_clients(clients, duration, request_fn):
+    """
+    clients 個のスレッドで duration 秒間 request_fn(クライアント番号, 回数) を呼び続け、
+    (成功した応答時間のリスト, 失敗数, 経過秒数) を返す
+    """
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    deadline = time.perf_counter() + duration
+
+    def client(index):
+        count = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                ok = request_fn(index, count)
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies[index].append(time.perf_counter() - started)
+            else:
+                errors[index] += 1
+            count += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [x for l in latencies for x in l], sum(errors), time.perf_counter() - started
+
+
+def summarize(label, latencies, errors, elapsed):
+    if latencies:
+        ordered = sorted(latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        mean = statistics.mean(ordered)
+    else:
+        p95 = mean = 0.0
+    return (f'{label:<28} {len(latencies):>8} {len(latencies) / elapsed:>10.1f} '
+            f'{mean * 1000:>9.1f} {p95 * 1000:>9.1f} {errors:>7}')
+
+
+def measure(base_url, args):
+    """起動済みのサーバーに対して2つのシナリオを計測し、結果の行を返す"""
+    sessions = [login(base_url, args.username, args.password) for _ in range(args.clients)]
+    inventories = fetch_inventories(sessions[0], base_url)
+    if not inventories:
+        raise RuntimeError('書き換えられる在庫がありません')
+
+    def get_products(index, count):
+        return sessions[index].get(f'{base_url}/products', timeout=60).status_code == 200
+
+    # クライアントごとに担当する在庫を分ける
+    assigned = [inventories[i::args.clients] or inventories for i in range(args.clients)]
+
+    def update_inventory(index, count):
+        inventory = assigned[index][count % len(assigned[index])]
+        inventory_id, quantity, threshold, version = inventory
+        response = sessions[index].post(f'{base_url}/api/update_inventory', json={
+            'inventory_id': inventory_id,
+            # 在庫数を1増やす・減らすを交互に繰り返す(0未満にはしない)
+            'quantity': quantity + 1 if quantity % 2 == 0 else quantity - 1,
+            'threshold': threshold,
+            'version': version,
+        }, timeout=60)
+        result = response.json()
+        if 'new_version' in result:
+            # 成功でも競合(409)でも、最新の値とバージョンで次の更新を行う
+            inventory[1:] = [result['new_quantity'], result['new_threshold'], result['new_version']]
+        return response.status_code == 200
+
+    return [
+        summarize('GET /products', *run_clients(args.clients, args.duration, get_products)),
+        summarize('POST /api/update_inventory', *run_clients(args.clients, args.duration, update_inventory)),
+    ]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, threads, config_name):
+    """gunicorn を起動し、リクエストを受け付けられるようになるまで待つ"""
+    port = _free_port()
+    env = dict(os.environ, WEB_BIND=f'127.0.0.1:{port}', WEB_WORKERS=str(workers),
+               WEB_THREADS=str(threads), WEB_ACCESS_LOG='', FLASK_CONFIG=config_name)
+    root = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+        cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn が起動できませんでした')
+        try:
+            requests.get(f'{base_url}/login', timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn の起動がタイムアウトしました')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/products と /api/update_inventory の負荷試験')
+    parser.add_argument('--url', help='起動済みのサーバーのURL(指定すると gunicorn を起動しない)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='試すワーカープロセス数')
+    parser.add_argument('--threads', type=int, default=4, help='ワーカー1つあたりのスレッド数')
+    parser.add_argument('--clients', type=int, default=16, help='同時に接続するクライアントの数')
+    parser.add_argument('--duration', type=float, default=10, help='シナリオごとの計測秒数')
+    parser.add_argument('--config', default=os.getenv('FLASK_CONFIG', 'development'), help='起動するサーバーの設定名')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', required=True)
+    args = parser.parse_args()
+
+    header = f'{"scenario":<28} {"requests":>8} {"req/s":>10} {"avg(ms)":>9} {"p95(ms)":>9} {"errors":>7}'
+    if args.url:
+        print(header)
+        for line in measure(args.url.rstrip('/'), args):
+            print(line)
+        return
+
+    for workers in args.workers:
+        process, base_url = start_server(workers, args.threads, args.config)
+        try:
+            print(f'\n== workers={workers} threads={args.threads} clients={args.clients} ==')
+            print(header)
+            for line in measure(base_url, args):
+                print(line)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
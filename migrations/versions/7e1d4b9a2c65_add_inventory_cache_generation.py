@@ -0,0 +1,31 @@
+"""add inventory cache generation
+
+Revision ID: 7e1d4b9a2c65
+Revises: 5c3e8a1f7d24
+Create Date: 2026-10-19 01:12:44.503918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e1d4b9a2c65'
+down_revision = '5c3e8a1f7d24'
+branch_labels = None
+depends_on = None
+
+
+cache_generation = sa.table('cache_generation',
+    sa.column('name', sa.String(length=64)),
+    sa.column('value', sa.Integer())
+)
+
+
+def upgrade():
+    # 在庫データのバージョン(在庫を書き換えるたびに進み、/products などのETagに使う)
+    op.bulk_insert(cache_generation, [{'name': 'inventory', 'value': 0}])
+
+
+def downgrade():
+    op.execute(cache_generation.delete().where(cache_generation.c.name == 'inventory'))
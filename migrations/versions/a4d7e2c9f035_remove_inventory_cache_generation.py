@@ -0,0 +1,31 @@
+"""remove inventory cache generation
+
+Revision ID: a4d7e2c9f035
+Revises: 0666112ae52a
+Create Date: 2026-10-19 13:27:51.904126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d7e2c9f035'
+down_revision = '0666112ae52a'
+branch_labels = None
+depends_on = None
+
+
+cache_generation = sa.table('cache_generation',
+    sa.column('name', sa.String(length=64)),
+    sa.column('value', sa.Integer())
+)
+
+
+def upgrade():
+    # 在庫データのバージョンは使わなくなった(ETagは表示する行の値から作り、他のプロセスの書き込みは在庫の変更ログで検出する)
+    op.execute(cache_generation.delete().where(cache_generation.c.name == 'inventory'))
+
+
+def downgrade():
+    op.bulk_insert(cache_generation, [{'name': 'inventory', 'value': 0}])
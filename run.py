@@ -1,12 +1,14 @@
 import os
 import logging
 
+import click
+
 from app import create_app, db
 from flask_migrate import Migrate
 from app.models import User, Store, Product, Inventory, InventoryLog, ProductLog 
 
 logging.basicConfig()
-logging.getLogger('apscheduler').setLevel(logging.DEBUG)
+logging.getLogger('apscheduler').setLevel(logging.INFO)
 
 # 環境変数'FLASK_CONFIG'があればそれを使う。なければ'default'を使う
 config_name = os.getenv('FLASK_CONFIG', 'default')
@@ -22,15 +24,62 @@ def make_shell_context():
         'Inventory': Inventory, 'InventoryLog': InventoryLog, 'ProductLog': ProductLog
     }
 
-if __name__ == '__main__':
-    from apscheduler.schedulers.background import BackgroundScheduler
-    from app.tasks import check_stock_levels
-    # scheduler
-    scheduler = BackgroundScheduler(daemon=True)
-    # every 9:30 am, running check_stock_levels
-    # in this test interval, seconds=60 , mail will send every 60sec. 
-    scheduler.add_job(check_stock_levels, 'interval', seconds=30)
-    # 本番用: scheduler.add_job(check_stock_levels, 'cron', hour=9, minute=30)
-    scheduler.start()
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """主要なクエリの実行計画を表示し、全件スキャンがあれば異常終了する"""
+    from app.query_plans import check_query_plans
+
+    failed = False
+    for name, plan, full_scans in check_query_plans():
+        status = 'NG' if full_scans else 'OK'
+        print(f'[{status}] {name}')
+        for detail in plan:
+            print(f'    {detail}')
+        if full_scans:
+            failed = True
+            print(f'    -> 全件スキャン: {", ".join(full_scans)}')
+
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('archive-logs')
+@click.option('--days', type=int, default=None, help='データベースに残す日数(省略時は LOG_RETENTION_DAYS)')
+def archive_logs_command(days):
+    """保存期間を過ぎた操作ログをアーカイブファイルへ移し、日ごとの集計を残す"""
+    from app.archive import archive_inventory_logs
+
+    result = archive_inventory_logs(retention_days=days)
+    print(f"{result['cutoff']} より前のログ {result['archived_rows']} 件をアーカイブしました")
+    for month in result['months']:
+        print(f'    {month}')
+
+@app.cli.command('snapshot-inventory')
+def snapshot_inventory_command():
+    """全在庫の現在の在庫数と閾値を今日のスナップショットとして記録する"""
+    from app.snapshots import take_inventory_snapshot
 
+    count = take_inventory_snapshot()
+    print(f'在庫のスナップショットを {count} 件記録しました')
+
+@app.cli.command('send-mail')
+def send_mail_command():
+    """送信待ちのメールを今すぐ送信する"""
+    from app.outbox import mail_outbox
+    from app.models import OutboxMessage
+
+    count = mail_outbox.drain()
+    failed = OutboxMessage.query.filter_by(state='failed').count()
+    print(f'{count} 件のメールを処理しました(送信に失敗したメール: {failed} 件)')
+
+@app.cli.command('worker')
+def worker_command():
+    """定期ジョブ(在庫アラート・スナップショット・ログのアーカイブ)とメール送信を実行するワーカーを起動する"""
+    from app.worker import SchedulerWorker
+
+    worker = SchedulerWorker(app)
+    print(f'ワーカー {worker.owner} を起動しました(Ctrl+C で停止)')
+    worker.run()
+
+if __name__ == '__main__':
+    # 定期ジョブとメール送信は別プロセスの `flask --app run worker` で実行する
     app.run(use_reloader=False) # debug=True はconfigから読み込まれるので不要
\ No newline at end of file
@@ -0,0 +1,18 @@
+"""
+本番環境用のWSGIエントリーポイント
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+プロセス数・スレッド数などは gunicorn.conf.py(環境変数 WEB_*)で、
+データベースの接続プールは config.py の SQLALCHEMY_ENGINE_OPTIONS(環境変数 DB_POOL_*)で設定する。
+定期ジョブとメール送信はWebのプロセスでは動かさず、別プロセスの `flask --app run worker` で実行する。
+"""
+import os
+import logging
+
+from app import create_app
+
+logging.basicConfig(level=logging.INFO)
+
+# 環境変数'FLASK_CONFIG'があればそれを使う。なければ本番環境の設定を使う
+app = create_app(os.getenv('FLASK_CONFIG', 'production'))